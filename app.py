@@ -1,17 +1,37 @@
 import os
 import json
+import time
 import traceback
 import asyncio
+from collections import OrderedDict
 from typing import Optional
 from urllib.parse import urlsplit
 
-from fastapi import FastAPI, Header, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, AsyncSession
-from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker
 
+import archive
+import eq5d5l_scoring
+import events
+import intake_analysis
+import metrics
+import pool_control
+import ratelimit
+import repository
+import sharding
+import singleflight
+import tracing
+from repository import (
+    DAILY_TREND_METRICS,
+    DAILY_TREND_WINDOWS,
+    MemoryRepository,
+    PostgresRepository,
+    Repository,
+)
+
 
 # Pydantic модели - точно как отправляет frontend
 class WeeklyPayload(BaseModel):
@@ -75,68 +95,289 @@ def _build_async_url(sync_url: str) -> str:
     return sync_url
 
 
+# Лента изменений для /events (включается CHANGE_FEED_TOKEN)
+change_broadcaster = events.ChangeBroadcaster()
+
+# Хранилище: postgres (по умолчанию) или memory - in-process движок для тестов
+# и профилирования без базы (данные не сохраняются между перезапусками)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres").lower()
+
+# DAILY_LAYOUT=compact хранит каждое количество food_*/drink_* в одном байте; в широкой раскладке
+# и в MemoryRepository это SMALLINT без CHECK (schema.sql), и /sendDaily их не ограничивает
+INTAKE_AMOUNT_LIMIT = (
+    intake_analysis.MAX_INTAKE_AMOUNT
+    if STORAGE_BACKEND != "memory" and repository.DAILY_LAYOUT == "compact" else None
+)
+
 # Инициализация базы данных
 DATABASE_URL = os.getenv("DATABASE_URL", "")
+# DATABASE_SHARD_URLS: пациенты распределены по нескольким базам (sharding.py), DATABASE_URL не нужен
+DATABASE_SHARDS = sharding.parse_shard_urls(sharding.DATABASE_SHARD_URLS)
 engine: AsyncEngine = None
 async_session = None
+# Движок, sessionmaker и контроллер пула каждой базы: name -> (engine, session factory, controller)
+databases: dict = {}
+change_listeners: list = []
+pool_controllers: list = []
+
+
+def _create_engine(database_url: str):
+    """Async engine for one database; returns (engine, async URL, asyncpg connect_args)."""
+    # ПРОСТОЕ РЕШЕНИЕ: автоматически переключаемся на Session Pooler (порт 5432)
+    # Transaction Pooler (порт 6543) не поддерживает prepared statements
+    # Заменяем :6543 на :5432 если используется pooler
+    if ":6543" in database_url:
+        database_url = database_url.replace(":6543", ":5432")
+        print("Switched from Transaction Pooler (6543) to Session Pooler (5432) for prepared statements support")
+    elif ".pooler.supabase.com" in database_url and ":5432" not in database_url:
+        # Если pooler, но порт не указан явно - добавляем 5432
+        database_url = database_url.replace(".pooler.supabase.com", ".pooler.supabase.com:5432")
+        print("Added Session Pooler port (5432) for prepared statements support")
+
+    async_url = _build_async_url(database_url)
+    ssl_required = "sslmode=require" in database_url.lower() or os.getenv("SUPABASE_SSLMODE") == "require"
+
+    # Optimized connection args for reliability
+    connect_args = {
+        "server_settings": {
+            "application_name": "lars_backend",
+            "tcp_keepalives_idle": "600",
+            "tcp_keepalives_interval": "30",
+            "tcp_keepalives_count": "3",
+        },
+        "command_timeout": 60,  # Timeout for SQL commands (60 seconds - longer for complex queries)
+        "timeout": 20,  # Connection timeout (20 seconds - enough for Supabase pooler)
+    }
+    if ssl_required:
+        # Minimal SSL config - just require SSL, don't verify cert (faster)
+        # Supabase pooler doesn't need cert verification
+        connect_args["ssl"] = True  # Simple SSL requirement
+
+    # Optimized pool settings for reliability with multiple concurrent users
+    new_engine = create_async_engine(
+        async_url,
+        pool_pre_ping=True,  # Enable pre-ping to detect dead connections
+        pool_size=pool_control.POOL_SIZE,  # POOL_SIZE, default 10: connections kept open
+        max_overflow=pool_control.POOL_MAX_OVERFLOW,  # POOL_MAX_OVERFLOW, default 20: extra for peaks
+        pool_recycle=3600,  # Recycle every hour (Supabase connections are stable)
+        pool_timeout=pool_control.POOL_TIMEOUT,  # POOL_TIMEOUT, default 30s
+        connect_args=connect_args,
+        max_identifier_length=128,
+        echo=False,
+        pool_reset_on_return="commit",  # Faster connection return
+    )
+    return new_engine, async_url, connect_args
 
-if DATABASE_URL:
+
+if (DATABASE_URL or DATABASE_SHARDS) and STORAGE_BACKEND != "memory":
     try:
-        # ПРОСТОЕ РЕШЕНИЕ: автоматически переключаемся на Session Pooler (порт 5432)
-        # Transaction Pooler (порт 6543) не поддерживает prepared statements
-        # Заменяем :6543 на :5432 если используется pooler
-        if ":6543" in DATABASE_URL:
-            DATABASE_URL = DATABASE_URL.replace(":6543", ":5432")
-            print("Switched from Transaction Pooler (6543) to Session Pooler (5432) for prepared statements support")
-        elif ".pooler.supabase.com" in DATABASE_URL and ":5432" not in DATABASE_URL:
-            # Если pooler, но порт не указан явно - добавляем 5432
-            DATABASE_URL = DATABASE_URL.replace(".pooler.supabase.com", ".pooler.supabase.com:5432")
-            print("Added Session Pooler port (5432) for prepared statements support")
-        
-        ASYNC_DATABASE_URL = _build_async_url(DATABASE_URL)
-        ssl_required = "sslmode=require" in DATABASE_URL.lower() or os.getenv("SUPABASE_SSLMODE") == "require"
-        
-        # Optimized connection args for reliability
-        connect_args = {
-            "server_settings": {
-                "application_name": "lars_backend",
-                "tcp_keepalives_idle": "600",
-                "tcp_keepalives_interval": "30",
-                "tcp_keepalives_count": "3",
-            },
-            "command_timeout": 60,  # Timeout for SQL commands (60 seconds - longer for complex queries)
-            "timeout": 20,  # Connection timeout (20 seconds - enough for Supabase pooler)
-        }
-        if ssl_required:
-            # Minimal SSL config - just require SSL, don't verify cert (faster)
-            # Supabase pooler doesn't need cert verification
-            connect_args["ssl"] = True  # Simple SSL requirement
-        
-        # Optimized pool settings for reliability with multiple concurrent users
-        engine = create_async_engine(
-            ASYNC_DATABASE_URL,
-            pool_pre_ping=True,  # Enable pre-ping to detect dead connections
-            pool_size=10,  # Increased pool size for concurrent requests
-            max_overflow=20,  # Allow more overflow for peak loads
-            pool_recycle=3600,  # Recycle every hour (Supabase connections are stable)
-            pool_timeout=30,  # Longer timeout to wait for available connection
-            connect_args=connect_args,
-            max_identifier_length=128,
-            echo=False,
-            pool_reset_on_return="commit",  # Faster connection return
-        )
-        
-        async_session = sessionmaker(bind=engine, expire_on_commit=False, class_=AsyncSession)
-        print("Database engine initialized successfully")
+        statement_names = tracing.statement_names(repository, intake_analysis)
+        for name, url in (DATABASE_SHARDS or {"default": DATABASE_URL}).items():
+            db_engine, async_url, connect_args = _create_engine(url)
+            session_factory = sessionmaker(bind=db_engine, expire_on_commit=False, class_=AsyncSession)
+            tracing.instrument_engine(db_engine, statement_names)
+            # Адаптивный лимит одновременных сессий (POOL_ADAPTIVE=0 - выключить)
+            controller = pool_control.install(db_engine, name)
+            if controller:
+                pool_controllers.append(controller)
+            if events.CHANGE_FEED_TOKEN:
+                # LISTEN держит своё соединение вне пула
+                listen_args = dict(connect_args, server_settings=dict(
+                    connect_args["server_settings"], application_name="lars_backend_listener"))
+                change_listeners.append(events.PostgresChangeListener(
+                    change_broadcaster, async_url.replace("postgresql+asyncpg://", "postgresql://", 1), listen_args
+                ))
+            databases[name] = (db_engine, session_factory, controller)
+        if not DATABASE_SHARDS:
+            engine, async_session, _ = databases["default"]
+        print(f"Database engine initialized successfully ({len(databases)} database(s))")
     except Exception as e:
         print(f"Warning: Failed to initialize database engine: {e}")
         traceback.print_exc()
+        databases, change_listeners, pool_controllers = {}, [], []
+
+repo: Optional[Repository] = None
+if STORAGE_BACKEND == "memory":
+    repo = MemoryRepository()
+    if events.CHANGE_FEED_TOKEN:
+        repo.on_change = change_broadcaster.publish
+    print("Using in-memory storage backend (data is not persisted)")
+elif databases:
+    daily_archive = archive.create_archive()  # DAILY_ARCHIVE_DIR: старые daily_entries в Parquet
+    postgres_repos = {
+        name: PostgresRepository(
+            session_factory,
+            notify_changes=bool(events.CHANGE_FEED_TOKEN),
+            archive=daily_archive,
+            pool_controller=controller,
+        )
+        for name, (_, session_factory, controller) in databases.items()
+    }
+    if DATABASE_SHARDS:
+        repo = sharding.ShardedRepository(
+            postgres_repos, sharding.HashRing(DATABASE_SHARDS), archive=daily_archive
+        )
+        print(f"Sharding patients across {len(DATABASE_SHARDS)} databases: {', '.join(DATABASE_SHARDS)}")
+    else:
+        repo = postgres_repos["default"]
+
+class _PatientCache:
+    """Small in-process LRU cache of computed results, grouped per patient_code.
+
+    Entries for a patient are dropped all at once via invalidate() when that
+    patient submits new data. A reader takes generation() before its query and
+    passes it to put(); if the patient was invalidated in between, the result
+    (possibly read before the write) is not cached.
+
+    The cache is per process: with several replicas (or shards behind several
+    app instances) a sendDaily on one replica does not invalidate the others,
+    which keep serving their cached result until their own invalidation or
+    eviction.
+    """
+
+    def __init__(self, max_patients: int):
+        self.max_patients = max_patients
+        self._data: "OrderedDict[str, dict]" = OrderedDict()
+        # Поколение растёт при каждом invalidate(); для пациента помним, в каком его сбросили.
+        # Вытесненные записи поднимают _evicted_generation, чтобы не потерять сброс
+        self._generation = 0
+        self._invalidated: "OrderedDict[str, int]" = OrderedDict()
+        self._evicted_generation = 0
+
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, patient_code: str, key):
+        entries = self._data.get(patient_code)
+        if entries is None or key not in entries:
+            return None
+        self._data.move_to_end(patient_code)
+        return entries[key]
+
+    def put(self, patient_code: str, key, value, generation: int):
+        if max(self._invalidated.get(patient_code, 0), self._evicted_generation) > generation:
+            return
+        entries = self._data.setdefault(patient_code, {})
+        entries[key] = value
+        self._data.move_to_end(patient_code)
+        while len(self._data) > self.max_patients:
+            self._data.popitem(last=False)
+
+    def invalidate(self, patient_code: str):
+        self._data.pop(patient_code, None)
+        self._generation += 1
+        self._invalidated[patient_code] = self._generation
+        self._invalidated.move_to_end(patient_code)
+        while len(self._invalidated) > self.max_patients:
+            _, evicted = self._invalidated.popitem(last=False)
+            self._evicted_generation = max(self._evicted_generation, evicted)
+
+
+# Кэш для /getDailyTrends, сбрасывается в /sendDaily. Одна запись на пациента: (день, days, точки);
+# запрос с меньшим days берёт хвост закэшированного ряда
+daily_trends_cache = _PatientCache(int(os.getenv("DAILY_TRENDS_CACHE_SIZE", "1000")))
+
+# Кэш для /getFoodSymptomAssociations: (время расчёта, результат). Пациента сбрасывает его /sendDaily;
+# когорта хранится под ключом "*" (короче минимальной длины patient_code) и пересчитывается
+# не чаще раза в COHORT_CACHE_TTL_SECONDS, а не после каждой записи
+intake_analysis_cache = _PatientCache(int(os.getenv("INTAKE_ANALYSIS_CACHE_SIZE", "200")))
+COHORT_CACHE_KEY = "*"
+COHORT_CACHE_TTL_SECONDS = float(os.getenv("COHORT_CACHE_TTL_SECONDS", "600"))
+# Когортный анализ (cohort=true) читает дневники всех пациентов - только с токеном, как /events
+COHORT_ANALYSIS_TOKEN = os.getenv("COHORT_ANALYSIS_TOKEN", "")
+
+# Одинаковые одновременные чтения (endpoint, patient_code, параметры) ждут один запрос к БД;
+# send* вызывают forget() после записи
+read_flights = singleflight.SingleFlight()
+
+# EQ-5D-5L: контрольные точки (дней после регистрации) и окно заполнения вокруг каждой
+EQ5D5L_MILESTONES = eq5d5l_scoring.MILESTONES
+EQ5D5L_WINDOW_BEFORE_DAYS = eq5d5l_scoring.WINDOW_BEFORE_DAYS
+EQ5D5L_WINDOW_AFTER_DAYS = eq5d5l_scoring.WINDOW_AFTER_DAYS
+
+# GET /changes: максимум строк в одном ответе (и значение ?limit= по умолчанию)
+CHANGES_PAGE_LIMIT = int(os.getenv("CHANGES_PAGE_LIMIT", "500"))
+
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Трейс пишется только если включён экспорт (TRACE_EXPORT + sampling/slow)
+    # или клиент прислал X-Debug-Timing с правильным токеном
+    debug = tracing.debug_requested(request.headers.get(tracing.DEBUG_HEADER))
+    if not debug and not tracing.recording_enabled():
+        return await call_next(request)
+
+    trace = tracing.start_trace(f"{request.method} {request.url.path}")
+    try:
+        response = await call_next(request)
+    except Exception as e:
+        tracing.finish_trace(trace, e)
+        raise
+    trace.root.attributes["http.status_code"] = response.status_code
+    tracing.finish_trace(trace)
+    if debug:
+        response.headers["Server-Timing"] = tracing.server_timing(trace)
+    return response
+
+
+# Rate limiter: токены списываются до любой работы с базой
+rate_limiter = ratelimit.create_limiter()
+
+
+@app.middleware("http")
+async def rate_limit_requests(request: Request, call_next):
+    kind = ratelimit.request_kind(request.method, request.url.path)
+    if rate_limiter is None or kind is None:
+        return await call_next(request)
+
+    patient_code = (request.headers.get("x-patient-code") or "").strip().upper()
+    if not 4 <= len(patient_code) <= 64:
+        patient_code = None  # невалидный код отклонит сам handler, лимит остаётся по IP
+    ip = ratelimit.client_ip(request.headers, request.client.host if request.client else None)
+    rejected = await ratelimit.check(rate_limiter, kind, patient_code, ip)
+    if rejected:
+        scope, retry_after = rejected
+        return JSONResponse(
+            status_code=429,
+            content={"detail": f"Rate limit exceeded ({scope}), retry later"},
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+        )
+    return await call_next(request)
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    if change_listeners and len(databases) > 1:
+        # Несколько шардов: id /events не должны пересекаться (rebalance_shards.py --init-sequences)
+        try:
+            await sharding.check_change_event_sequences({name: db[0] for name, db in databases.items()})
+        except ValueError:
+            raise
+        except Exception as e:
+            print(f"Warning: Failed to check change_events_seq on shards: {type(e).__name__}: {e}")
+    for listener in change_listeners:
+        listener.start()
+    for controller in pool_controllers:
+        controller.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for listener in change_listeners:
+        await listener.stop()
+    for controller in pool_controllers:
+        await controller.stop()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/healthz")
 async def healthcheck():
-    db_status = "ok" if engine else "not_configured"
-    return {"status": "ok", "database": db_status}
+    db_status = "ok" if repo else "not_configured"
+    return {"status": "ok", "database": db_status, "storage": repo.name if repo else None}
 
 
 @app.post("/sendWeekly")
@@ -147,63 +388,27 @@ async def send_weekly(payload: WeeklyPayload, x_patient_code: Optional[str] = He
     if not patient_code or len(patient_code) < 4 or len(patient_code) > 64:
         raise HTTPException(status_code=400, detail="Invalid patient code format")
 
-    if not async_session:
+    if not repo:
         raise HTTPException(status_code=503, detail="Database not configured")
     
     try:
-        async with async_session() as session:
-            async with session.begin():
-                # Создать или получить patient_id
-                res = await session.execute(
-                    text("""
-                        INSERT INTO patients (patient_code)
-                        VALUES (:code)
-                        ON CONFLICT (patient_code) DO UPDATE SET patient_code = EXCLUDED.patient_code
-                        RETURNING id
-                    """).bindparams(code=patient_code)
-                )
-                patient_id = res.first()[0]
+        # Сохранить weekly entry
+        # Вычисляем total_score из raw_data если есть
+        total_score = None
+        if payload.raw_data and "total_score" in payload.raw_data:
+            total_score = payload.raw_data["total_score"]
 
-                # Сохранить weekly entry
-                # Вычисляем total_score из raw_data если есть
-                total_score = None
-                if payload.raw_data and "total_score" in payload.raw_data:
-                    total_score = payload.raw_data["total_score"]
-                
-                res2 = await session.execute(
-                    text("""
-                        INSERT INTO weekly_entries (
-                            patient_id, entry_date,
-                            flatus_control, liquid_stool_leakage, bowel_frequency,
-                            repeat_bowel_opening, urgency_to_toilet, total_score
-                        ) VALUES (
-                            :patient_id,
-                            COALESCE(CAST(:entry_date AS DATE), CURRENT_DATE),
-                            :flatus_control, :liquid_stool_leakage, :bowel_frequency,
-                            :repeat_bowel_opening, :urgency_to_toilet, :total_score
-                        )
-                        ON CONFLICT (patient_id, entry_date) DO UPDATE SET
-                            flatus_control = EXCLUDED.flatus_control,
-                            liquid_stool_leakage = EXCLUDED.liquid_stool_leakage,
-                            bowel_frequency = EXCLUDED.bowel_frequency,
-                            repeat_bowel_opening = EXCLUDED.repeat_bowel_opening,
-                            urgency_to_toilet = EXCLUDED.urgency_to_toilet,
-                            total_score = EXCLUDED.total_score
-                        RETURNING id
-                    """)
-                    .bindparams(
-                        patient_id=patient_id,
-                        entry_date=payload.entry_date,
-                        flatus_control=payload.flatus_control,
-                        liquid_stool_leakage=payload.liquid_stool_leakage,
-                        bowel_frequency=payload.bowel_frequency,
-                        repeat_bowel_opening=payload.repeat_bowel_opening,
-                        urgency_to_toilet=payload.urgency_to_toilet,
-                        total_score=total_score,
-                    )
-                )
-                row2 = res2.first()
-        return {"status": "ok", "id": str(row2[0])}
+        entry_id = await repo.upsert_weekly(patient_code, {
+            "entry_date": payload.entry_date,
+            "flatus_control": payload.flatus_control,
+            "liquid_stool_leakage": payload.liquid_stool_leakage,
+            "bowel_frequency": payload.bowel_frequency,
+            "repeat_bowel_opening": payload.repeat_bowel_opening,
+            "urgency_to_toilet": payload.urgency_to_toilet,
+            "total_score": total_score,
+        })
+        read_flights.forget(patient_code)
+        return {"status": "ok", "id": entry_id}
     except Exception as e:
         error_msg = str(e)
         error_type = type(e).__name__
@@ -223,163 +428,82 @@ async def send_daily(payload: DailyPayload, x_patient_code: Optional[str] = Head
     if not patient_code or len(patient_code) < 4 or len(patient_code) > 64:
         raise HTTPException(status_code=400, detail="Invalid patient code format")
 
-    if not async_session:
+    if not repo:
         raise HTTPException(status_code=503, detail="Database not configured")
     
     try:
-        async with async_session() as session:
-            async with session.begin():
-                res = await session.execute(
-                    text("""
-                        INSERT INTO patients (patient_code)
-                        VALUES (:code)
-                        ON CONFLICT (patient_code) DO UPDATE SET patient_code = EXCLUDED.patient_code
-                        RETURNING id
-                    """).bindparams(code=patient_code)
-                )
-                patient_id = res.first()[0]
-
-                # Парсим raw_data в отдельные поля
-                # Frontend sends: stool_count, pads_used, urgency ('Yes'/'No'), 
-                # night_stools ('Yes'/'No'), leakage ('None'/'Liquid'/'Solid'),
-                # incomplete_evacuation ('Yes'/'No'), bloating (double), 
-                # impact_score (double), activity_interfere (double)
-                raw = payload.raw_data or {}
-                stool_count = raw.get("stool_count", 0)
-                pads_used = raw.get("pads_used", 0)
-                urgency = raw.get("urgency", "No")
-                night_stools = raw.get("night_stools", "No")
-                leakage = raw.get("leakage", "None")
-                # Validate leakage value matches frontend options
-                if leakage not in ("None", "Liquid", "Solid"):
-                    print(f"Warning: Invalid leakage value '{leakage}', defaulting to 'None'")
-                    leakage = "None"
-                incomplete_evacuation = raw.get("incomplete_evacuation", "No")
-                bloating = raw.get("bloating", 0.0)
-                impact_score = raw.get("impact_score", 0.0)
-                activity_interfere = raw.get("activity_interfere", 0.0)
-                
-                # Парсим food_consumption Map в отдельные колонки
-                # Frontend sends keys: 'vegetables_all_types', 'root_vegetables', 
-                # 'whole_grains', 'whole_grain_bread', 'nuts_and_seeds', 'legumes',
-                # 'fruits_with_skin', 'berries_any', 'soft_fruits_without_skin', 
-                # 'muesli_and_bran_cereals'
-                food = payload.food_consumption or {}
-                food_vegetables_all = food.get("vegetables_all_types", 0)
-                food_root_vegetables = food.get("root_vegetables", 0)
-                food_whole_grains = food.get("whole_grains", 0)
-                food_whole_grain_bread = food.get("whole_grain_bread", 0)
-                food_nuts_and_seeds = food.get("nuts_and_seeds", 0)
-                food_legumes = food.get("legumes", 0)
-                food_fruits_with_skin = food.get("fruits_with_skin", 0)
-                food_berries = food.get("berries_any", 0)
-                food_soft_fruits_no_skin = food.get("soft_fruits_without_skin", 0)
-                food_muesli_and_bran = food.get("muesli_and_bran_cereals", 0)
-                
-                # Парсим drink_consumption Map в отдельные колонки
-                # Frontend sends keys: 'water', 'coffee', 'tea', 'alcohol',
-                # 'carbonated_drinks', 'juices', 'dairy_drinks', 'energy_drinks'
-                drink = payload.drink_consumption or {}
-                drink_water = drink.get("water", 0)
-                drink_coffee = drink.get("coffee", 0)
-                drink_tea = drink.get("tea", 0)
-                drink_alcohol = drink.get("alcohol", 0)
-                drink_carbonated = drink.get("carbonated_drinks", 0)
-                drink_juices = drink.get("juices", 0)
-                drink_dairy = drink.get("dairy_drinks", 0)
-                drink_energy = drink.get("energy_drinks", 0)
-                
-                res2 = await session.execute(
-                    text("""
-                        INSERT INTO daily_entries (
-                            patient_id, entry_date, bristol_scale,
-                            stool_count, pads_used, urgency, night_stools, leakage,
-                            incomplete_evacuation, bloating, impact_score, activity_interfere,
-                            food_vegetables_all, food_root_vegetables, food_whole_grains,
-                            food_whole_grain_bread, food_nuts_and_seeds, food_legumes,
-                            food_fruits_with_skin, food_berries, food_soft_fruits_no_skin,
-                            food_muesli_and_bran,
-                            drink_water, drink_coffee, drink_tea, drink_alcohol,
-                            drink_carbonated, drink_juices, drink_dairy, drink_energy
-                        ) VALUES (
-                            :patient_id,
-                            COALESCE(CAST(:entry_date AS DATE), CURRENT_DATE),
-                            :bristol_scale,
-                            :stool_count, :pads_used, :urgency, :night_stools, :leakage,
-                            :incomplete_evacuation, :bloating, :impact_score, :activity_interfere,
-                            :food_vegetables_all, :food_root_vegetables, :food_whole_grains,
-                            :food_whole_grain_bread, :food_nuts_and_seeds, :food_legumes,
-                            :food_fruits_with_skin, :food_berries, :food_soft_fruits_no_skin,
-                            :food_muesli_and_bran,
-                            :drink_water, :drink_coffee, :drink_tea, :drink_alcohol,
-                            :drink_carbonated, :drink_juices, :drink_dairy, :drink_energy
-                        )
-                        ON CONFLICT (patient_id, entry_date) DO UPDATE SET
-                            bristol_scale = EXCLUDED.bristol_scale,
-                            stool_count = EXCLUDED.stool_count,
-                            pads_used = EXCLUDED.pads_used,
-                            urgency = EXCLUDED.urgency,
-                            night_stools = EXCLUDED.night_stools,
-                            leakage = EXCLUDED.leakage,
-                            incomplete_evacuation = EXCLUDED.incomplete_evacuation,
-                            bloating = EXCLUDED.bloating,
-                            impact_score = EXCLUDED.impact_score,
-                            activity_interfere = EXCLUDED.activity_interfere,
-                            food_vegetables_all = EXCLUDED.food_vegetables_all,
-                            food_root_vegetables = EXCLUDED.food_root_vegetables,
-                            food_whole_grains = EXCLUDED.food_whole_grains,
-                            food_whole_grain_bread = EXCLUDED.food_whole_grain_bread,
-                            food_nuts_and_seeds = EXCLUDED.food_nuts_and_seeds,
-                            food_legumes = EXCLUDED.food_legumes,
-                            food_fruits_with_skin = EXCLUDED.food_fruits_with_skin,
-                            food_berries = EXCLUDED.food_berries,
-                            food_soft_fruits_no_skin = EXCLUDED.food_soft_fruits_no_skin,
-                            food_muesli_and_bran = EXCLUDED.food_muesli_and_bran,
-                            drink_water = EXCLUDED.drink_water,
-                            drink_coffee = EXCLUDED.drink_coffee,
-                            drink_tea = EXCLUDED.drink_tea,
-                            drink_alcohol = EXCLUDED.drink_alcohol,
-                            drink_carbonated = EXCLUDED.drink_carbonated,
-                            drink_juices = EXCLUDED.drink_juices,
-                            drink_dairy = EXCLUDED.drink_dairy,
-                            drink_energy = EXCLUDED.drink_energy
-                        RETURNING id
-                    """)
-                    .bindparams(
-                        patient_id=patient_id,
-                        entry_date=payload.entry_date,
-                        bristol_scale=payload.bristol_scale,
-                        stool_count=stool_count,
-                        pads_used=pads_used,
-                        urgency=urgency,
-                        night_stools=night_stools,
-                        leakage=leakage,
-                        incomplete_evacuation=incomplete_evacuation,
-                        bloating=bloating,
-                        impact_score=impact_score,
-                        activity_interfere=activity_interfere,
-                        food_vegetables_all=food_vegetables_all,
-                        food_root_vegetables=food_root_vegetables,
-                        food_whole_grains=food_whole_grains,
-                        food_whole_grain_bread=food_whole_grain_bread,
-                        food_nuts_and_seeds=food_nuts_and_seeds,
-                        food_legumes=food_legumes,
-                        food_fruits_with_skin=food_fruits_with_skin,
-                        food_berries=food_berries,
-                        food_soft_fruits_no_skin=food_soft_fruits_no_skin,
-                        food_muesli_and_bran=food_muesli_and_bran,
-                        drink_water=drink_water,
-                        drink_coffee=drink_coffee,
-                        drink_tea=drink_tea,
-                        drink_alcohol=drink_alcohol,
-                        drink_carbonated=drink_carbonated,
-                        drink_juices=drink_juices,
-                        drink_dairy=drink_dairy,
-                        drink_energy=drink_energy,
+        # Парсим raw_data в отдельные поля
+        # Frontend sends: stool_count, pads_used, urgency ('Yes'/'No'), 
+        # night_stools ('Yes'/'No'), leakage ('None'/'Liquid'/'Solid'),
+        # incomplete_evacuation ('Yes'/'No'), bloating (double), 
+        # impact_score (double), activity_interfere (double)
+        raw = payload.raw_data or {}
+        leakage = raw.get("leakage", "None")
+        # Validate leakage value matches frontend options
+        if leakage not in ("None", "Liquid", "Solid"):
+            print(f"Warning: Invalid leakage value '{leakage}', defaulting to 'None'")
+            leakage = "None"
+        entry = {
+            "entry_date": payload.entry_date,
+            "bristol_scale": payload.bristol_scale,
+            "stool_count": raw.get("stool_count", 0),
+            "pads_used": raw.get("pads_used", 0),
+            "urgency": raw.get("urgency", "No"),
+            "night_stools": raw.get("night_stools", "No"),
+            "leakage": leakage,
+            "incomplete_evacuation": raw.get("incomplete_evacuation", "No"),
+            "bloating": raw.get("bloating", 0.0),
+            "impact_score": raw.get("impact_score", 0.0),
+            "activity_interfere": raw.get("activity_interfere", 0.0),
+        }
+
+        # Парсим food_consumption Map в отдельные колонки
+        # Frontend sends keys: 'vegetables_all_types', 'root_vegetables', 
+        # 'whole_grains', 'whole_grain_bread', 'nuts_and_seeds', 'legumes',
+        # 'fruits_with_skin', 'berries_any', 'soft_fruits_without_skin', 
+        # 'muesli_and_bran_cereals'
+        food = payload.food_consumption or {}
+        entry["food_vegetables_all"] = food.get("vegetables_all_types", 0)
+        entry["food_root_vegetables"] = food.get("root_vegetables", 0)
+        entry["food_whole_grains"] = food.get("whole_grains", 0)
+        entry["food_whole_grain_bread"] = food.get("whole_grain_bread", 0)
+        entry["food_nuts_and_seeds"] = food.get("nuts_and_seeds", 0)
+        entry["food_legumes"] = food.get("legumes", 0)
+        entry["food_fruits_with_skin"] = food.get("fruits_with_skin", 0)
+        entry["food_berries"] = food.get("berries_any", 0)
+        entry["food_soft_fruits_no_skin"] = food.get("soft_fruits_without_skin", 0)
+        entry["food_muesli_and_bran"] = food.get("muesli_and_bran_cereals", 0)
+
+        # Парсим drink_consumption Map в отдельные колонки
+        # Frontend sends keys: 'water', 'coffee', 'tea', 'alcohol',
+        # 'carbonated_drinks', 'juices', 'dairy_drinks', 'energy_drinks'
+        drink = payload.drink_consumption or {}
+        entry["drink_water"] = drink.get("water", 0)
+        entry["drink_coffee"] = drink.get("coffee", 0)
+        entry["drink_tea"] = drink.get("tea", 0)
+        entry["drink_alcohol"] = drink.get("alcohol", 0)
+        entry["drink_carbonated"] = drink.get("carbonated_drinks", 0)
+        entry["drink_juices"] = drink.get("juices", 0)
+        entry["drink_dairy"] = drink.get("dairy_drinks", 0)
+        entry["drink_energy"] = drink.get("energy_drinks", 0)
+
+        if INTAKE_AMOUNT_LIMIT is not None:
+            for column in intake_analysis.INTAKE_COLUMNS:
+                amount = entry[column]
+                if (not isinstance(amount, int) or isinstance(amount, bool)
+                        or not 0 <= amount <= INTAKE_AMOUNT_LIMIT):
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Invalid {column}. Must be an integer between 0 and {INTAKE_AMOUNT_LIMIT}",
                     )
-                )
-                row2 = res2.first()
-        return {"status": "ok", "id": str(row2[0])}
+
+        entry_id = await repo.upsert_daily(patient_code, entry)
+        daily_trends_cache.invalidate(patient_code)
+        intake_analysis_cache.invalidate(patient_code)
+        read_flights.forget(patient_code)
+        return {"status": "ok", "id": entry_id}
+    except HTTPException:
+        raise
     except Exception as e:
         error_msg = str(e)
         error_type = type(e).__name__
@@ -399,71 +523,25 @@ async def send_monthly(payload: MonthlyPayload, x_patient_code: Optional[str] =
     if not patient_code or len(patient_code) < 4 or len(patient_code) > 64:
         raise HTTPException(status_code=400, detail="Invalid patient code format")
 
-    if not async_session:
+    if not repo:
         raise HTTPException(status_code=503, detail="Database not configured")
     
     try:
-        async with async_session() as session:
-            async with session.begin():
-                res = await session.execute(
-                    text("""
-                        INSERT INTO patients (patient_code)
-                        VALUES (:code)
-                        ON CONFLICT (patient_code) DO UPDATE SET patient_code = EXCLUDED.patient_code
-                        RETURNING id
-                    """).bindparams(code=patient_code)
-                )
-                patient_id = res.first()[0]
-
-                # Парсим raw_data в отдельные поля
-                raw = payload.raw_data or {}
-                avoid_travel = raw.get("avoid_travel", 1.0)
-                avoid_social = raw.get("avoid_social", 1.0)
-                embarrassed = raw.get("embarrassed", 1.0)
-                worry_notice = raw.get("worry_notice", 1.0)
-                depressed = raw.get("depressed", 1.0)
-                control = raw.get("control", 0.0)
-                satisfaction = raw.get("satisfaction", 0.0)
-                
-                res2 = await session.execute(
-                    text("""
-                        INSERT INTO monthly_entries (
-                            patient_id, entry_date, qol_score,
-                            avoid_travel, avoid_social, embarrassed, worry_notice,
-                            depressed, control, satisfaction
-                        ) VALUES (
-                            :patient_id,
-                            COALESCE(CAST(:entry_date AS DATE), CURRENT_DATE),
-                            :qol_score,
-                            :avoid_travel, :avoid_social, :embarrassed, :worry_notice,
-                            :depressed, :control, :satisfaction
-                        )
-                        ON CONFLICT (patient_id, entry_date) DO UPDATE SET
-                            qol_score = EXCLUDED.qol_score,
-                            avoid_travel = EXCLUDED.avoid_travel,
-                            avoid_social = EXCLUDED.avoid_social,
-                            embarrassed = EXCLUDED.embarrassed,
-                            worry_notice = EXCLUDED.worry_notice,
-                            depressed = EXCLUDED.depressed,
-                            control = EXCLUDED.control,
-                            satisfaction = EXCLUDED.satisfaction
-                        RETURNING id
-                    """)
-                    .bindparams(
-                        patient_id=patient_id,
-                        entry_date=payload.entry_date,
-                        qol_score=payload.qol_score,
-                        avoid_travel=avoid_travel,
-                        avoid_social=avoid_social,
-                        embarrassed=embarrassed,
-                        worry_notice=worry_notice,
-                        depressed=depressed,
-                        control=control,
-                        satisfaction=satisfaction,
-                    )
-                )
-                row2 = res2.first()
-        return {"status": "ok", "id": str(row2[0])}
+        # Парсим raw_data в отдельные поля
+        raw = payload.raw_data or {}
+        entry_id = await repo.upsert_monthly(patient_code, {
+            "entry_date": payload.entry_date,
+            "qol_score": payload.qol_score,
+            "avoid_travel": raw.get("avoid_travel", 1.0),
+            "avoid_social": raw.get("avoid_social", 1.0),
+            "embarrassed": raw.get("embarrassed", 1.0),
+            "worry_notice": raw.get("worry_notice", 1.0),
+            "depressed": raw.get("depressed", 1.0),
+            "control": raw.get("control", 0.0),
+            "satisfaction": raw.get("satisfaction", 0.0),
+        })
+        read_flights.forget(patient_code)
+        return {"status": "ok", "id": entry_id}
     except Exception as e:
         error_msg = str(e)
         error_type = type(e).__name__
@@ -483,66 +561,31 @@ async def send_eq5d5l(payload: Eq5d5lPayload, x_patient_code: Optional[str] = He
     if not patient_code or len(patient_code) < 4 or len(patient_code) > 64:
         raise HTTPException(status_code=400, detail="Invalid patient code format")
 
-    if not async_session:
+    if not repo:
         raise HTTPException(status_code=503, detail="Database not configured")
     
     try:
-        async with async_session() as session:
-            async with session.begin():
-                res = await session.execute(
-                    text("""
-                        INSERT INTO patients (patient_code)
-                        VALUES (:code)
-                        ON CONFLICT (patient_code) DO UPDATE SET patient_code = EXCLUDED.patient_code
-                        RETURNING id
-                    """).bindparams(code=patient_code)
-                )
-                patient_id = res.first()[0]
-
-                # Extract health VAS from payload or raw_data if provided
-                health_vas = payload.health_vas
-                if health_vas is None and payload.raw_data is not None:
-                    hv = payload.raw_data.get("health_vas")
-                    if isinstance(hv, (int, float)):
-                        try:
-                            health_vas = int(hv)
-                        except Exception:
-                            health_vas = None
-
-                res2 = await session.execute(
-                    text("""
-                        INSERT INTO eq5d5l_entries (
-                            patient_id, entry_date,
-                            mobility, self_care, usual_activities,
-                            pain_discomfort, anxiety_depression, health_vas
-                        ) VALUES (
-                            :patient_id,
-                            COALESCE(CAST(:entry_date AS DATE), CURRENT_DATE),
-                            :mobility, :self_care, :usual_activities,
-                            :pain_discomfort, :anxiety_depression, :health_vas
-                        )
-                        ON CONFLICT (patient_id, entry_date) DO UPDATE SET
-                            mobility = EXCLUDED.mobility,
-                            self_care = EXCLUDED.self_care,
-                            usual_activities = EXCLUDED.usual_activities,
-                            pain_discomfort = EXCLUDED.pain_discomfort,
-                            anxiety_depression = EXCLUDED.anxiety_depression,
-                            health_vas = EXCLUDED.health_vas
-                        RETURNING id
-                    """)
-                    .bindparams(
-                        patient_id=patient_id,
-                        entry_date=payload.entry_date,
-                        mobility=payload.mobility,
-                        self_care=payload.self_care,
-                        usual_activities=payload.usual_activities,
-                        pain_discomfort=payload.pain_discomfort,
-                        anxiety_depression=payload.anxiety_depression,
-                        health_vas=health_vas,
-                    )
-                )
-                row2 = res2.first()
-        return {"status": "ok", "id": str(row2[0])}
+        # Extract health VAS from payload or raw_data if provided
+        health_vas = payload.health_vas
+        if health_vas is None and payload.raw_data is not None:
+            hv = payload.raw_data.get("health_vas")
+            if isinstance(hv, (int, float)):
+                try:
+                    health_vas = int(hv)
+                except Exception:
+                    health_vas = None
+
+        entry_id = await repo.upsert_eq5d5l(patient_code, {
+            "entry_date": payload.entry_date,
+            "mobility": payload.mobility,
+            "self_care": payload.self_care,
+            "usual_activities": payload.usual_activities,
+            "pain_discomfort": payload.pain_discomfort,
+            "anxiety_depression": payload.anxiety_depression,
+            "health_vas": health_vas,
+        })
+        read_flights.forget(patient_code)
+        return {"status": "ok", "id": entry_id}
     except Exception as e:
         error_msg = str(e)
         error_type = type(e).__name__
@@ -554,76 +597,6 @@ async def send_eq5d5l(payload: Eq5d5lPayload, x_patient_code: Optional[str] = He
         )
 
 
-async def _execute_with_retry(session, query, max_retries=3, initial_delay=0.5):
-    """Execute query with retry logic for transient errors"""
-    last_error = None
-    for attempt in range(max_retries):
-        try:
-            result = await session.execute(query)
-            return result
-        except Exception as e:
-            error_str = str(e)
-            error_type = type(e).__name__
-            last_error = e
-            
-            # Identify different error types
-            is_pool_error = (
-                "MaxClientsInSessionMode" in error_str or 
-                "max clients reached" in error_str.lower() or
-                "pool" in error_str.lower() or
-                "connection" in error_str.lower() and "unavailable" in error_str.lower()
-            )
-            
-            is_timeout = (
-                error_type == "TimeoutError" or 
-                "timeout" in error_str.lower() or
-                "CancelledError" in error_type or
-                "asyncio.TimeoutError" in error_type
-            )
-            
-            is_connection_error = (
-                "connection" in error_str.lower() and (
-                    "closed" in error_str.lower() or
-                    "lost" in error_str.lower() or
-                    "reset" in error_str.lower()
-                )
-            )
-            
-            # Log the error
-            print(f"Database error on attempt {attempt + 1}/{max_retries}: {error_type}: {error_str[:200]}")
-            
-            # Retry on pool errors and connection errors (transient)
-            if (is_pool_error or is_connection_error) and attempt < max_retries - 1:
-                # Exponential backoff: 0.5s, 1s, 2s
-                delay = initial_delay * (2 ** attempt)
-                print(f"Retrying after {delay}s...")
-                await asyncio.sleep(delay)
-                continue
-            
-            # For timeouts, retry once more with longer delay
-            if is_timeout and attempt < max_retries - 1:
-                delay = initial_delay * (2 ** attempt) * 2  # Longer delay for timeouts
-                print(f"Timeout detected, retrying after {delay}s...")
-                await asyncio.sleep(delay)
-                continue
-            
-            # Don't retry on other errors (syntax errors, constraint violations, etc.)
-            if not (is_pool_error or is_timeout or is_connection_error):
-                print(f"Non-retryable error: {error_type}: {error_str[:200]}")
-                raise
-            
-            # If we're on the last attempt, raise the error
-            if attempt == max_retries - 1:
-                print(f"Max retries reached, failing with: {error_type}: {error_str[:200]}")
-                raise
-    
-    # This shouldn't be reached, but just in case - raise the last error
-    if last_error:
-        raise last_error
-    # If we somehow got here without an error, something is wrong
-    raise Exception("_execute_with_retry completed without result or error")
-
-
 @app.get("/getLarsData")
 async def get_lars_data(
     period: str,  # "weekly", "monthly", or "yearly"
@@ -640,7 +613,7 @@ async def get_lars_data(
     if not patient_code or len(patient_code) < 4 or len(patient_code) > 64:
         raise HTTPException(status_code=400, detail="Invalid patient code format")
 
-    if not async_session:
+    if not repo:
         raise HTTPException(status_code=503, detail="Database not configured")
     
     # Validate period
@@ -648,89 +621,34 @@ async def get_lars_data(
         raise HTTPException(status_code=400, detail="Invalid period. Must be 'weekly', 'monthly', or 'yearly'")
     
     try:
-        async with async_session() as session:
-            # Optimized: Get patient_id and data in ONE query using JOIN
-            if period == "weekly":
-                query = text("""
-                    SELECT 
-                        DATE_TRUNC('week', we.entry_date) as period_start,
-                        AVG(we.total_score)::INTEGER as avg_score,
-                        MIN(we.entry_date) as first_entry_date
-                    FROM weekly_entries we
-                    INNER JOIN patients p ON p.id = we.patient_id
-                    WHERE p.patient_code = :code
-                        AND we.total_score IS NOT NULL
-                    GROUP BY DATE_TRUNC('week', we.entry_date)
-                    ORDER BY period_start DESC
-                    LIMIT 5
-                """)
-            elif period == "monthly":
-                query = text("""
-                    SELECT 
-                        DATE_TRUNC('month', we.entry_date) as period_start,
-                        AVG(we.total_score)::INTEGER as avg_score,
-                        MIN(we.entry_date) as first_entry_date
-                    FROM weekly_entries we
-                    INNER JOIN patients p ON p.id = we.patient_id
-                    WHERE p.patient_code = :code
-                        AND we.total_score IS NOT NULL
-                        AND we.entry_date >= CURRENT_DATE - INTERVAL '6 months'
-                    GROUP BY DATE_TRUNC('month', we.entry_date)
-                    ORDER BY period_start ASC
-                """)
-            else:  # yearly
-                query = text("""
-                    SELECT 
-                        DATE_TRUNC('year', we.entry_date) as period_start,
-                        AVG(we.total_score)::INTEGER as avg_score,
-                        MIN(we.entry_date) as first_entry_date
-                    FROM weekly_entries we
-                    INNER JOIN patients p ON p.id = we.patient_id
-                    WHERE p.patient_code = :code
-                        AND we.total_score IS NOT NULL
-                        AND we.entry_date >= CURRENT_DATE - INTERVAL '5 years'
-                    GROUP BY DATE_TRUNC('year', we.entry_date)
-                    ORDER BY period_start ASC
-                """)
-            
-            # Execute with retry logic
-            try:
-                result = await _execute_with_retry(session, query.bindparams(code=patient_code))
-                if result is None:
-                    # This shouldn't happen with new retry logic, but keep for safety
-                    print("WARNING: _execute_with_retry returned None unexpectedly")
-                    return JSONResponse(
-                        status_code=503,
-                        content={"status": "error", "detail": "Database connection timeout, please try again"}
-                    )
-                rows = result.fetchall()
-            except Exception as query_error:
-                # If retry logic failed, log and return 503
-                error_msg = str(query_error)
-                error_type = type(query_error).__name__
-                print(f"Query execution failed after retries: {error_type}: {error_msg[:200]}")
-                return JSONResponse(
-                    status_code=503,
-                    content={
-                        "status": "error", 
-                        "detail": f"Database error: {error_type}. Please try again.",
-                        "error_type": error_type
-                    }
-                )
-            
-            # Reverse if ordered DESC to get chronological order
-            if period == "weekly" and rows:
-                rows = list(reversed(rows))
-            
-            data = []
-            for idx, row in enumerate(rows, start=1):
-                data.append({
-                    "index": idx,
-                    "date": row[2].isoformat() if row[2] else None,  # first_entry_date
-                    "score": row[1] if row[1] is not None else None  # avg_score
-                })
-            
-            return {"status": "ok", "data": data}
+        # Execute with retry logic
+        try:
+            rows = await read_flights.do(
+                "getLarsData", patient_code, (period,), lambda: repo.get_lars_series(patient_code, period)
+            )
+        except Exception as query_error:
+            # If retry logic failed, log and return 503
+            error_msg = str(query_error)
+            error_type = type(query_error).__name__
+            print(f"Query execution failed after retries: {error_type}: {error_msg[:200]}")
+            return JSONResponse(
+                status_code=503,
+                content={
+                    "status": "error", 
+                    "detail": f"Database error: {error_type}. Please try again.",
+                    "error_type": error_type
+                }
+            )
+        
+        data = []
+        for idx, (first_entry_date, avg_score) in enumerate(rows, start=1):
+            data.append({
+                "index": idx,
+                "date": first_entry_date.isoformat() if first_entry_date else None,
+                "score": avg_score if avg_score is not None else None
+            })
+        
+        return {"status": "ok", "data": data}
     except HTTPException:
         raise
     except Exception as e:
@@ -770,219 +688,140 @@ async def get_next_questionnaire(x_patient_code: Optional[str] = Header(None)):
     if not patient_code or len(patient_code) < 4 or len(patient_code) > 64:
         raise HTTPException(status_code=400, detail="Invalid patient code format")
 
-    if not async_session:
+    if not repo:
         raise HTTPException(status_code=503, detail="Database not configured")
     
     try:
-        from datetime import datetime, date, timedelta
+        from datetime import date, timedelta
         
-        async with async_session() as session:
-            today = date.today()
-            
-            # Optimized: Get all patient data and last completion dates in ONE query
-            # Use retry logic for connection pool issues
-            try:
-                patient_res = await _execute_with_retry(
-                    session,
-                    text("""
-                        SELECT 
-                            p.id,
-                            p.created_at::DATE as patient_created_date,
-                            (SELECT MAX(entry_date) FROM weekly_entries WHERE patient_id = p.id) as last_weekly_date,
-                            (SELECT MAX(entry_date) FROM monthly_entries WHERE patient_id = p.id) as last_monthly_date,
-                            (SELECT MAX(entry_date) FROM eq5d5l_entries WHERE patient_id = p.id) as last_eq5d5l_date,
-                            (SELECT MAX(entry_date) FROM daily_entries WHERE patient_id = p.id) as last_daily_date
-                        FROM patients p
-                        WHERE p.patient_code = :code
-                    """).bindparams(code=patient_code)
-                )
-                if patient_res is None:
-                    # This shouldn't happen with new retry logic, but keep for safety
-                    print("WARNING: _execute_with_retry returned None in getNextQuestionnaire")
-                    return {
-                        "status": "ok",
-                        "questionnaire_type": "daily",
-                        "is_today_filled": False,
-                        "reason": "Unable to determine questionnaire (database timeout)"
-                    }
-                patient_row = patient_res.first()
-            except Exception as query_error:
-                # If query failed after retries, return default response
-                error_msg = str(query_error)
-                error_type = type(query_error).__name__
-                print(f"Query execution failed in getNextQuestionnaire: {error_type}: {error_msg[:200]}")
-                return {
-                    "status": "ok",
-                    "questionnaire_type": "daily",
-                    "is_today_filled": False,
-                    "reason": f"Unable to determine questionnaire (database error: {error_type})"
-                }
-            
-            # If patient doesn't exist, suggest first questionnaire (weekly) - patient will be created when they submit
-            if not patient_row:
-                return {
-                    "status": "ok",
-                    "questionnaire_type": "weekly",
-                    "is_today_filled": False,
-                    "reason": "Welcome! Please start with your first weekly questionnaire (LARS)"
-                }
-            
-            patient_id = patient_row[0]
-            patient_created_date = patient_row[1] if patient_row[1] is not None else None
-            last_weekly_date = patient_row[2] if patient_row[2] is not None else None
-            last_monthly_date = patient_row[3] if patient_row[3] is not None else None
-            last_eq5d5l_date = patient_row[4] if patient_row[4] is not None else None
-            last_daily_date = patient_row[5] if patient_row[5] is not None else None
+        today = date.today()
+        
+        # Optimized: Get all patient data, last completion dates, EQ-5D-5L dates
+        # and today's entries in ONE query (retry logic for connection pool issues)
+        try:
+            state = await read_flights.do(
+                "getNextQuestionnaire", patient_code, (today,),
+                lambda: repo.get_questionnaire_state(patient_code, today),
+            )
+        except Exception as query_error:
+            # If query failed after retries, return default response
+            error_msg = str(query_error)
+            error_type = type(query_error).__name__
+            print(f"Query execution failed in getNextQuestionnaire: {error_type}: {error_msg[:200]}")
+            return {
+                "status": "ok",
+                "questionnaire_type": "daily",
+                "is_today_filled": False,
+                "reason": f"Unable to determine questionnaire (database error: {error_type})"
+            }
+        
+        # If patient doesn't exist, suggest first questionnaire (weekly) - patient will be created when they submit
+        if not state:
+            return {
+                "status": "ok",
+                "questionnaire_type": "weekly",
+                "is_today_filled": False,
+                "reason": "Welcome! Please start with your first weekly questionnaire (LARS)"
+            }
+        
+        patient_created_date = state.created_date
+        last_weekly_date = state.last_dates["weekly"]
+        last_monthly_date = state.last_dates["monthly"]
+        last_daily_date = state.last_dates["daily"]
+        
+        # Determine next questionnaire using priority logic
+        questionnaire_type = None
+        reason = None
+        
+        # Priority 1: EQ-5D-5L (quality of life) - scheduled milestones
+        if patient_created_date:
+            days_since_start = (today - patient_created_date).days
             
-            # Determine next questionnaire using priority logic
-            questionnaire_type = None
-            reason = None
+            # Build list of milestone dates to check
+            milestones_to_check = []
+            for milestone_days in EQ5D5L_MILESTONES:
+                milestone_date = patient_created_date + timedelta(days=milestone_days)
+                # Only consider milestones that are due (within 3 days before to 7 days after)
+                if (today >= milestone_date - timedelta(days=EQ5D5L_WINDOW_BEFORE_DAYS)
+                        and days_since_start >= milestone_days - EQ5D5L_WINDOW_BEFORE_DAYS):
+                    milestones_to_check.append((milestone_days, milestone_date))
             
-            # Priority 1: EQ-5D-5L (quality of life) - scheduled milestones
-            # Optimized: Check all milestones in one query
-            if patient_created_date:
-                days_since_start = (today - patient_created_date).days
-                eq5d5l_milestones = [14, 30, 90, 180, 365]  # 2 weeks, 1 month, 3 months, 6 months, 12 months
-                
-                # Build list of milestone dates to check
-                milestones_to_check = []
-                for milestone_days in eq5d5l_milestones:
-                    milestone_date = patient_created_date + timedelta(days=milestone_days)
-                    # Only consider milestones that are due (within 3 days before to 7 days after)
-                    if today >= milestone_date - timedelta(days=3) and days_since_start >= milestone_days - 3:
-                        milestones_to_check.append((milestone_days, milestone_date))
+            # Check all milestones against the patient's EQ-5D-5L dates
+            for milestone_days, milestone_date in milestones_to_check:
+                window_start = milestone_date - timedelta(days=EQ5D5L_WINDOW_BEFORE_DAYS)
+                window_end = milestone_date + timedelta(days=EQ5D5L_WINDOW_AFTER_DAYS)
+                milestone_filled = any(
+                    window_start <= filled_date <= window_end 
+                    for filled_date in state.eq5d5l_dates
+                )
                 
-                # Check all milestones in one query if there are any to check
-                if milestones_to_check:
-                    # Build date ranges for all milestones
-                    date_ranges = []
-                    for milestone_days, milestone_date in milestones_to_check:
-                        window_start = milestone_date - timedelta(days=3)
-                        window_end = milestone_date + timedelta(days=7)
-                        date_ranges.append((milestone_days, milestone_date, window_start, window_end))
-                    
-                    # Get all eq5d5l entries in the relevant date range
-                    if date_ranges:
-                        min_date = min(range_item[2] for range_item in date_ranges)
-                        max_date = max(range_item[3] for range_item in date_ranges)
-                        
-                        check_res = await _execute_with_retry(
-                            session,
-                            text("""
-                                SELECT entry_date
-                                FROM eq5d5l_entries
-                                WHERE patient_id = :patient_id
-                                    AND entry_date >= :min_date
-                                    AND entry_date <= :max_date
-                            """).bindparams(
-                                patient_id=patient_id,
-                                min_date=min_date,
-                                max_date=max_date
-                            )
-                        )
-                        if check_res is None:
-                            # Skip milestone check if pool exhausted
-                            filled_dates = set()
-                        else:
-                            filled_dates = {row[0] for row in check_res.fetchall()}
-                        
-                        # Find first unfilled milestone
-                        for milestone_days, milestone_date, window_start, window_end in date_ranges:
-                            milestone_filled = any(
-                                window_start <= filled_date <= window_end 
-                                for filled_date in filled_dates
-                            )
-                            
-                            if not milestone_filled:
-                                questionnaire_type = "eq5d5l"
-                                reason = f"EQ-5D-5L milestone at {milestone_days} days ({'due' if days_since_start >= milestone_days else 'upcoming'})"
-                                break  # Found next uncompleted milestone, stop checking
-            
-            # Priority 2: Weekly (LARS) - once per week
-            if not questionnaire_type:
-                if last_weekly_date:
-                    days_since_weekly = (today - last_weekly_date).days
-                    if days_since_weekly >= 7:
-                        questionnaire_type = "weekly"
-                        reason = "Weekly questionnaire due (7 days passed)"
-                else:
-                    # Never filled weekly - make it due
+                if not milestone_filled:
+                    questionnaire_type = "eq5d5l"
+                    reason = f"EQ-5D-5L milestone at {milestone_days} days ({'due' if days_since_start >= milestone_days else 'upcoming'})"
+                    break  # Found next uncompleted milestone, stop checking
+        
+        # Priority 2: Weekly (LARS) - once per week
+        if not questionnaire_type:
+            if last_weekly_date:
+                days_since_weekly = (today - last_weekly_date).days
+                if days_since_weekly >= 7:
                     questionnaire_type = "weekly"
-                    reason = "First weekly questionnaire"
-            
-            # Priority 3: Monthly - once per month, but avoid same day as weekly
-            if not questionnaire_type:
-                if last_monthly_date:
-                    days_since_monthly = (today - last_monthly_date).days
-                    if days_since_monthly >= 28:  # ~4 weeks, slightly less than 30 to allow flexibility
-                        # Check if weekly is also due today - if so, weekly has priority
-                        weekly_due_today = False
-                        if last_weekly_date:
-                            days_since_weekly = (today - last_weekly_date).days
-                            if days_since_weekly >= 7:
-                                weekly_due_today = True
-                        
-                        if not weekly_due_today:
-                            # Weekly is not due today, so monthly can be shown
-                            questionnaire_type = "monthly"
-                            reason = "Monthly questionnaire due (28+ days passed)"
-                        # If weekly is also due, it will take priority (already checked above)
-                else:
-                    # Never filled monthly - but check if we should prioritize weekly first
-                    weekly_due = False
+                    reason = "Weekly questionnaire due (7 days passed)"
+            else:
+                # Never filled weekly - make it due
+                questionnaire_type = "weekly"
+                reason = "First weekly questionnaire"
+        
+        # Priority 3: Monthly - once per month, but avoid same day as weekly
+        if not questionnaire_type:
+            if last_monthly_date:
+                days_since_monthly = (today - last_monthly_date).days
+                if days_since_monthly >= 28:  # ~4 weeks, slightly less than 30 to allow flexibility
+                    # Check if weekly is also due today - if so, weekly has priority
+                    weekly_due_today = False
                     if last_weekly_date:
                         days_since_weekly = (today - last_weekly_date).days
                         if days_since_weekly >= 7:
-                            weekly_due = True
+                            weekly_due_today = True
                     
-                    if not weekly_due:
-                        # Weekly is not due, can show monthly
+                    if not weekly_due_today:
+                        # Weekly is not due today, so monthly can be shown
                         questionnaire_type = "monthly"
-                        reason = "First monthly questionnaire"
-                    # If weekly is due, it will take priority (already checked above)
-            
-            # Priority 4: Daily - if no mandatory questionnaires are due
-            if not questionnaire_type:
-                if last_daily_date:
-                    if (today - last_daily_date).days >= 1:
-                        questionnaire_type = "daily"
-                        reason = "Daily questionnaire available"
-                else:
+                        reason = "Monthly questionnaire due (28+ days passed)"
+                    # If weekly is also due, it will take priority (already checked above)
+            else:
+                # Never filled monthly - but check if we should prioritize weekly first
+                weekly_due = False
+                if last_weekly_date:
+                    days_since_weekly = (today - last_weekly_date).days
+                    if days_since_weekly >= 7:
+                        weekly_due = True
+                
+                if not weekly_due:
+                    # Weekly is not due, can show monthly
+                    questionnaire_type = "monthly"
+                    reason = "First monthly questionnaire"
+                # If weekly is due, it will take priority (already checked above)
+        
+        # Priority 4: Daily - if no mandatory questionnaires are due
+        if not questionnaire_type:
+            if last_daily_date:
+                if (today - last_daily_date).days >= 1:
                     questionnaire_type = "daily"
-                    reason = "First daily questionnaire"
-            
-            # Check if today's questionnaire is already filled
-            # Optimized: Check in one query using UNION
-            is_today_filled = False
-            if questionnaire_type:
-                try:
-                    table_map = {
-                        "weekly": "weekly_entries",
-                        "monthly": "monthly_entries",
-                        "eq5d5l": "eq5d5l_entries",
-                        "daily": "daily_entries"
-                    }
-                    table_name = table_map.get(questionnaire_type)
-                    if table_name:
-                        check = await _execute_with_retry(
-                            session,
-                            text(f"SELECT COUNT(*) FROM {table_name} WHERE patient_id = :pid AND entry_date = :today")
-                            .bindparams(pid=patient_id, today=today)
-                        )
-                        if check is not None:
-                            check_row = check.first()
-                            is_today_filled = check_row[0] > 0 if check_row else False
-                except Exception as check_error:
-                    # If check fails, assume not filled
-                    print(f"Warning: Failed to check if today's questionnaire is filled: {check_error}")
-                    is_today_filled = False
-            
-            return {
-                "status": "ok",
-                "questionnaire_type": questionnaire_type,
-                "is_today_filled": is_today_filled,
-                "reason": reason
-            }
+                    reason = "Daily questionnaire available"
+            else:
+                questionnaire_type = "daily"
+                reason = "First daily questionnaire"
+        
+        # Check if today's questionnaire is already filled
+        is_today_filled = questionnaire_type in state.filled_today if questionnaire_type else False
+        
+        return {
+            "status": "ok",
+            "questionnaire_type": questionnaire_type,
+            "is_today_filled": is_today_filled,
+            "reason": reason
+        }
     except HTTPException:
         raise
     except Exception as e:
@@ -995,3 +834,345 @@ async def get_next_questionnaire(x_patient_code: Optional[str] = Header(None)):
             content={"status": "error", "detail": error_msg, "error_type": error_type}
         )
 
+
+@app.get("/getDailyTrends")
+async def get_daily_trends(
+    days: int = 365,
+    x_patient_code: Optional[str] = Header(None)
+):
+    """
+    Get 7- and 28-day rolling means and counts of daily diary metrics
+    (stool_count, pads_used, bloating, impact_score, activity_interfere, bristol_scale).
+    Returns one data point per filled day within the last `days` days.
+    Computed in ONE query with window functions; cached per patient (in this process)
+    until next sendDaily.
+    """
+    if not x_patient_code:
+        raise HTTPException(status_code=400, detail="Missing X-Patient-Code header")
+    patient_code = x_patient_code.strip().upper()
+    if not patient_code or len(patient_code) < 4 or len(patient_code) > 64:
+        raise HTTPException(status_code=400, detail="Invalid patient code format")
+
+    if not repo:
+        raise HTTPException(status_code=503, detail="Database not configured")
+
+    if days < 1 or days > 730:
+        raise HTTPException(status_code=400, detail="Invalid days. Must be between 1 and 730")
+
+    from datetime import date, timedelta
+
+    today = date.today()
+    since = today - timedelta(days=days - 1)
+    cached = daily_trends_cache.get(patient_code, "trends")
+    if cached is not None:
+        cached_day, cached_days, points = cached
+        if cached_day == today and cached_days >= days:
+            # Окна считаются с запасом до since, поэтому хвост длинного ряда совпадает с коротким рядом
+            first = since.isoformat()
+            tail = [point for point in points if point["date"] >= first]
+            return {"status": "ok", "data": [dict(point, index=idx) for idx, point in enumerate(tail, start=1)]}
+
+    generation = daily_trends_cache.generation()
+    try:
+        try:
+            rows = await read_flights.do(
+                "getDailyTrends", patient_code, (since,), lambda: repo.get_daily_trends(patient_code, since)
+            )
+        except Exception as query_error:
+            error_msg = str(query_error)
+            error_type = type(query_error).__name__
+            print(f"Query execution failed in getDailyTrends: {error_type}: {error_msg[:200]}")
+            return JSONResponse(
+                status_code=503,
+                content={
+                    "status": "error",
+                    "detail": f"Database error: {error_type}. Please try again.",
+                    "error_type": error_type
+                }
+            )
+
+        data = []
+        for idx, row in enumerate(rows, start=1):
+            trend_metrics = {}
+            for metric in DAILY_TREND_METRICS:
+                trend_metrics[metric] = {}
+                for window in DAILY_TREND_WINDOWS:
+                    mean = row[f"{metric}_mean_{window}"]
+                    trend_metrics[metric][f"mean_{window}"] = round(float(mean), 2) if mean is not None else None
+                    trend_metrics[metric][f"count_{window}"] = row[f"{metric}_count_{window}"]
+            data.append({
+                "index": idx,
+                "date": row["entry_date"].isoformat(),
+                "metrics": trend_metrics,
+            })
+
+        daily_trends_cache.put(patient_code, "trends", (today, days, data), generation)
+        return {"status": "ok", "data": data}
+    except HTTPException:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        error_type = type(e).__name__
+        print(f"Error in getDailyTrends: {error_type}: {error_msg}")
+        traceback.print_exc()
+        return JSONResponse(
+            status_code=500,
+            content={"status": "error", "detail": error_msg, "error_type": error_type}
+        )
+
+
+@app.get("/getFoodSymptomAssociations")
+async def get_food_symptom_associations(
+    cohort: bool = False,
+    token: Optional[str] = None,
+    x_patient_code: Optional[str] = Header(None),
+    authorization: Optional[str] = Header(None),
+):
+    """
+    Correlations between food/drink intake and stool_count, leakage, urgency, bloating,
+    same-day and next-day, for the patient from X-Patient-Code or (cohort=true) for all patients.
+    Cached until the next sendDaily of that patient; the cohort result for COHORT_CACHE_TTL_SECONDS.
+    Cohort auth: Authorization: Bearer <COHORT_ANALYSIS_TOKEN> or ?token=.
+    """
+    if cohort:
+        if not COHORT_ANALYSIS_TOKEN:
+            raise HTTPException(status_code=503, detail="Cohort analysis not configured")
+        bearer = authorization[7:].strip() if authorization and authorization.lower().startswith("bearer ") else None
+        if (bearer or token) != COHORT_ANALYSIS_TOKEN:
+            raise HTTPException(status_code=401, detail="Invalid cohort analysis token")
+        cache_code = COHORT_CACHE_KEY
+        patient_code = None
+    else:
+        if not x_patient_code:
+            raise HTTPException(status_code=400, detail="Missing X-Patient-Code header")
+        patient_code = x_patient_code.strip().upper()
+        if not patient_code or len(patient_code) < 4 or len(patient_code) > 64:
+            raise HTTPException(status_code=400, detail="Invalid patient code format")
+        cache_code = patient_code
+
+    if not repo:
+        raise HTTPException(status_code=503, detail="Database not configured")
+
+    cached = intake_analysis_cache.get(cache_code, "associations")
+    if cached is not None:
+        computed_at, data = cached
+        if not cohort or time.monotonic() - computed_at < COHORT_CACHE_TTL_SECONDS:
+            return {"status": "ok", "data": data}
+
+    generation = intake_analysis_cache.generation()
+
+    async def compute():
+        matrix = await repo.get_intake_symptom_matrix(patient_code)
+        # NumPy-расчёт в отдельном потоке, чтобы не блокировать event loop на когорте
+        with tracing.span("intake_analysis.compute", days=matrix.intake.shape[0]):
+            return await asyncio.to_thread(intake_analysis.compute_associations, matrix)
+
+    try:
+        data = await read_flights.do("getFoodSymptomAssociations", cache_code, (), compute)
+        intake_analysis_cache.put(cache_code, "associations", (time.monotonic(), data), generation)
+        return {"status": "ok", "data": data}
+    except HTTPException:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        error_type = type(e).__name__
+        print(f"Error in getFoodSymptomAssociations: {error_type}: {error_msg}")
+        traceback.print_exc()
+        return JSONResponse(
+            status_code=500,
+            content={"status": "error", "detail": error_msg, "error_type": error_type}
+        )
+
+
+@app.get("/getEq5d5lData")
+async def get_eq5d5l_data(x_patient_code: Optional[str] = Header(None)):
+    """
+    Get EQ-5D-5L utility index and VAS for each milestone of the EQ-5D-5L schedule
+    (same milestones as getNextQuestionnaire). For every milestone the entry closest to
+    the milestone date within its fill window is used; missing milestones have null values.
+    Index values come from the value set configured via EQ5D5L_VALUE_SET.
+    """
+    if not x_patient_code:
+        raise HTTPException(status_code=400, detail="Missing X-Patient-Code header")
+    patient_code = x_patient_code.strip().upper()
+    if not patient_code or len(patient_code) < 4 or len(patient_code) > 64:
+        raise HTTPException(status_code=400, detail="Invalid patient code format")
+
+    if not repo:
+        raise HTTPException(status_code=503, detail="Database not configured")
+
+    try:
+        from datetime import timedelta
+
+        # Optimized: patient registration date and all entries in ONE query
+        try:
+            history = await read_flights.do(
+                "getEq5d5lData", patient_code, (), lambda: repo.get_eq5d5l_history(patient_code)
+            )
+        except Exception as query_error:
+            error_msg = str(query_error)
+            error_type = type(query_error).__name__
+            print(f"Query execution failed in getEq5d5lData: {error_type}: {error_msg[:200]}")
+            return JSONResponse(
+                status_code=503,
+                content={
+                    "status": "error",
+                    "detail": f"Database error: {error_type}. Please try again.",
+                    "error_type": error_type
+                }
+            )
+
+        if not history:
+            return {"status": "ok", "value_set": eq5d5l_scoring.DEFAULT_VALUE_SET, "data": []}
+
+        patient_created_date, entries = history
+        index_values = eq5d5l_scoring.score_many([entry[1:6] for entry in entries])
+
+        data = []
+        for idx, milestone_days in enumerate(EQ5D5L_MILESTONES, start=1):
+            milestone_date = patient_created_date + timedelta(days=milestone_days)
+            window_start = milestone_date - timedelta(days=EQ5D5L_WINDOW_BEFORE_DAYS)
+            window_end = milestone_date + timedelta(days=EQ5D5L_WINDOW_AFTER_DAYS)
+            best = None
+            for entry_pos, entry in enumerate(entries):
+                if window_start <= entry[0] <= window_end:
+                    distance = abs((entry[0] - milestone_date).days)
+                    if best is None or distance < best[0]:
+                        best = (distance, entry_pos)
+            point = {
+                "index": idx,
+                "milestone_days": milestone_days,
+                "milestone_date": milestone_date.isoformat(),
+                "date": None,
+                "health_state": None,
+                "index_value": None,
+                "health_vas": None,
+            }
+            if best is not None:
+                entry = entries[best[1]]
+                point["date"] = entry[0].isoformat()
+                point["health_state"] = eq5d5l_scoring.health_state(entry[1:6])
+                point["index_value"] = float(index_values[best[1]])
+                point["health_vas"] = entry[6]
+            data.append(point)
+
+        return {"status": "ok", "value_set": eq5d5l_scoring.DEFAULT_VALUE_SET, "data": data}
+    except HTTPException:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        error_type = type(e).__name__
+        print(f"Error in getEq5d5lData: {error_type}: {error_msg}")
+        traceback.print_exc()
+        return JSONResponse(
+            status_code=500,
+            content={"status": "error", "detail": error_msg, "error_type": error_type}
+        )
+
+
+@app.get("/changes")
+async def get_changes(
+    since: int = 0,
+    limit: Optional[int] = None,
+    x_patient_code: Optional[str] = Header(None)
+):
+    """
+    Delta sync: entries of all four questionnaires created or updated after `since`
+    (the cursor from the previous response; 0 = everything), oldest change first.
+    Each change is {kind, seq, entry}; entry has the columns of the table row (with
+    updated_at, without patient_id). Store `cursor` and pass it as `since` next time;
+    while has_more is true, request the next page right away. With since=0 the first
+    page also carries the diary days moved to the Parquet archive (seq 0, not counted
+    in limit). Served from the (patient_id, change_seq) indexes, so a sync with nothing
+    new reads no entry rows.
+    """
+    if not x_patient_code:
+        raise HTTPException(status_code=400, detail="Missing X-Patient-Code header")
+    patient_code = x_patient_code.strip().upper()
+    if not patient_code or len(patient_code) < 4 or len(patient_code) > 64:
+        raise HTTPException(status_code=400, detail="Invalid patient code format")
+
+    if not repo:
+        raise HTTPException(status_code=503, detail="Database not configured")
+
+    if since < 0:
+        raise HTTPException(status_code=400, detail="Invalid since. Must be a cursor from /changes or 0")
+    if limit is None:
+        limit = CHANGES_PAGE_LIMIT
+    if limit < 1 or limit > CHANGES_PAGE_LIMIT:
+        raise HTTPException(status_code=400, detail=f"Invalid limit. Must be between 1 and {CHANGES_PAGE_LIMIT}")
+
+    try:
+        try:
+            # Одна лишняя строка показывает, есть ли следующая страница
+            rows = await read_flights.do(
+                "changes", patient_code, (since, limit),
+                lambda: repo.get_changes(patient_code, since, limit + 1)
+            )
+        except Exception as query_error:
+            error_msg = str(query_error)
+            error_type = type(query_error).__name__
+            print(f"Query execution failed in changes: {error_type}: {error_msg[:200]}")
+            return JSONResponse(
+                status_code=503,
+                content={
+                    "status": "error",
+                    "detail": f"Database error: {error_type}. Please try again.",
+                    "error_type": error_type
+                }
+            )
+
+        # С since=0 впереди идут архивные дни (seq 0): они отдаются целиком и не входят в limit
+        archived = sum(1 for _, seq, _ in rows if seq == 0)
+        changes = [{"kind": kind, "seq": seq, "entry": entry} for kind, seq, entry in rows[:archived + limit]]
+        return {
+            "status": "ok",
+            "changes": changes,
+            "cursor": changes[-1]["seq"] if len(changes) > archived else since,
+            "has_more": len(rows) > archived + limit,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        error_type = type(e).__name__
+        print(f"Error in changes: {error_type}: {error_msg}")
+        traceback.print_exc()
+        return JSONResponse(
+            status_code=500,
+            content={"status": "error", "detail": error_msg, "error_type": error_type}
+        )
+
+
+@app.get("/events")
+async def get_events(
+    request: Request,
+    token: Optional[str] = None,
+    cursor: Optional[int] = None,
+    authorization: Optional[str] = Header(None),
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    Server-Sent Events feed of new submissions for clinician dashboards.
+    Events: "entry" with {seq, kind, patient_code, entry_id, entry_date};
+    "reset" when missed events cannot be replayed and the client should reload.
+    Auth: Authorization: Bearer <CHANGE_FEED_TOKEN> or ?token= (EventSource cannot set headers).
+    Resume: Last-Event-ID header (sent by EventSource on reconnect) or ?cursor=<seq>.
+    """
+    if not events.CHANGE_FEED_TOKEN or not repo:
+        raise HTTPException(status_code=503, detail="Change feed not configured")
+    bearer = authorization[7:].strip() if authorization and authorization.lower().startswith("bearer ") else None
+    if (bearer or token) != events.CHANGE_FEED_TOKEN:
+        raise HTTPException(status_code=401, detail="Invalid change feed token")
+
+    if last_event_id:
+        try:
+            cursor = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+
+    return StreamingResponse(
+        events.sse_stream(request, change_broadcaster, cursor),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
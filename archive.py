@@ -0,0 +1,235 @@
+"""Cold-storage tier for daily_entries: one compressed Parquet file per month.
+
+scripts/archive_daily.py moves diary rows older than the horizon out of
+Postgres into DAILY_ARCHIVE_DIR/daily_entries/YYYY-MM.parquet and records in
+_manifest.json that everything before `archived_before` may live in the
+archive. PostgresRepository consults the archive only when a read reaches
+before that date, and merges it with live rows; a live row wins over an
+archived one for the same (patient, entry_date), e.g. a late edit of an old
+day after archival.
+
+Files are sorted by (patient_code, entry_date) and written in row groups, so
+a per-patient read only decodes row groups whose patient_code statistics match.
+
+Needs the optional pyarrow package (requirements-archive.txt).
+"""
+import os
+import json
+import uuid
+from datetime import date, datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+import intake_analysis
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency
+    pa = None
+
+
+DAILY_ARCHIVE_DIR = os.getenv("DAILY_ARCHIVE_DIR", "")
+ARCHIVE_HORIZON_MONTHS = int(os.getenv("ARCHIVE_HORIZON_MONTHS", "12"))
+ROW_GROUP_SIZE = 64 * 1024
+
+
+def _daily_schema():
+    small = pa.int16()
+    numeric = pa.decimal128(5, 2)
+    fields = [
+        ("id", pa.string()),
+        ("patient_id", pa.string()),
+        ("patient_code", pa.string()),
+        ("entry_date", pa.date32()),
+        ("bristol_scale", small),
+        ("stool_count", small),
+        ("pads_used", small),
+        ("urgency", pa.string()),
+        ("night_stools", pa.string()),
+        ("leakage", pa.string()),
+        ("incomplete_evacuation", pa.string()),
+        ("bloating", numeric),
+        ("impact_score", numeric),
+        ("activity_interfere", numeric),
+    ]
+    fields += [(column, small) for column in intake_analysis.INTAKE_COLUMNS]
+    fields.append(("created_at", pa.timestamp("us", tz="UTC")))
+    return pa.schema(fields)
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(day: date, months: int) -> date:
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+class DailyArchive:
+    def __init__(self, root: str):
+        if pa is None:
+            raise RuntimeError("pyarrow is not installed (pip install -r requirements-archive.txt)")
+        self.path = Path(root) / "daily_entries"
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.schema = _daily_schema()
+        self.columns = tuple(self.schema.names)
+        self._manifest = {}
+        self._manifest_mtime = None
+
+    # ---------- manifest ----------
+
+    @property
+    def _manifest_path(self) -> Path:
+        return self.path / "_manifest.json"
+
+    def manifest(self) -> dict:
+        # Перечитываем, только если файл изменился (архивация идёт отдельным процессом)
+        try:
+            mtime = self._manifest_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        if mtime != self._manifest_mtime:
+            self._manifest = json.loads(self._manifest_path.read_text())
+            self._manifest_mtime = mtime
+        return self._manifest
+
+    @property
+    def archived_before(self) -> Optional[date]:
+        value = self.manifest().get("archived_before")
+        return date.fromisoformat(value) if value else None
+
+    def covers(self, since: Optional[date]) -> bool:
+        """True if rows on or after `since` (None = all rows) may be in the archive."""
+        archived_before = self.archived_before
+        return archived_before is not None and (since is None or since < archived_before)
+
+    def _write_manifest(self, manifest: dict):
+        tmp = self._manifest_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+        os.replace(tmp, self._manifest_path)
+
+    def set_archived_before(self, day: date, shard: Optional[str] = None):
+        manifest = dict(self.manifest())
+        changed = False
+        current = manifest.get("archived_before")
+        if current is None or date.fromisoformat(current) < day:
+            manifest["archived_before"] = day.isoformat()
+            changed = True
+        if shard is not None:
+            # Прогресс каждого шарда (scripts/archive_daily.py); читатели смотрят только на archived_before
+            shards = dict(manifest.get("shards", {}))
+            if shards.get(shard) is None or date.fromisoformat(shards[shard]) < day:
+                shards[shard] = day.isoformat()
+                manifest["shards"] = shards
+                changed = True
+        if changed:
+            self._write_manifest(manifest)
+
+    # ---------- files ----------
+
+    def month_path(self, month: date) -> Path:
+        return self.path / f"{month:%Y-%m}.parquet"
+
+    def _month_paths(self, since: Optional[date]) -> list:
+        paths = sorted(self.path.glob("????-??.parquet"))
+        if since is None:
+            return paths
+        first = f"{month_start(since):%Y-%m}.parquet"
+        return [path for path in paths if path.name >= first]
+
+    def _replace_file(self, path: Path, table: "pa.Table"):
+        table = table.sort_by([("patient_code", "ascending"), ("entry_date", "ascending")])
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        pq.write_table(table, tmp, compression="zstd", row_group_size=ROW_GROUP_SIZE)
+        os.replace(tmp, path)
+
+    def write_month(self, month: date, table: "pa.Table") -> int:
+        """Merge rows into the month file (new rows win per patient_code/date), atomically."""
+        path = self.month_path(month)
+        table = table.cast(self.schema)
+        if path.exists():
+            # Ключ - patient_code: после rebalance_shards.py у пациента на другом шарде другой patient_id
+            existing = pq.read_table(path, schema=self.schema)
+            new_keys = set(zip(table["patient_code"].to_pylist(), table["entry_date"].to_pylist()))
+            keep = [
+                key not in new_keys
+                for key in zip(existing["patient_code"].to_pylist(), existing["entry_date"].to_pylist())
+            ]
+            table = pa.concat_tables([existing.filter(pa.array(keep, type=pa.bool_())), table])
+        self._replace_file(path, table)
+        manifest = dict(self.manifest())
+        manifest.setdefault("months", {})[f"{month:%Y-%m}"] = {
+            "rows": table.num_rows,
+            "written_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        }
+        self._write_manifest(manifest)
+        return table.num_rows
+
+    def rehome(self, patient_ids: dict) -> int:
+        """Set patient_id of archived rows to the given {patient_code: patient_id} (after patients
+        moved to another shard); rewrites only month files that change. Returns rows changed."""
+        changed = 0
+        for path in self._month_paths(None):
+            table = pq.read_table(path, schema=self.schema)
+            codes = table["patient_code"].to_pylist()
+            old_ids = table["patient_id"].to_pylist()
+            new_ids = [patient_ids.get(code, old) for code, old in zip(codes, old_ids)]
+            month_changed = sum(new != old for new, old in zip(new_ids, old_ids))
+            if month_changed:
+                column = table.schema.get_field_index("patient_id")
+                self._replace_file(path, table.set_column(column, "patient_id", pa.array(new_ids, pa.string())))
+                changed += month_changed
+        return changed
+
+    def read(self, patient_code: Optional[str] = None, since: Optional[date] = None,
+             columns: Optional[tuple] = None) -> "pa.Table":
+        """Archived rows for one patient (or all), on or after `since`."""
+        columns = list(columns or self.columns)
+        read_columns = list(dict.fromkeys(columns + ["patient_code", "entry_date"]))
+        filters = []
+        if patient_code is not None:
+            filters.append(("patient_code", "=", patient_code))
+        if since is not None:
+            filters.append(("entry_date", ">=", since))
+        tables = [
+            pq.read_table(path, columns=read_columns, filters=filters or None, schema=self.schema)
+            for path in self._month_paths(since)
+        ]
+        if not tables:
+            return self.schema.empty_table().select(columns)
+        return pa.concat_tables(tables).select(columns)
+
+    def rows(self, patient_code: Optional[str] = None, since: Optional[date] = None,
+             columns: Optional[tuple] = None) -> list:
+        return self.read(patient_code, since, columns).to_pylist()
+
+    def last_entry_date(self, patient_code: str) -> Optional[date]:
+        # Месяцы с конца: первый файл, где пациент есть, даёт ответ
+        for path in reversed(self._month_paths(None)):
+            table = pq.read_table(path, columns=["entry_date"], filters=[("patient_code", "=", patient_code)])
+            if table.num_rows:
+                return pc.max(table["entry_date"]).as_py()
+        return None
+
+
+def create_archive() -> Optional[DailyArchive]:
+    """Archive for DAILY_ARCHIVE_DIR, or None if it is not set. Called at startup: a missing
+    pyarrow or an unreadable _manifest.json fails here, not on the first read of old rows."""
+    if not DAILY_ARCHIVE_DIR:
+        return None
+    if pa is None:
+        manifest_path = Path(DAILY_ARCHIVE_DIR) / "daily_entries" / "_manifest.json"
+        archived_before = json.loads(manifest_path.read_text()).get("archived_before") if manifest_path.exists() else None
+        detail = f"; diary rows before {archived_before} are only in the archive" if archived_before else ""
+        raise RuntimeError(
+            f"DAILY_ARCHIVE_DIR is set but pyarrow is not installed "
+            f"(pip install -r requirements-archive.txt){detail}"
+        )
+    daily_archive = DailyArchive(DAILY_ARCHIVE_DIR)
+    archived_before = daily_archive.archived_before
+    if archived_before is not None:
+        print(f"Daily archive: rows before {archived_before} are read from {daily_archive.path}")
+    return daily_archive
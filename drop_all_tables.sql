@@ -4,9 +4,15 @@
 -- Удаляем таблицы в правильном порядке (сначала дочерние, потом родительские)
 DROP TABLE IF EXISTS eq5d5l_entries CASCADE;
 DROP TABLE IF EXISTS monthly_entries CASCADE;
+-- Компактная раскладка дневника (migration_compact_daily_entries.sql): вместе с таблицей уходит представление daily_entries
+DROP TABLE IF EXISTS daily_entries_compact CASCADE;
+DROP TABLE IF EXISTS daily_entries_wide CASCADE;
 DROP TABLE IF EXISTS daily_entries CASCADE;
 DROP TABLE IF EXISTS weekly_entries CASCADE;
 DROP TABLE IF EXISTS patients CASCADE;
+DROP FUNCTION IF EXISTS daily_entries_write(), daily_yes_no(TEXT), daily_leakage_code(TEXT),
+    daily_intake_pack(SMALLINT[]), daily_intake_at(BYTEA, INTEGER);
+DROP SEQUENCE IF EXISTS entry_change_seq;
 
 -- Проверка: таблицы должны исчезнуть
 SELECT table_name 
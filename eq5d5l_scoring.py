@@ -0,0 +1,89 @@
+"""EQ-5D-5L utility index scoring.
+
+Every one of the 5^5 = 3125 health states is scored once per value set into a
+lookup table; scoring is then a single array index, so whole cohorts are
+scored with one vectorized lookup.
+
+Dimension levels are taken as stored in eq5d5l_entries, i.e. 0..4 (level 1..5
+in EQ-5D notation).
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+
+
+DIMENSIONS = ("mobility", "self_care", "usual_activities", "pain_discomfort", "anxiety_depression")
+
+# Расписание опросника: дни после регистрации пациента и окно заполнения вокруг каждой точки
+MILESTONES = [14, 30, 90, 180, 365]  # 2 weeks, 1 month, 3 months, 6 months, 12 months
+WINDOW_BEFORE_DAYS = 3
+WINDOW_AFTER_DAYS = 7
+
+# Декременты для уровней 2..5 каждого измерения (уровень 1 = 0), аддитивная модель:
+# index = 1 - сумма декрементов. Коэффициенты из опубликованных value set'ов EuroQol.
+VALUE_SETS = {
+    # Devlin et al. 2018, England
+    "england": {
+        "mobility": (0.058, 0.076, 0.207, 0.274),
+        "self_care": (0.050, 0.080, 0.164, 0.203),
+        "usual_activities": (0.050, 0.063, 0.162, 0.184),
+        "pain_discomfort": (0.063, 0.084, 0.276, 0.335),
+        "anxiety_depression": (0.078, 0.104, 0.285, 0.289),
+    },
+    # Pickard et al. 2019, United States
+    "us": {
+        "mobility": (0.096, 0.122, 0.237, 0.322),
+        "self_care": (0.089, 0.107, 0.220, 0.261),
+        "usual_activities": (0.068, 0.101, 0.255, 0.255),
+        "pain_discomfort": (0.060, 0.098, 0.318, 0.414),
+        "anxiety_depression": (0.057, 0.123, 0.299, 0.321),
+    },
+}
+
+DEFAULT_VALUE_SET = os.getenv("EQ5D5L_VALUE_SET", "england").lower()
+# Опечатка в EQ5D5L_VALUE_SET должна остановить запуск, а не давать 500 на каждом запросе
+if DEFAULT_VALUE_SET not in VALUE_SETS:
+    raise ValueError(
+        f"EQ5D5L_VALUE_SET must be one of {', '.join(sorted(VALUE_SETS))}, got {DEFAULT_VALUE_SET!r}"
+    )
+
+
+@lru_cache(maxsize=None)
+def lookup_table(value_set: str = DEFAULT_VALUE_SET) -> np.ndarray:
+    """Index values for all 3125 states, addressed by state_code()."""
+    if value_set not in VALUE_SETS:
+        raise ValueError(f"Unknown EQ-5D-5L value set '{value_set}'. Available: {', '.join(sorted(VALUE_SETS))}")
+    decrements = VALUE_SETS[value_set]
+    levels = np.indices((5,) * len(DIMENSIONS)).reshape(len(DIMENSIONS), -1)
+    table = np.ones(levels.shape[1])
+    for dim_pos, dimension in enumerate(DIMENSIONS):
+        table -= np.array((0.0,) + decrements[dimension])[levels[dim_pos]]
+    table = np.round(table, 3)
+    table.flags.writeable = False
+    return table
+
+
+def state_codes(levels) -> np.ndarray:
+    """Map rows of 0..4 levels (n, 5) in DIMENSIONS order to lookup table positions."""
+    levels = np.asarray(levels, dtype=np.int64).reshape(-1, len(DIMENSIONS))
+    if levels.size and (levels.min() < 0 or levels.max() > 4):
+        raise ValueError("EQ-5D-5L levels must be between 0 and 4")
+    return levels @ (5 ** np.arange(len(DIMENSIONS) - 1, -1, -1))
+
+
+def score_many(levels, value_set: str = DEFAULT_VALUE_SET) -> np.ndarray:
+    """Index values for an (n, 5) array of levels."""
+    return lookup_table(value_set)[state_codes(levels)]
+
+
+def score(mobility: int, self_care: int, usual_activities: int,
+          pain_discomfort: int, anxiety_depression: int,
+          value_set: str = DEFAULT_VALUE_SET) -> float:
+    levels = (mobility, self_care, usual_activities, pain_discomfort, anxiety_depression)
+    return float(score_many([levels], value_set)[0])
+
+
+def health_state(levels) -> str:
+    """5-digit EQ-5D health state, e.g. (0, 0, 1, 2, 0) -> "11231"."""
+    return "".join(str(int(level) + 1) for level in levels)
@@ -0,0 +1,181 @@
+"""Change feed for clinician dashboards: GET /events (Server-Sent Events).
+
+Writes announce themselves after commit: PostgresRepository runs pg_notify on
+the "lars_changes" channel inside the upsert transaction (Postgres delivers it
+only on COMMIT), MemoryRepository calls its on_change hook. Each replica keeps
+one LISTEN connection outside the pool and fans events out to its SSE
+subscribers through a ChangeBroadcaster.
+
+Every event has a seq (change_events_seq). A client that reconnects with
+Last-Event-ID (or ?cursor=) gets the events it missed from a ring buffer of
+recent events; if the cursor is older than the buffer it gets a "reset" event
+and should reload its data instead.
+
+Subscriber queues are bounded: a client that does not keep up is
+disconnected (its events are not buffered without limit) and resumes from
+its cursor on reconnect.
+"""
+import os
+import json
+import asyncio
+from collections import deque
+from typing import Optional
+
+import metrics
+from repository import NOTIFY_CHANNEL
+
+
+CHANGE_FEED_TOKEN = os.getenv("CHANGE_FEED_TOKEN", "")
+EVENTS_BUFFER_SIZE = int(os.getenv("EVENTS_BUFFER_SIZE", "10000"))
+EVENTS_SUBSCRIBER_QUEUE = int(os.getenv("EVENTS_SUBSCRIBER_QUEUE", "256"))
+EVENTS_KEEPALIVE_SECONDS = 15.0
+
+subscribers_gauge = metrics.Gauge("events_subscribers", "Connected /events subscribers")
+events_published_total = metrics.Counter("events_published_total", "Change events received for fan-out")
+subscriber_overflows_total = metrics.Counter(
+    "events_subscriber_overflows_total", "/events subscribers disconnected because their queue was full"
+)
+
+
+class Subscription:
+    def __init__(self, maxsize: int):
+        self.queue: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+
+class ChangeBroadcaster:
+    def __init__(self, buffer_size: int = EVENTS_BUFFER_SIZE, subscriber_queue: int = EVENTS_SUBSCRIBER_QUEUE):
+        self.subscriber_queue = subscriber_queue
+        self._buffer: "deque[dict]" = deque(maxlen=buffer_size)
+        self._subscribers: set = set()
+
+    def publish(self, event: dict):
+        events_published_total.inc()
+        self._buffer.append(event)
+        for subscription in list(self._subscribers):
+            self._deliver(subscription, event)
+
+    def publish_reset(self):
+        """Tell every subscriber that events may have been lost (e.g. LISTEN reconnect)."""
+        self._buffer.clear()
+        for subscription in list(self._subscribers):
+            self._deliver(subscription, {"type": "reset"})
+
+    def _deliver(self, subscription: Subscription, event: dict):
+        if subscription.overflowed:
+            return
+        try:
+            subscription.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            subscription.overflowed = True
+            subscriber_overflows_total.inc()
+            self.unsubscribe(subscription)
+
+    def subscribe(self, cursor: Optional[int]) -> tuple:
+        """Register a subscriber. Returns (subscription, backlog) where backlog is
+        the buffered events after cursor, or [{"type": "reset"}] if they are gone."""
+        subscription = Subscription(self.subscriber_queue)
+        backlog = []
+        if cursor is not None:
+            # Порядок в буфере - порядок COMMIT'ов, seq внутри него может идти не строго по возрастанию,
+            # поэтому продолжаем с позиции события cursor, а не с seq > cursor
+            seqs = [event["seq"] for event in self._buffer]
+            if cursor in seqs:
+                backlog = list(self._buffer)[seqs.index(cursor) + 1:]
+            elif not seqs or cursor < max(seqs):
+                backlog = [{"type": "reset"}]
+        self._subscribers.add(subscription)
+        subscribers_gauge.set(len(self._subscribers))
+        return subscription, backlog
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+        subscribers_gauge.set(len(self._subscribers))
+
+
+class PostgresChangeListener:
+    """One dedicated LISTEN connection per process, reconnected with backoff."""
+
+    def __init__(self, broadcaster: ChangeBroadcaster, dsn: str, connect_kwargs: Optional[dict] = None):
+        self.broadcaster = broadcaster
+        self.dsn = dsn
+        self.connect_kwargs = connect_kwargs or {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            print(f"Ignoring malformed change notification: {payload[:200]}")
+            return
+        self.broadcaster.publish(event)
+
+    async def _run(self):
+        import asyncpg
+
+        delay = 1.0
+        connected_before = False
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(dsn=self.dsn, **self.connect_kwargs)
+                await conn.add_listener(NOTIFY_CHANNEL, self._on_notify)
+                if connected_before:
+                    # Пока соединения не было, уведомления терялись
+                    self.broadcaster.publish_reset()
+                connected_before = True
+                delay = 1.0
+                print(f"Listening for change notifications on '{NOTIFY_CHANNEL}'")
+                while not conn.is_closed():
+                    await asyncio.sleep(5)
+                print("Change listener connection closed, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Change listener error: {type(e).__name__}: {e}; retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60.0)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+
+
+def format_sse(event: dict) -> str:
+    if event.get("type") == "reset":
+        return "event: reset\ndata: {}\n\n"
+    return f"id: {event['seq']}\nevent: entry\ndata: {json.dumps(event, separators=(',', ':'))}\n\n"
+
+
+async def sse_stream(request, broadcaster: ChangeBroadcaster, cursor: Optional[int]):
+    subscription, backlog = broadcaster.subscribe(cursor)
+    try:
+        yield "retry: 3000\n\n"
+        for event in backlog:
+            yield format_sse(event)
+        while not subscription.overflowed:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), EVENTS_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield ": keepalive\n\n"
+                continue
+            yield format_sse(event)
+        # Переполнение: отдаём то, что уже в очереди, и закрываем поток - клиент продолжит с Last-Event-ID
+        while not subscription.queue.empty():
+            yield format_sse(subscription.queue.get_nowait())
+    finally:
+        broadcaster.unsubscribe(subscription)
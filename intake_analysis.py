@@ -0,0 +1,191 @@
+"""Food/drink intake vs. symptom association analysis for daily_entries.
+
+Loads the intake and symptom matrix for one patient or the whole cohort in a
+single query and computes same-day and next-day Pearson correlations with
+NumPy. Values are centred per patient first, so cohort results describe
+within-patient associations rather than differences between patients.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import text
+
+
+# Колонки intake в порядке, в котором они возвращаются в ответе
+FOOD_COLUMNS = (
+    "food_vegetables_all",
+    "food_root_vegetables",
+    "food_whole_grains",
+    "food_whole_grain_bread",
+    "food_nuts_and_seeds",
+    "food_legumes",
+    "food_fruits_with_skin",
+    "food_berries",
+    "food_soft_fruits_no_skin",
+    "food_muesli_and_bran",
+)
+DRINK_COLUMNS = (
+    "drink_water",
+    "drink_coffee",
+    "drink_tea",
+    "drink_alcohol",
+    "drink_carbonated",
+    "drink_juices",
+    "drink_dairy",
+    "drink_energy",
+)
+INTAKE_COLUMNS = FOOD_COLUMNS + DRINK_COLUMNS
+# Верхняя граница количества: компактная раскладка дневника хранит один байт на колонку
+MAX_INTAKE_AMOUNT = 255
+
+# Симптомы; leakage и urgency переводятся в числа прямо в SQL
+SYMPTOM_COLUMNS = ("stool_count", "leakage", "urgency", "bloating")
+
+# Меньше пар - корреляция не считается (null в ответе)
+MIN_PAIRS = 5
+
+# Пациент - по patient_code: так же ключуются архивные строки (archive.py), у которых patient_id
+# может быть от другого шарда (rebalance_shards.py)
+_SELECT_MATRIX = f"""
+    SELECT
+        p.patient_code,
+        de.entry_date,
+        {", ".join("de." + column for column in INTAKE_COLUMNS)},
+        de.stool_count,
+        CASE de.leakage WHEN 'Liquid' THEN 1 WHEN 'Solid' THEN 2 ELSE 0 END AS leakage,
+        CASE de.urgency WHEN 'Yes' THEN 1 ELSE 0 END AS urgency,
+        de.bloating::FLOAT8 AS bloating
+    FROM daily_entries de
+    INNER JOIN patients p ON p.id = de.patient_id
+"""
+
+PATIENT_MATRIX_QUERY = text(_SELECT_MATRIX + """
+    WHERE p.patient_code = :code
+    ORDER BY de.entry_date ASC
+""")
+
+# Порядок индекса (patient_id, entry_date): у patient_id один patient_code, строки пациента идут подряд
+COHORT_MATRIX_QUERY = text(_SELECT_MATRIX + """
+    ORDER BY de.patient_id, de.entry_date ASC
+""")
+
+
+@dataclass
+class IntakeSymptomMatrix:
+    """Diary rows as arrays: each patient's rows consecutive and sorted by entry_date."""
+
+    patient_index: np.ndarray  # int, 0..n_patients-1
+    day_number: np.ndarray  # int, days since epoch
+    intake: np.ndarray  # float, shape (n_rows, len(INTAKE_COLUMNS))
+    symptoms: np.ndarray  # float, shape (n_rows, len(SYMPTOM_COLUMNS))
+
+    @classmethod
+    def from_rows(cls, rows) -> "IntakeSymptomMatrix":
+        n_intake = len(INTAKE_COLUMNS)
+        if not rows:
+            return cls(
+                patient_index=np.zeros(0, dtype=np.int64),
+                day_number=np.zeros(0, dtype=np.int64),
+                intake=np.zeros((0, n_intake)),
+                symptoms=np.zeros((0, len(SYMPTOM_COLUMNS))),
+            )
+        _, patient_index = np.unique([str(row[0]) for row in rows], return_inverse=True)
+        day_number = np.array([row[1].toordinal() for row in rows], dtype=np.int64)
+        values = np.array([row[2:] for row in rows], dtype=np.float64)
+        return cls(
+            patient_index=patient_index.astype(np.int64),
+            day_number=day_number,
+            intake=values[:, :n_intake],
+            symptoms=values[:, n_intake:],
+        )
+
+
+async def load_rows(session, patient_code: Optional[str] = None) -> list:
+    """Matrix rows (as selected by _SELECT_MATRIX) for one patient, or the cohort if patient_code is None."""
+    if patient_code is None:
+        result = await session.execute(COHORT_MATRIX_QUERY)
+    else:
+        result = await session.execute(PATIENT_MATRIX_QUERY.bindparams(code=patient_code))
+    return result.fetchall()
+
+
+async def load_matrix(session, patient_code: Optional[str] = None) -> IntakeSymptomMatrix:
+    """Load the intake/symptom matrix for one patient, or the cohort if patient_code is None."""
+    return IntakeSymptomMatrix.from_rows(await load_rows(session, patient_code))
+
+
+_LEAKAGE_CODES = {"Liquid": 1, "Solid": 2}
+
+
+def matrix_row(record: dict) -> tuple:
+    """Python version of _SELECT_MATRIX for one daily_entries row given as a dict."""
+    return (
+        (record["patient_code"], record["entry_date"])
+        + tuple(record[column] for column in INTAKE_COLUMNS)
+        + (
+            record["stool_count"],
+            _LEAKAGE_CODES.get(record["leakage"], 0),
+            1 if record["urgency"] == "Yes" else 0,
+            float(record["bloating"]),
+        )
+    )
+
+
+def _center_per_patient(values: np.ndarray, patient_index: np.ndarray) -> np.ndarray:
+    n_patients = int(patient_index.max()) + 1
+    counts = np.bincount(patient_index, minlength=n_patients)
+    sums = np.zeros((n_patients, values.shape[1]))
+    np.add.at(sums, patient_index, values)
+    return values - (sums / counts[:, None])[patient_index]
+
+
+def _correlate(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Pearson r for every (x column, y column) pair; NaN where undefined."""
+    if x.shape[0] < MIN_PAIRS:
+        return np.full((x.shape[1], y.shape[1]), np.nan)
+    xc = x - x.mean(axis=0)
+    yc = y - y.mean(axis=0)
+    norm = np.outer(np.sqrt((xc ** 2).sum(axis=0)), np.sqrt((yc ** 2).sum(axis=0)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = (xc.T @ yc) / norm
+    r[norm == 0] = np.nan
+    return r
+
+
+def _as_table(r: np.ndarray) -> dict:
+    return {
+        intake: {
+            symptom: (None if np.isnan(r[i, j]) else round(float(r[i, j]), 3))
+            for j, symptom in enumerate(SYMPTOM_COLUMNS)
+        }
+        for i, intake in enumerate(INTAKE_COLUMNS)
+    }
+
+
+def compute_associations(matrix: IntakeSymptomMatrix) -> dict:
+    """Same-day and next-day intake→symptom correlations.
+
+    Next-day pairs match intake on day D with symptoms on day D+1 of the same
+    patient; days without a following diary entry are skipped.
+    """
+    n_rows = matrix.intake.shape[0]
+    if n_rows == 0:
+        intake = np.zeros((0, len(INTAKE_COLUMNS)))
+        symptoms = np.zeros((0, len(SYMPTOM_COLUMNS)))
+        next_day = np.zeros(0, dtype=bool)
+    else:
+        intake = _center_per_patient(matrix.intake, matrix.patient_index)
+        symptoms = _center_per_patient(matrix.symptoms, matrix.patient_index)
+        next_day = (
+            (matrix.patient_index[1:] == matrix.patient_index[:-1])
+            & (matrix.day_number[1:] - matrix.day_number[:-1] == 1)
+        )
+
+    return {
+        "n_patients": int(np.unique(matrix.patient_index).size),
+        "n_days": n_rows,
+        "n_next_day_pairs": int(next_day.sum()),
+        "same_day": _as_table(_correlate(intake, symptoms)),
+        "next_day": _as_table(_correlate(intake[:-1][next_day], symptoms[1:][next_day])),
+    }
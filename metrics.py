@@ -0,0 +1,91 @@
+"""In-process counters and gauges exposed in Prometheus text format on /metrics.
+
+Values are per process; with several replicas/workers the scraper sums them.
+"""
+import threading
+from typing import Callable, Optional
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """Gauge set explicitly, or read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (),
+                 callback: Optional[Callable[[], dict]] = None):
+        super().__init__(name, help_text, labelnames)
+        # callback() -> {labels tuple: value}
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                return list(self.callback().items())
+            except Exception as e:
+                print(f"Metrics callback for {self.name} failed: {type(e).__name__}: {e}")
+                return []
+        return super().samples()
+
+
+REGISTRY: list = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key, value in sorted(metric.samples()):
+            if metric.labelnames:
+                labels = ",".join(f'{name}="{_escape(v)}"' for name, v in zip(metric.labelnames, key))
+                lines.append(f"{metric.name}{{{labels}}} {_format_value(value)}")
+            else:
+                lines.append(f"{metric.name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
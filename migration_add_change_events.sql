@@ -0,0 +1,3 @@
+-- Лента изменений для GET /events: номер события в pg_notify('lars_changes', ...)
+-- Нужна до включения CHANGE_FEED_TOKEN
+CREATE SEQUENCE IF NOT EXISTS change_events_seq;
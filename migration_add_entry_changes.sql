@@ -0,0 +1,59 @@
+-- Delta-синхронизация (GET /changes): у каждой строки weekly/daily/monthly/eq5d5l_entries
+--   * change_seq - номер последнего изменения из общей последовательности entry_change_seq;
+--     новая строка получает его из DEFAULT, ON CONFLICT DO UPDATE в repository.py выдаёт новый
+--   * updated_at - время последнего изменения (у существующих строк = created_at)
+-- Индекс (patient_id, change_seq): /changes читает только строки после курсора клиента.
+--
+-- Каждая таблица переписывается один раз (номера раздаются при перезаписи, без UPDATE
+-- и мёртвых строк) под ACCESS EXCLUSIVE - запускать в окно обслуживания:
+--     psql "$DATABASE_URL" -1 -f migration_add_entry_changes.sql
+-- Работает и после migration_compact_daily_entries.sql (колонки добавляются в
+-- daily_entries_compact и в представление daily_entries). На новой базе эта миграция
+-- идёт раньше компактной: migration_compact_daily_entries.sql переносит обе колонки.
+-- Повторный запуск (и запуск на базе из нового schema.sql) ничего не меняет.
+
+CREATE SEQUENCE IF NOT EXISTS entry_change_seq;
+
+DO $$
+DECLARE
+  entry_table TEXT;
+BEGIN
+  FOREACH entry_table IN ARRAY ARRAY[
+    'weekly_entries',
+    COALESCE(to_regclass('daily_entries_compact'), to_regclass('daily_entries'))::TEXT,
+    'monthly_entries',
+    'eq5d5l_entries'
+  ] LOOP
+    IF EXISTS (
+      SELECT 1 FROM pg_attribute
+      WHERE attrelid = entry_table::REGCLASS AND attname = 'change_seq' AND NOT attisdropped
+    ) THEN
+      CONTINUE;
+    END IF;
+    EXECUTE format('ALTER TABLE %I ADD COLUMN updated_at TIMESTAMPTZ', entry_table);
+    -- Одна перезапись таблицы: nextval для каждой строки и updated_at из created_at
+    EXECUTE format(
+      'ALTER TABLE %I
+         ADD COLUMN change_seq BIGINT NOT NULL DEFAULT nextval(''entry_change_seq''),
+         ALTER COLUMN updated_at TYPE TIMESTAMPTZ USING created_at,
+         ALTER COLUMN updated_at SET DEFAULT now(),
+         ALTER COLUMN updated_at SET NOT NULL',
+      entry_table
+    );
+    EXECUTE format('CREATE INDEX %I ON %I (patient_id, change_seq)', entry_table || '_changes_idx', entry_table);
+    EXECUTE format('ANALYZE %I', entry_table);
+  END LOOP;
+
+  IF to_regclass('daily_entries_compact') IS NOT NULL AND NOT EXISTS (
+    SELECT 1 FROM pg_attribute WHERE attrelid = 'daily_entries'::REGCLASS AND attname = 'change_seq'
+  ) THEN
+    -- Представление: новые колонки в конце (CREATE OR REPLACE VIEW может только дописывать)
+    EXECUTE 'CREATE OR REPLACE VIEW daily_entries AS '
+      || regexp_replace(
+           pg_get_viewdef('daily_entries'::REGCLASS),
+           '\s+FROM\s+daily_entries_compact\s*;?\s*$',
+           ', updated_at, change_seq FROM daily_entries_compact'
+         );
+  END IF;
+END
+$$;
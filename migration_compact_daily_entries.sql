@@ -0,0 +1,247 @@
+-- Компактное хранение дневника (DAILY_LAYOUT=compact)
+-- Строки переезжают в daily_entries_compact:
+--   * 18 колонок food_*/drink_* -> intake BYTEA, один байт на колонку в порядке
+--     intake_analysis.INTAKE_COLUMNS, хвостовые нули отрезаны (значения 0..255)
+--   * bloating / impact_score / activity_interfere NUMERIC(5,2) -> INTEGER * 100
+--   * urgency / night_stools / incomplete_evacuation 'Yes'/'No' -> BOOLEAN
+--   * leakage 'None'/'Liquid'/'Solid' -> leakage_code 0/1/2
+-- daily_entries становится представлением с прежними колонками и типами:
+-- чтение, экспорт, аналитика, COPY/INSERT (триггер) и DELETE работают как раньше.
+-- Старая таблица остаётся как daily_entries_wide до проверки (DROP в конце файла).
+--
+-- Запускать одной транзакцией после migration_add_entry_changes.sql (change_seq,
+-- updated_at переносятся как есть), затем включить DAILY_LAYOUT=compact:
+--     psql "$DATABASE_URL" -1 -f migration_compact_daily_entries.sql
+-- Файл без BEGIN/COMMIT: scripts/daily_layout_benchmark.py выполняет его внутри
+-- своей транзакции и откатывает.
+
+CREATE TABLE daily_entries_compact (
+  id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+  patient_id UUID NOT NULL REFERENCES patients(id) ON DELETE CASCADE,
+  -- Колонки по убыванию выравнивания: без пустых байтов между ними
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  change_seq BIGINT NOT NULL DEFAULT nextval('entry_change_seq'),
+  entry_date DATE NOT NULL DEFAULT CURRENT_DATE,
+  bloating_x100 INTEGER NOT NULL DEFAULT 0 CHECK (bloating_x100 BETWEEN -99999 AND 99999),
+  impact_score_x100 INTEGER NOT NULL DEFAULT 0 CHECK (impact_score_x100 BETWEEN -99999 AND 99999),
+  activity_interfere_x100 INTEGER NOT NULL DEFAULT 0 CHECK (activity_interfere_x100 BETWEEN -99999 AND 99999),
+  bristol_scale SMALLINT CHECK (bristol_scale BETWEEN 1 AND 7),
+  stool_count SMALLINT NOT NULL DEFAULT 0,
+  pads_used SMALLINT NOT NULL DEFAULT 0,
+  leakage_code SMALLINT NOT NULL DEFAULT 0 CHECK (leakage_code BETWEEN 0 AND 2),
+  urgency BOOLEAN NOT NULL DEFAULT FALSE,
+  night_stools BOOLEAN NOT NULL DEFAULT FALSE,
+  incomplete_evacuation BOOLEAN NOT NULL DEFAULT FALSE,
+  intake BYTEA NOT NULL DEFAULT '' CHECK (length(intake) <= 18),
+  UNIQUE (patient_id, entry_date)
+);
+
+-- 'Yes'/'No' -> BOOLEAN; другое значение - та же ошибка, что у CHECK в старой таблице
+CREATE FUNCTION daily_yes_no(answer TEXT) RETURNS BOOLEAN
+LANGUAGE plpgsql IMMUTABLE AS $$
+BEGIN
+  IF answer IS NULL THEN
+    RETURN NULL;
+  ELSIF answer = 'Yes' THEN
+    RETURN TRUE;
+  ELSIF answer = 'No' THEN
+    RETURN FALSE;
+  END IF;
+  RAISE EXCEPTION 'invalid Yes/No value: %', answer USING ERRCODE = 'check_violation';
+END
+$$;
+
+CREATE FUNCTION daily_leakage_code(leakage TEXT) RETURNS SMALLINT
+LANGUAGE plpgsql IMMUTABLE AS $$
+BEGIN
+  IF leakage IS NULL THEN
+    RETURN NULL;
+  ELSIF leakage IN ('None', 'Liquid', 'Solid') THEN
+    RETURN array_position(ARRAY['None', 'Liquid', 'Solid'], leakage) - 1;
+  END IF;
+  RAISE EXCEPTION 'invalid leakage value: %', leakage USING ERRCODE = 'check_violation';
+END
+$$;
+
+-- 18 количеств food/drink -> BYTEA без хвостовых нулей
+CREATE FUNCTION daily_intake_pack(amounts SMALLINT[]) RETURNS BYTEA
+LANGUAGE plpgsql IMMUTABLE STRICT AS $$
+DECLARE
+  packed BYTEA := '\x'::BYTEA;
+  used INTEGER := 0;
+BEGIN
+  IF cardinality(amounts) <> 18 THEN
+    RAISE EXCEPTION 'expected 18 intake amounts, got %', cardinality(amounts) USING ERRCODE = 'check_violation';
+  END IF;
+  FOR i IN 1 .. 18 LOOP
+    IF amounts[i] IS NULL THEN
+      RAISE EXCEPTION 'intake amount % is null', i USING ERRCODE = 'not_null_violation';
+    END IF;
+    IF amounts[i] NOT BETWEEN 0 AND 255 THEN
+      RAISE EXCEPTION 'intake amount % out of range 0..255: %', i, amounts[i] USING ERRCODE = 'check_violation';
+    END IF;
+    packed := packed || set_byte('\x00'::BYTEA, 0, amounts[i]);
+    IF amounts[i] <> 0 THEN
+      used := i;
+    END IF;
+  END LOOP;
+  RETURN substring(packed FROM 1 FOR used);
+END
+$$;
+
+-- Количество на позиции slot (0..17); SQL-функция встраивается в план представления
+CREATE FUNCTION daily_intake_at(intake BYTEA, slot INTEGER) RETURNS SMALLINT
+LANGUAGE sql IMMUTABLE AS $$
+  SELECT CASE WHEN slot < length(intake) THEN get_byte(intake, slot)::SMALLINT ELSE 0::SMALLINT END
+$$;
+
+INSERT INTO daily_entries_compact (
+  id, patient_id, created_at, updated_at, change_seq, entry_date,
+  bloating_x100, impact_score_x100, activity_interfere_x100,
+  bristol_scale, stool_count, pads_used, leakage_code,
+  urgency, night_stools, incomplete_evacuation, intake
+)
+SELECT
+  id, patient_id, created_at, updated_at, change_seq, entry_date,
+  round(bloating * 100), round(impact_score * 100), round(activity_interfere * 100),
+  bristol_scale, stool_count, pads_used, daily_leakage_code(leakage),
+  daily_yes_no(urgency), daily_yes_no(night_stools), daily_yes_no(incomplete_evacuation),
+  daily_intake_pack(ARRAY[
+    food_vegetables_all, food_root_vegetables, food_whole_grains,
+    food_whole_grain_bread, food_nuts_and_seeds, food_legumes,
+    food_fruits_with_skin, food_berries, food_soft_fruits_no_skin,
+    food_muesli_and_bran,
+    drink_water, drink_coffee, drink_tea, drink_alcohol,
+    drink_carbonated, drink_juices, drink_dairy, drink_energy
+  ])
+FROM daily_entries
+ORDER BY patient_id, entry_date;
+
+ALTER TABLE daily_entries RENAME TO daily_entries_wide;
+-- Индекс GET /changes остаётся у старой таблицы - у новой свой
+ALTER INDEX daily_entries_changes_idx RENAME TO daily_entries_wide_changes_idx;
+CREATE INDEX daily_entries_compact_changes_idx ON daily_entries_compact (patient_id, change_seq);
+
+-- Колонки, их порядок и типы - как у прежней таблицы (SELECT * и экспорт не меняются)
+CREATE VIEW daily_entries AS
+SELECT
+  id,
+  patient_id,
+  entry_date,
+  bristol_scale,
+  stool_count,
+  pads_used,
+  CASE WHEN urgency THEN 'Yes' ELSE 'No' END AS urgency,
+  CASE WHEN night_stools THEN 'Yes' ELSE 'No' END AS night_stools,
+  (ARRAY['None', 'Liquid', 'Solid'])[leakage_code + 1] AS leakage,
+  CASE WHEN incomplete_evacuation THEN 'Yes' ELSE 'No' END AS incomplete_evacuation,
+  (bloating_x100 / 100.0)::NUMERIC(5, 2) AS bloating,
+  (impact_score_x100 / 100.0)::NUMERIC(5, 2) AS impact_score,
+  (activity_interfere_x100 / 100.0)::NUMERIC(5, 2) AS activity_interfere,
+  daily_intake_at(intake, 0) AS food_vegetables_all,
+  daily_intake_at(intake, 1) AS food_root_vegetables,
+  daily_intake_at(intake, 2) AS food_whole_grains,
+  daily_intake_at(intake, 3) AS food_whole_grain_bread,
+  daily_intake_at(intake, 4) AS food_nuts_and_seeds,
+  daily_intake_at(intake, 5) AS food_legumes,
+  daily_intake_at(intake, 6) AS food_fruits_with_skin,
+  daily_intake_at(intake, 7) AS food_berries,
+  daily_intake_at(intake, 8) AS food_soft_fruits_no_skin,
+  daily_intake_at(intake, 9) AS food_muesli_and_bran,
+  daily_intake_at(intake, 10) AS drink_water,
+  daily_intake_at(intake, 11) AS drink_coffee,
+  daily_intake_at(intake, 12) AS drink_tea,
+  daily_intake_at(intake, 13) AS drink_alcohol,
+  daily_intake_at(intake, 14) AS drink_carbonated,
+  daily_intake_at(intake, 15) AS drink_juices,
+  daily_intake_at(intake, 16) AS drink_dairy,
+  daily_intake_at(intake, 17) AS drink_energy,
+  created_at,
+  updated_at,
+  change_seq
+FROM daily_entries_compact;
+
+-- Значения по умолчанию как у прежней таблицы: INSERT/COPY без части колонок
+ALTER VIEW daily_entries ALTER COLUMN id SET DEFAULT gen_random_uuid();
+ALTER VIEW daily_entries ALTER COLUMN entry_date SET DEFAULT CURRENT_DATE;
+ALTER VIEW daily_entries ALTER COLUMN stool_count SET DEFAULT 0;
+ALTER VIEW daily_entries ALTER COLUMN pads_used SET DEFAULT 0;
+ALTER VIEW daily_entries ALTER COLUMN urgency SET DEFAULT 'No';
+ALTER VIEW daily_entries ALTER COLUMN night_stools SET DEFAULT 'No';
+ALTER VIEW daily_entries ALTER COLUMN leakage SET DEFAULT 'None';
+ALTER VIEW daily_entries ALTER COLUMN incomplete_evacuation SET DEFAULT 'No';
+ALTER VIEW daily_entries ALTER COLUMN bloating SET DEFAULT 0;
+ALTER VIEW daily_entries ALTER COLUMN impact_score SET DEFAULT 0;
+ALTER VIEW daily_entries ALTER COLUMN activity_interfere SET DEFAULT 0;
+ALTER VIEW daily_entries ALTER COLUMN created_at SET DEFAULT now();
+DO $$
+DECLARE
+  intake_column TEXT;
+BEGIN
+  FOREACH intake_column IN ARRAY ARRAY[
+    'food_vegetables_all', 'food_root_vegetables', 'food_whole_grains',
+    'food_whole_grain_bread', 'food_nuts_and_seeds', 'food_legumes',
+    'food_fruits_with_skin', 'food_berries', 'food_soft_fruits_no_skin',
+    'food_muesli_and_bran',
+    'drink_water', 'drink_coffee', 'drink_tea', 'drink_alcohol',
+    'drink_carbonated', 'drink_juices', 'drink_dairy', 'drink_energy'
+  ] LOOP
+    EXECUTE format('ALTER VIEW daily_entries ALTER COLUMN %I SET DEFAULT 0', intake_column);
+  END LOOP;
+END
+$$;
+
+-- INSERT/UPDATE через представление пишут в daily_entries_compact.
+-- INSERT ... ON CONFLICT (patient_id, entry_date) на представлении не поддерживается -
+-- приложение с DAILY_LAYOUT=compact пишет в таблицу напрямую (repository.UPSERT_DAILY_COMPACT_SQL).
+CREATE FUNCTION daily_entries_write() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+DECLARE
+  packed_intake BYTEA := daily_intake_pack(ARRAY[
+    NEW.food_vegetables_all, NEW.food_root_vegetables, NEW.food_whole_grains,
+    NEW.food_whole_grain_bread, NEW.food_nuts_and_seeds, NEW.food_legumes,
+    NEW.food_fruits_with_skin, NEW.food_berries, NEW.food_soft_fruits_no_skin,
+    NEW.food_muesli_and_bran,
+    NEW.drink_water, NEW.drink_coffee, NEW.drink_tea, NEW.drink_alcohol,
+    NEW.drink_carbonated, NEW.drink_juices, NEW.drink_dairy, NEW.drink_energy
+  ]);
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO daily_entries_compact (
+      id, patient_id, created_at, entry_date,
+      bloating_x100, impact_score_x100, activity_interfere_x100,
+      bristol_scale, stool_count, pads_used, leakage_code,
+      urgency, night_stools, incomplete_evacuation, intake
+    ) VALUES (
+      NEW.id, NEW.patient_id, NEW.created_at, NEW.entry_date,
+      round(NEW.bloating * 100), round(NEW.impact_score * 100), round(NEW.activity_interfere * 100),
+      NEW.bristol_scale, NEW.stool_count, NEW.pads_used, daily_leakage_code(NEW.leakage),
+      daily_yes_no(NEW.urgency), daily_yes_no(NEW.night_stools), daily_yes_no(NEW.incomplete_evacuation),
+      packed_intake
+    );
+  ELSE
+    UPDATE daily_entries_compact SET
+      id = NEW.id, patient_id = NEW.patient_id, created_at = NEW.created_at, entry_date = NEW.entry_date,
+      bloating_x100 = round(NEW.bloating * 100),
+      impact_score_x100 = round(NEW.impact_score * 100),
+      activity_interfere_x100 = round(NEW.activity_interfere * 100),
+      bristol_scale = NEW.bristol_scale, stool_count = NEW.stool_count, pads_used = NEW.pads_used,
+      leakage_code = daily_leakage_code(NEW.leakage),
+      urgency = daily_yes_no(NEW.urgency), night_stools = daily_yes_no(NEW.night_stools),
+      incomplete_evacuation = daily_yes_no(NEW.incomplete_evacuation),
+      intake = packed_intake
+    WHERE id = OLD.id;
+  END IF;
+  RETURN NEW;
+END
+$$;
+
+CREATE TRIGGER daily_entries_write
+  INSTEAD OF INSERT OR UPDATE ON daily_entries
+  FOR EACH ROW EXECUTE FUNCTION daily_entries_write();
+
+ANALYZE daily_entries_compact;
+
+-- После проверки (DAILY_LAYOUT=compact, экспорт, аналитика) освободить место:
+-- DROP TABLE daily_entries_wide;
@@ -0,0 +1,19 @@
+-- Удаление избыточных индексов (сгенерировано scripts/index_audit.py)
+-- Каждый из них повторяет ведущие колонки другого индекса той же таблицы;
+-- B-tree читается в обе стороны, поэтому планы запросов не меняются, а каждый
+-- send* перестаёт обновлять лишнее дерево.
+-- DROP INDEX коротко берёт ACCESS EXCLUSIVE на таблицу; вне транзакции можно
+-- заменить на DROP INDEX CONCURRENTLY.
+-- Размеры в комментариях - с локальной синтетической базы scripts/generate_data.py
+-- (2 000 пациентов, 755 тыс. строк дневника); на другой базе они будут другими.
+
+-- idx_daily_patient_date: duplicate of daily_entries_patient_id_entry_date_key (constraint index), differs in sort order, 48.1 MB
+DROP INDEX IF EXISTS idx_daily_patient_date;
+-- idx_eq5d5l_patient_date: duplicate of eq5d5l_entries_patient_id_entry_date_key (constraint index), differs in sort order, 416.0 kB
+DROP INDEX IF EXISTS idx_eq5d5l_patient_date;
+-- idx_monthly_patient_date: duplicate of monthly_entries_patient_id_entry_date_key (constraint index), differs in sort order, 1.5 MB
+DROP INDEX IF EXISTS idx_monthly_patient_date;
+-- idx_patients_code: duplicate of patients_patient_code_key (constraint index), 88.0 kB
+DROP INDEX IF EXISTS idx_patients_code;
+-- idx_weekly_patient_date: duplicate of weekly_entries_patient_id_entry_date_key (constraint index), differs in sort order, 6.7 MB
+DROP INDEX IF EXISTS idx_weekly_patient_date;
@@ -0,0 +1,278 @@
+"""Adaptive limit on concurrent database work (AIMD) in front of the SQLAlchemy pool.
+
+The pool itself is sized once at startup (POOL_SIZE kept open, up to
+POOL_MAX_OVERFLOW more opened on demand and closed again when returned).
+PostgresRepository enters ConcurrencyGate.slot() before opening a session, so
+the number of connections actually checked out never exceeds the gate's
+limit. Every POOL_CONTROL_INTERVAL seconds AimdController looks at what
+happened since the last tick and moves the limit between POOL_LIMIT_MIN and
+POOL_LIMIT_MAX:
+- max-clients errors from the server/pooler: limit x0.5
+- pool or statement timeouts, lost connections, or slow checkouts (p95 above
+  POOL_TARGET_CHECKOUT_MS): limit x0.75
+- requests queued at the gate while it was full and nothing above happened:
+  limit + POOL_LIMIT_STEP
+- otherwise the limit is kept
+
+With DATABASE_SHARD_URLS every shard engine gets its own gate and
+controller (metrics are labelled with the shard name, "default" otherwise).
+
+POOL_ADAPTIVE=0 disables the gate; the pool then works as before.
+"""
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+
+import metrics
+
+
+POOL_SIZE = int(os.getenv("POOL_SIZE", "10"))
+POOL_MAX_OVERFLOW = int(os.getenv("POOL_MAX_OVERFLOW", "20"))
+POOL_TIMEOUT = float(os.getenv("POOL_TIMEOUT", "30"))
+POOL_ADAPTIVE = os.getenv("POOL_ADAPTIVE", "1") != "0"
+POOL_LIMIT_MIN = int(os.getenv("POOL_LIMIT_MIN", "2"))
+POOL_LIMIT_MAX = int(os.getenv("POOL_LIMIT_MAX", str(POOL_SIZE + POOL_MAX_OVERFLOW)))
+POOL_LIMIT_INITIAL = int(os.getenv("POOL_LIMIT_INITIAL", str(POOL_SIZE)))
+POOL_LIMIT_STEP = int(os.getenv("POOL_LIMIT_STEP", "1"))
+POOL_CONTROL_INTERVAL = float(os.getenv("POOL_CONTROL_INTERVAL", "5"))
+POOL_TARGET_CHECKOUT_MS = float(os.getenv("POOL_TARGET_CHECKOUT_MS", "100"))
+
+DECREASE_FACTORS = {"max_clients": 0.5, "timeout": 0.75, "connection": 0.75, "slow_checkout": 0.75}
+
+decisions_total = metrics.Counter(
+    "pool_controller_decisions_total", "Concurrency limit decisions per control interval",
+    ("database", "action", "reason"),
+)
+errors_total = metrics.Counter("pool_errors_total", "Database errors seen by the pool controller", ("database", "kind"))
+gate_waits_total = metrics.Counter(
+    "pool_gate_waits_total", "Requests that had to queue for a database slot", ("database",)
+)
+gate_wait_seconds_total = metrics.Counter(
+    "pool_gate_wait_seconds_total", "Total time spent queueing for a slot", ("database",)
+)
+
+
+def classify_error(error: BaseException) -> Optional[str]:
+    """max_clients / timeout / connection for errors the controller reacts to, else None."""
+    message = str(error).lower()
+    name = type(error).__name__
+    if name == "TooManyConnectionsError" or any(
+        phrase in message
+        for phrase in ("maxclientsinsessionmode", "max clients reached", "too many clients", "too many connections")
+    ):
+        return "max_clients"
+    if "timeout" in name.lower() or "timed out" in message or "timeout" in message:
+        return "timeout"
+    if "connection" in message and any(word in message for word in ("closed", "lost", "reset", "refused")):
+        return "connection"
+    return None
+
+
+class ConcurrencyGate:
+    def __init__(self, limit: int, timeout: float = POOL_TIMEOUT, name: str = "default"):
+        self.name = name
+        self.limit = limit
+        self.timeout = timeout
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+        # Статистика с прошлого тика контроллера
+        self.peak_in_flight = 0
+        self.waited = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            await self.release()
+
+    async def acquire(self):
+        async with self._condition:
+            if self.in_flight >= self.limit:
+                self.waited += 1
+                gate_waits_total.inc(database=self.name)
+                started = time.perf_counter()
+                try:
+                    await asyncio.wait_for(
+                        self._condition.wait_for(lambda: self.in_flight < self.limit), self.timeout
+                    )
+                finally:
+                    gate_wait_seconds_total.inc(time.perf_counter() - started, database=self.name)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    async def set_limit(self, limit: int):
+        async with self._condition:
+            grew = limit > self.limit
+            self.limit = limit
+            if grew:
+                self._condition.notify(limit)
+
+    def take_stats(self) -> tuple:
+        stats = (self.peak_in_flight, self.waited)
+        self.peak_in_flight = self.in_flight
+        self.waited = 0
+        return stats
+
+
+class AimdController:
+    def __init__(self, gate: ConcurrencyGate, low: int = POOL_LIMIT_MIN, high: int = POOL_LIMIT_MAX,
+                 step: int = POOL_LIMIT_STEP, interval: float = POOL_CONTROL_INTERVAL,
+                 target_checkout_ms: float = POOL_TARGET_CHECKOUT_MS):
+        self.gate = gate
+        self.low = low
+        self.high = high
+        self.step = step
+        self.interval = interval
+        self.target_checkout_ms = target_checkout_ms
+        self.last_decision = ("hold", "start")
+        self._errors = {}
+        self._checkout_ms = []
+        self._task: Optional[asyncio.Task] = None
+
+    def observe_error(self, error: BaseException):
+        kind = classify_error(error)
+        if kind:
+            errors_total.inc(database=self.gate.name, kind=kind)
+            self._errors[kind] = self._errors.get(kind, 0) + 1
+
+    def observe_checkout(self, seconds: float):
+        if len(self._checkout_ms) < 10000:
+            self._checkout_ms.append(seconds * 1000)
+
+    def decide(self, peak_in_flight: int, waited: int, errors: dict, checkout_ms: list) -> tuple:
+        """(new limit, action, reason) for one interval of observations."""
+        limit = self.gate.limit
+        checkout_p95 = sorted(checkout_ms)[int(len(checkout_ms) * 0.95)] if checkout_ms else 0.0
+        if errors.get("max_clients"):
+            reason = "max_clients"
+        elif errors.get("timeout"):
+            reason = "timeout"
+        elif errors.get("connection"):
+            reason = "connection"
+        elif checkout_p95 > self.target_checkout_ms:
+            reason = "slow_checkout"
+        else:
+            reason = None
+        if reason:
+            new_limit = max(self.low, int(limit * DECREASE_FACTORS[reason]))
+            return new_limit, ("decrease" if new_limit < limit else "hold"), reason
+        if waited and peak_in_flight >= limit:
+            new_limit = min(self.high, limit + self.step)
+            return new_limit, ("increase" if new_limit > limit else "hold"), "queueing"
+        return limit, "hold", "steady"
+
+    async def tick(self):
+        peak_in_flight, waited = self.gate.take_stats()
+        errors, self._errors = self._errors, {}
+        checkout_ms, self._checkout_ms = self._checkout_ms, []
+        new_limit, action, reason = self.decide(peak_in_flight, waited, errors, checkout_ms)
+        decisions_total.inc(database=self.gate.name, action=action, reason=reason)
+        if new_limit != self.gate.limit:
+            print(f"Pool concurrency limit [{self.gate.name}] {self.gate.limit} -> {new_limit} ({reason})")
+            await self.gate.set_limit(new_limit)
+        self.last_decision = (action, reason)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f"Pool controller [{self.gate.name}] tick failed: {type(e).__name__}: {e}")
+
+
+# Контроллер на каждый движок (шард); repository передаёт свой в slot(),
+# а _checkout/handle_error находят текущий через contextvar
+controllers: dict = {}
+_pools: dict = {}
+_current: ContextVar[Optional[AimdController]] = ContextVar("pool_controller", default=None)
+
+
+def _per_database(value) -> dict:
+    return {(name,): value(controller, _pools[name]) for name, controller in controllers.items()}
+
+
+metrics.Gauge("pool_concurrency_limit", "Current adaptive limit on concurrent DB sessions", ("database",),
+              callback=lambda: _per_database(lambda controller, pool: controller.gate.limit))
+metrics.Gauge("pool_in_flight", "DB sessions currently holding a gate slot", ("database",),
+              callback=lambda: _per_database(lambda controller, pool: controller.gate.in_flight))
+metrics.Gauge("pool_checked_out", "Connections checked out of the SQLAlchemy pool", ("database",),
+              callback=lambda: _per_database(lambda controller, pool: pool.checkedout()))
+metrics.Gauge("pool_open_connections", "Open connections in the SQLAlchemy pool (idle + checked out)", ("database",),
+              callback=lambda: _per_database(lambda controller, pool: pool.checkedout() + pool.checkedin()))
+
+
+def install(engine, name: str = "default") -> Optional[AimdController]:
+    """Create the gate and controller for the engine's pool (no-op if POOL_ADAPTIVE=0)."""
+    if not POOL_ADAPTIVE:
+        return None
+    low = max(1, min(POOL_LIMIT_MIN, POOL_LIMIT_MAX))
+    gate = ConcurrencyGate(min(max(POOL_LIMIT_INITIAL, low), POOL_LIMIT_MAX), name=name)
+    controller = AimdController(gate, low=low, high=POOL_LIMIT_MAX)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def _handle_error(exception_context):
+        controller.observe_error(exception_context.original_exception)
+
+    controllers[name] = controller
+    _pools[name] = engine.sync_engine.pool
+    return controller
+
+
+@asynccontextmanager
+async def slot(controller: Optional[AimdController] = None):
+    if controller is None:
+        yield
+        return
+    token = _current.set(controller)
+    try:
+        try:
+            await controller.gate.acquire()
+        except asyncio.TimeoutError as e:
+            # Только ожидание слота: ошибки драйвера и запросов внутри тела контроллер видит
+            # через handle_error, таймаут QueuePool - через observe_error в repository._checkout
+            controller.observe_error(e)
+            raise
+        try:
+            yield
+        finally:
+            await controller.gate.release()
+    finally:
+        _current.reset(token)
+
+
+def observe_error(error: BaseException):
+    controller = _current.get()
+    if controller is not None:
+        controller.observe_error(error)
+
+
+def observe_checkout(seconds: float):
+    controller = _current.get()
+    if controller is not None:
+        controller.observe_checkout(seconds)
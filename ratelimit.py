@@ -0,0 +1,214 @@
+"""Token-bucket rate limiting by patient code and client IP.
+
+Every request spends one token from the bucket of its patient code and one
+from the bucket of its client IP; reads (GET /get*, GET /changes) and writes
+(POST /send*) have separate budgets. The check runs in middleware, before the
+handler takes a pooled connection or creates a patients row.
+
+Buckets live in process memory by default. With several replicas set
+RATE_LIMIT_REDIS_URL (needs the optional `redis` package) so all replicas
+share one set of buckets; if Redis is unreachable requests are let through
+and counted in metrics rather than failing the API.
+
+Configuration (env), budgets as "<requests per minute>:<burst>":
+- RATE_LIMIT_ENABLED=0 turns the limiter off
+- RATE_LIMIT_PATIENT_WRITE (default 60:30), RATE_LIMIT_PATIENT_READ (120:60)
+- RATE_LIMIT_IP_WRITE (600:120), RATE_LIMIT_IP_READ (1200:300)
+- RATE_LIMIT_PROXY_HOPS: number of reverse proxies in front of the app that
+  append to X-Forwarded-For (default 0 = use the socket address)
+"""
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import metrics
+
+
+@dataclass(frozen=True)
+class Budget:
+    per_minute: float
+    burst: int
+
+    @property
+    def rate(self) -> float:
+        """Tokens per second."""
+        return self.per_minute / 60.0
+
+    @classmethod
+    def parse(cls, value: str) -> "Budget":
+        per_minute, _, burst = value.partition(":")
+        per_minute = float(per_minute)
+        burst = int(burst) if burst else max(1, int(per_minute))
+        if per_minute <= 0 or burst < 1:
+            raise ValueError(f"Invalid rate limit budget '{value}'")
+        return cls(per_minute, burst)
+
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") != "0"
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "")
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "0"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+BUDGETS = {
+    ("patient", "write"): Budget.parse(os.getenv("RATE_LIMIT_PATIENT_WRITE", "60:30")),
+    ("patient", "read"): Budget.parse(os.getenv("RATE_LIMIT_PATIENT_READ", "120:60")),
+    ("ip", "write"): Budget.parse(os.getenv("RATE_LIMIT_IP_WRITE", "600:120")),
+    ("ip", "read"): Budget.parse(os.getenv("RATE_LIMIT_IP_READ", "1200:300")),
+}
+
+rejections_total = metrics.Counter(
+    "rate_limit_rejections_total", "Requests rejected with 429 by the rate limiter", ("scope", "kind")
+)
+backend_errors_total = metrics.Counter(
+    "rate_limit_backend_errors_total", "Shared rate limit backend failures (request let through)"
+)
+
+
+def request_kind(method: str, path: str) -> Optional[str]:
+    """'write' for submit endpoints, 'read' for data endpoints, None if not limited."""
+    if method == "POST" and path.startswith("/send"):
+        return "write"
+    if method == "GET" and (path.startswith("/get") or path == "/changes"):
+        return "read"
+    return None
+
+
+def client_ip(headers, peer: Optional[str]) -> str:
+    if RATE_LIMIT_PROXY_HOPS > 0:
+        forwarded = [part.strip() for part in headers.get("x-forwarded-for", "").split(",") if part.strip()]
+        # Каждый прокси дописывает адрес справа; левее доверенных прокси - то, что прислал клиент
+        if len(forwarded) >= RATE_LIMIT_PROXY_HOPS:
+            return forwarded[-RATE_LIMIT_PROXY_HOPS]
+    return peer or "unknown"
+
+
+class MemoryRateLimiter:
+    """Buckets in a bounded LRU dict; least recently used keys are dropped first
+    (a dropped bucket simply starts full again)."""
+
+    name = "memory"
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    async def acquire(self, key: str, budget: Budget) -> float:
+        """Take one token. Returns 0 if allowed, else seconds until a token is available."""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [float(budget.burst), now]
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(float(budget.burst), bucket[0] + (now - bucket[1]) * budget.rate)
+            bucket[1] = now
+        if bucket[0] >= 1.0:
+            bucket[0] -= 1.0
+            return 0.0
+        return (1.0 - bucket[0]) / budget.rate
+
+    async def refund(self, key: str, budget: Budget):
+        """Give back a token taken by acquire() (the request was rejected by another bucket)."""
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket[0] = min(float(budget.burst), bucket[0] + 1.0)
+
+
+# Атомарный token bucket на стороне Redis; время берём у Redis, чтобы реплики не зависели от своих часов
+_REDIS_TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+_REDIS_REFUND = """
+local burst = tonumber(ARGV[1])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+if tokens then
+  redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(burst, tokens + 1)))
+end
+return 0
+"""
+
+
+class RedisRateLimiter:
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = "lars:ratelimit:"):
+        import redis.asyncio as redis_asyncio  # optional dependency
+
+        self.prefix = prefix
+        self._client = redis_asyncio.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self._script = self._client.register_script(_REDIS_TOKEN_BUCKET)
+        self._refund = self._client.register_script(_REDIS_REFUND)
+
+    async def acquire(self, key: str, budget: Budget) -> float:
+        try:
+            wait = await self._script(keys=[self.prefix + key], args=[budget.rate, budget.burst])
+        except Exception as e:
+            backend_errors_total.inc()
+            print(f"Rate limit backend error, allowing request: {type(e).__name__}: {e}")
+            return 0.0
+        return float(wait)
+
+    async def refund(self, key: str, budget: Budget):
+        try:
+            await self._refund(keys=[self.prefix + key], args=[budget.burst])
+        except Exception as e:
+            backend_errors_total.inc()
+            print(f"Rate limit backend error on refund: {type(e).__name__}: {e}")
+
+
+def create_limiter():
+    if not RATE_LIMIT_ENABLED:
+        return None
+    if RATE_LIMIT_REDIS_URL:
+        try:
+            limiter = RedisRateLimiter(RATE_LIMIT_REDIS_URL)
+            print("Rate limiting: shared Redis buckets")
+            return limiter
+        except ImportError:
+            print("Warning: RATE_LIMIT_REDIS_URL is set but the redis package is not installed; "
+                  "using per-process rate limiting")
+    return MemoryRateLimiter()
+
+
+async def check(limiter, kind: str, patient_code: Optional[str], ip: str) -> Optional[tuple]:
+    """Spend tokens for one request. Returns (scope, retry_after_seconds) when rejected.
+
+    A rejected request spends nothing: tokens already taken from the earlier
+    buckets are given back, so one noisy patient does not drain the budget of
+    the other patients behind the same IP."""
+    keys = [("ip", ip)]
+    if patient_code:
+        keys.append(("patient", patient_code))
+    spent = []
+    for scope, value in keys:
+        key, budget = f"{scope}:{kind}:{value}", BUDGETS[(scope, kind)]
+        wait = await limiter.acquire(key, budget)
+        if wait > 0:
+            for spent_key, spent_budget in spent:
+                await limiter.refund(spent_key, spent_budget)
+            rejections_total.inc(scope=scope, kind=kind)
+            return scope, wait
+        spent.append((key, budget))
+    return None
@@ -0,0 +1,1045 @@
+"""Data access layer for the LARS backend.
+
+Route handlers talk to a Repository. PostgresRepository runs the SQL against
+the configured database; MemoryRepository keeps everything in process memory
+with the same upsert (ON CONFLICT (patient_id, entry_date) DO UPDATE) and
+CHECK-constraint behaviour. The in-memory engine is meant for tests and for
+load-testing the FastAPI request path without database latency
+(STORAGE_BACKEND=memory); its data is lost on restart.
+
+DAILY_LAYOUT=compact is for databases migrated with
+migration_compact_daily_entries.sql: daily_entries is then a view over
+daily_entries_compact, and daily upserts write the compact table directly.
+"""
+import os
+import time
+import uuid
+import asyncio
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+import intake_analysis
+import pool_control
+import tracing
+
+
+# Таблицы опросников по типу опросника
+ENTRY_TABLES = {
+    "weekly": "weekly_entries",
+    "daily": "daily_entries",
+    "monthly": "monthly_entries",
+    "eq5d5l": "eq5d5l_entries",
+}
+
+# Метрики daily_entries, для которых считаются скользящие средние
+DAILY_TREND_METRICS = (
+    "stool_count",
+    "pads_used",
+    "bloating",
+    "impact_score",
+    "activity_interfere",
+    "bristol_scale",
+)
+DAILY_TREND_WINDOWS = {"7d": 7, "28d": 28}
+
+# Хранение дневника: wide - таблица daily_entries из schema.sql, compact - daily_entries_compact
+# за представлением daily_entries (migration_compact_daily_entries.sql)
+DAILY_LAYOUTS = ("wide", "compact")
+DAILY_LAYOUT = os.getenv("DAILY_LAYOUT", "wide")
+
+# Таблица с данными дневника при любой раскладке (VACUUM, ANALYZE, перенос строк между шардами)
+DAILY_TABLE_SQL = "SELECT COALESCE(to_regclass('daily_entries_compact'), to_regclass('daily_entries'))::TEXT"
+
+
+class ConstraintViolation(Exception):
+    """A value was rejected by a NOT NULL / CHECK constraint or could not be parsed."""
+
+
+@dataclass
+class QuestionnaireState:
+    """Everything getNextQuestionnaire needs about a patient."""
+
+    patient_id: object
+    created_date: Optional[date]
+    last_dates: dict  # questionnaire type -> last entry_date or None
+    eq5d5l_dates: list  # all eq5d5l entry dates, ascending
+    filled_today: set = field(default_factory=set)  # questionnaire types with an entry today
+
+
+class Repository(ABC):
+    """Storage operations used by the route handlers; all are scoped to one patient_code
+    except the cohort variant of get_intake_symptom_matrix."""
+
+    name = "abstract"
+
+    @abstractmethod
+    async def upsert_weekly(self, patient_code: str, entry: dict) -> str:
+        """Create the patient if needed and upsert a weekly_entries row; returns its id."""
+
+    @abstractmethod
+    async def upsert_daily(self, patient_code: str, entry: dict) -> str:
+        """Create the patient if needed and upsert a daily_entries row; returns its id."""
+
+    @abstractmethod
+    async def upsert_monthly(self, patient_code: str, entry: dict) -> str:
+        """Create the patient if needed and upsert a monthly_entries row; returns its id."""
+
+    @abstractmethod
+    async def upsert_eq5d5l(self, patient_code: str, entry: dict) -> str:
+        """Create the patient if needed and upsert an eq5d5l_entries row; returns its id."""
+
+    @abstractmethod
+    async def get_lars_series(self, patient_code: str, period: str) -> list:
+        """(first_entry_date, avg_score) per week/month/year, chronological."""
+
+    @abstractmethod
+    async def get_questionnaire_state(self, patient_code: str, today: date) -> Optional[QuestionnaireState]:
+        """Patient registration date and questionnaire history, or None if unknown."""
+
+    @abstractmethod
+    async def get_daily_trends(self, patient_code: str, since: date) -> list:
+        """Rolling daily metrics for each diary day >= since, as dicts with entry_date and
+        <metric>_mean_<window> / <metric>_count_<window> keys."""
+
+    @abstractmethod
+    async def get_intake_symptom_matrix(self, patient_code: Optional[str]) -> "intake_analysis.IntakeSymptomMatrix":
+        """Intake/symptom matrix for one patient, or the cohort if patient_code is None."""
+
+    @abstractmethod
+    async def get_eq5d5l_history(self, patient_code: str) -> Optional[tuple]:
+        """(patient created date, [(entry_date, mobility, self_care, usual_activities,
+        pain_discomfort, anxiety_depression, health_vas), ...]) or None if unknown."""
+
+    @abstractmethod
+    async def get_changes(self, patient_code: str, since: int, limit: int) -> list:
+        """Entries written after change_seq `since` as (kind, change_seq, entry dict without
+        patient_id), ordered by change_seq, at most `limit`. With since=0 the result starts with
+        the archived diary days (change_seq 0), which do not count towards `limit`."""
+
+
+# ==========================================
+# PostgreSQL
+# ==========================================
+
+# Первым делом транзакция записи берёт advisory-блокировку пациента (до COMMIT), и только потом
+# запись получает change_seq: иначе при параллельных sendDaily/sendWeekly одного пациента номер N+1
+# мог бы закоммититься раньше N, и GET /changes, вернув курсор N+1, никогда не отдал бы строку N.
+# Тот же ключ берёт scripts/rebalance_shards.py на целевом шарде.
+UPSERT_PATIENT_SQL = text("""
+    INSERT INTO patients (patient_code)
+    SELECT :code FROM (SELECT pg_advisory_xact_lock(hashtextextended(:code, 0))) AS patient_write_lock
+    ON CONFLICT (patient_code) DO UPDATE SET patient_code = EXCLUDED.patient_code
+    RETURNING id
+""")
+
+# ON CONFLICT DO UPDATE берёт change_seq/updated_at из DEFAULT новой строки (EXCLUDED), и
+# GET /changes отдаёт изменённую строку снова
+UPSERT_WEEKLY_SQL = text("""
+    INSERT INTO weekly_entries (
+        patient_id, entry_date,
+        flatus_control, liquid_stool_leakage, bowel_frequency,
+        repeat_bowel_opening, urgency_to_toilet, total_score
+    ) VALUES (
+        :patient_id,
+        COALESCE(CAST(:entry_date AS DATE), CURRENT_DATE),
+        :flatus_control, :liquid_stool_leakage, :bowel_frequency,
+        :repeat_bowel_opening, :urgency_to_toilet, :total_score
+    )
+    ON CONFLICT (patient_id, entry_date) DO UPDATE SET
+        flatus_control = EXCLUDED.flatus_control,
+        liquid_stool_leakage = EXCLUDED.liquid_stool_leakage,
+        bowel_frequency = EXCLUDED.bowel_frequency,
+        repeat_bowel_opening = EXCLUDED.repeat_bowel_opening,
+        urgency_to_toilet = EXCLUDED.urgency_to_toilet,
+        total_score = EXCLUDED.total_score,
+        updated_at = EXCLUDED.updated_at,
+        change_seq = EXCLUDED.change_seq
+    RETURNING id, entry_date
+""")
+
+UPSERT_DAILY_SQL = text("""
+    INSERT INTO daily_entries (
+        patient_id, entry_date, bristol_scale,
+        stool_count, pads_used, urgency, night_stools, leakage,
+        incomplete_evacuation, bloating, impact_score, activity_interfere,
+        food_vegetables_all, food_root_vegetables, food_whole_grains,
+        food_whole_grain_bread, food_nuts_and_seeds, food_legumes,
+        food_fruits_with_skin, food_berries, food_soft_fruits_no_skin,
+        food_muesli_and_bran,
+        drink_water, drink_coffee, drink_tea, drink_alcohol,
+        drink_carbonated, drink_juices, drink_dairy, drink_energy
+    ) VALUES (
+        :patient_id,
+        COALESCE(CAST(:entry_date AS DATE), CURRENT_DATE),
+        :bristol_scale,
+        :stool_count, :pads_used, :urgency, :night_stools, :leakage,
+        :incomplete_evacuation, :bloating, :impact_score, :activity_interfere,
+        :food_vegetables_all, :food_root_vegetables, :food_whole_grains,
+        :food_whole_grain_bread, :food_nuts_and_seeds, :food_legumes,
+        :food_fruits_with_skin, :food_berries, :food_soft_fruits_no_skin,
+        :food_muesli_and_bran,
+        :drink_water, :drink_coffee, :drink_tea, :drink_alcohol,
+        :drink_carbonated, :drink_juices, :drink_dairy, :drink_energy
+    )
+    ON CONFLICT (patient_id, entry_date) DO UPDATE SET
+        bristol_scale = EXCLUDED.bristol_scale,
+        stool_count = EXCLUDED.stool_count,
+        pads_used = EXCLUDED.pads_used,
+        urgency = EXCLUDED.urgency,
+        night_stools = EXCLUDED.night_stools,
+        leakage = EXCLUDED.leakage,
+        incomplete_evacuation = EXCLUDED.incomplete_evacuation,
+        bloating = EXCLUDED.bloating,
+        impact_score = EXCLUDED.impact_score,
+        activity_interfere = EXCLUDED.activity_interfere,
+        food_vegetables_all = EXCLUDED.food_vegetables_all,
+        food_root_vegetables = EXCLUDED.food_root_vegetables,
+        food_whole_grains = EXCLUDED.food_whole_grains,
+        food_whole_grain_bread = EXCLUDED.food_whole_grain_bread,
+        food_nuts_and_seeds = EXCLUDED.food_nuts_and_seeds,
+        food_legumes = EXCLUDED.food_legumes,
+        food_fruits_with_skin = EXCLUDED.food_fruits_with_skin,
+        food_berries = EXCLUDED.food_berries,
+        food_soft_fruits_no_skin = EXCLUDED.food_soft_fruits_no_skin,
+        food_muesli_and_bran = EXCLUDED.food_muesli_and_bran,
+        drink_water = EXCLUDED.drink_water,
+        drink_coffee = EXCLUDED.drink_coffee,
+        drink_tea = EXCLUDED.drink_tea,
+        drink_alcohol = EXCLUDED.drink_alcohol,
+        drink_carbonated = EXCLUDED.drink_carbonated,
+        drink_juices = EXCLUDED.drink_juices,
+        drink_dairy = EXCLUDED.drink_dairy,
+        drink_energy = EXCLUDED.drink_energy,
+        updated_at = EXCLUDED.updated_at,
+        change_seq = EXCLUDED.change_seq
+    RETURNING id, entry_date
+""")
+
+# DAILY_LAYOUT=compact: upsert прямо в daily_entries_compact (ON CONFLICT на представлении невозможен).
+# Те же ошибки, что у CHECK/NOT NULL широкой таблицы; intake - 0..255 на колонку.
+UPSERT_DAILY_COMPACT_SQL = text(f"""
+    INSERT INTO daily_entries_compact (
+        patient_id, entry_date, bristol_scale,
+        stool_count, pads_used, urgency, night_stools, leakage_code,
+        incomplete_evacuation, bloating_x100, impact_score_x100, activity_interfere_x100,
+        intake
+    ) VALUES (
+        :patient_id,
+        COALESCE(CAST(:entry_date AS DATE), CURRENT_DATE),
+        :bristol_scale,
+        :stool_count, :pads_used,
+        daily_yes_no(:urgency), daily_yes_no(:night_stools), daily_leakage_code(:leakage),
+        daily_yes_no(:incomplete_evacuation),
+        round(CAST(:bloating AS NUMERIC(5, 2)) * 100),
+        round(CAST(:impact_score AS NUMERIC(5, 2)) * 100),
+        round(CAST(:activity_interfere AS NUMERIC(5, 2)) * 100),
+        daily_intake_pack(CAST(ARRAY[{", ".join(":" + column for column in intake_analysis.INTAKE_COLUMNS)}] AS SMALLINT[]))
+    )
+    ON CONFLICT (patient_id, entry_date) DO UPDATE SET
+        bristol_scale = EXCLUDED.bristol_scale,
+        stool_count = EXCLUDED.stool_count,
+        pads_used = EXCLUDED.pads_used,
+        urgency = EXCLUDED.urgency,
+        night_stools = EXCLUDED.night_stools,
+        leakage_code = EXCLUDED.leakage_code,
+        incomplete_evacuation = EXCLUDED.incomplete_evacuation,
+        bloating_x100 = EXCLUDED.bloating_x100,
+        impact_score_x100 = EXCLUDED.impact_score_x100,
+        activity_interfere_x100 = EXCLUDED.activity_interfere_x100,
+        intake = EXCLUDED.intake,
+        updated_at = EXCLUDED.updated_at,
+        change_seq = EXCLUDED.change_seq
+    RETURNING id, entry_date
+""")
+
+UPSERT_MONTHLY_SQL = text("""
+    INSERT INTO monthly_entries (
+        patient_id, entry_date, qol_score,
+        avoid_travel, avoid_social, embarrassed, worry_notice,
+        depressed, control, satisfaction
+    ) VALUES (
+        :patient_id,
+        COALESCE(CAST(:entry_date AS DATE), CURRENT_DATE),
+        :qol_score,
+        :avoid_travel, :avoid_social, :embarrassed, :worry_notice,
+        :depressed, :control, :satisfaction
+    )
+    ON CONFLICT (patient_id, entry_date) DO UPDATE SET
+        qol_score = EXCLUDED.qol_score,
+        avoid_travel = EXCLUDED.avoid_travel,
+        avoid_social = EXCLUDED.avoid_social,
+        embarrassed = EXCLUDED.embarrassed,
+        worry_notice = EXCLUDED.worry_notice,
+        depressed = EXCLUDED.depressed,
+        control = EXCLUDED.control,
+        satisfaction = EXCLUDED.satisfaction,
+        updated_at = EXCLUDED.updated_at,
+        change_seq = EXCLUDED.change_seq
+    RETURNING id, entry_date
+""")
+
+UPSERT_EQ5D5L_SQL = text("""
+    INSERT INTO eq5d5l_entries (
+        patient_id, entry_date,
+        mobility, self_care, usual_activities,
+        pain_discomfort, anxiety_depression, health_vas
+    ) VALUES (
+        :patient_id,
+        COALESCE(CAST(:entry_date AS DATE), CURRENT_DATE),
+        :mobility, :self_care, :usual_activities,
+        :pain_discomfort, :anxiety_depression, :health_vas
+    )
+    ON CONFLICT (patient_id, entry_date) DO UPDATE SET
+        mobility = EXCLUDED.mobility,
+        self_care = EXCLUDED.self_care,
+        usual_activities = EXCLUDED.usual_activities,
+        pain_discomfort = EXCLUDED.pain_discomfort,
+        anxiety_depression = EXCLUDED.anxiety_depression,
+        health_vas = EXCLUDED.health_vas,
+        updated_at = EXCLUDED.updated_at,
+        change_seq = EXCLUDED.change_seq
+    RETURNING id, entry_date
+""")
+
+# Лента изменений (events.py): уведомление уходит подписчикам только после COMMIT
+NOTIFY_CHANNEL = "lars_changes"
+NOTIFY_CHANGE_SQL = text("""
+    SELECT pg_notify('lars_changes', json_build_object(
+        'seq', nextval('change_events_seq'),
+        'kind', CAST(:kind AS TEXT),
+        'patient_code', CAST(:code AS TEXT),
+        'entry_id', CAST(:entry_id AS TEXT),
+        'entry_date', CAST(:entry_date AS TEXT)
+    )::TEXT)
+""")
+
+LARS_WEEKLY_SQL = text("""
+    SELECT
+        DATE_TRUNC('week', we.entry_date) as period_start,
+        AVG(we.total_score)::INTEGER as avg_score,
+        MIN(we.entry_date) as first_entry_date
+    FROM weekly_entries we
+    INNER JOIN patients p ON p.id = we.patient_id
+    WHERE p.patient_code = :code
+        AND we.total_score IS NOT NULL
+    GROUP BY DATE_TRUNC('week', we.entry_date)
+    ORDER BY period_start DESC
+    LIMIT 5
+""")
+
+LARS_MONTHLY_SQL = text("""
+    SELECT
+        DATE_TRUNC('month', we.entry_date) as period_start,
+        AVG(we.total_score)::INTEGER as avg_score,
+        MIN(we.entry_date) as first_entry_date
+    FROM weekly_entries we
+    INNER JOIN patients p ON p.id = we.patient_id
+    WHERE p.patient_code = :code
+        AND we.total_score IS NOT NULL
+        AND we.entry_date >= CURRENT_DATE - INTERVAL '6 months'
+    GROUP BY DATE_TRUNC('month', we.entry_date)
+    ORDER BY period_start ASC
+""")
+
+LARS_YEARLY_SQL = text("""
+    SELECT
+        DATE_TRUNC('year', we.entry_date) as period_start,
+        AVG(we.total_score)::INTEGER as avg_score,
+        MIN(we.entry_date) as first_entry_date
+    FROM weekly_entries we
+    INNER JOIN patients p ON p.id = we.patient_id
+    WHERE p.patient_code = :code
+        AND we.total_score IS NOT NULL
+        AND we.entry_date >= CURRENT_DATE - INTERVAL '5 years'
+    GROUP BY DATE_TRUNC('year', we.entry_date)
+    ORDER BY period_start ASC
+""")
+
+LARS_SQL = {"weekly": LARS_WEEKLY_SQL, "monthly": LARS_MONTHLY_SQL, "yearly": LARS_YEARLY_SQL}
+
+# Optimized: all patient data, last completion dates, EQ-5D-5L dates and
+# "filled today" flags in ONE query
+QUESTIONNAIRE_STATE_SQL = text("""
+    SELECT
+        p.id,
+        p.created_at::DATE as patient_created_date,
+        (SELECT MAX(entry_date) FROM weekly_entries WHERE patient_id = p.id) as last_weekly_date,
+        (SELECT MAX(entry_date) FROM monthly_entries WHERE patient_id = p.id) as last_monthly_date,
+        (SELECT MAX(entry_date) FROM eq5d5l_entries WHERE patient_id = p.id) as last_eq5d5l_date,
+        (SELECT MAX(entry_date) FROM daily_entries WHERE patient_id = p.id) as last_daily_date,
+        ARRAY(SELECT entry_date FROM eq5d5l_entries WHERE patient_id = p.id ORDER BY entry_date) as eq5d5l_dates,
+        EXISTS (SELECT 1 FROM weekly_entries WHERE patient_id = p.id AND entry_date = :today) as weekly_today,
+        EXISTS (SELECT 1 FROM monthly_entries WHERE patient_id = p.id AND entry_date = :today) as monthly_today,
+        EXISTS (SELECT 1 FROM eq5d5l_entries WHERE patient_id = p.id AND entry_date = :today) as eq5d5l_today,
+        EXISTS (SELECT 1 FROM daily_entries WHERE patient_id = p.id AND entry_date = :today) as daily_today
+    FROM patients p
+    WHERE p.patient_code = :code
+""")
+
+
+def _daily_trends_sql():
+    # Окна RANGE по дате, а не ROWS: пропущенные дни не растягивают окно.
+    # Строки за 27 дней до since читаются только для заполнения 28-дневного окна.
+    # MATERIALIZED: колонки представления daily_entries (DAILY_LAYOUT=compact) вычисляются
+    # один раз на строку, а не заново в каждом окне.
+    rolling_columns = []
+    for metric in DAILY_TREND_METRICS:
+        for window in DAILY_TREND_WINDOWS:
+            rolling_columns.append(f"AVG({metric}) OVER w{window} AS {metric}_mean_{window}")
+            rolling_columns.append(f"COUNT({metric}) OVER w{window} AS {metric}_count_{window}")
+    return text(f"""
+        WITH series AS MATERIALIZED (
+            SELECT de.entry_date, {", ".join("de." + metric for metric in DAILY_TREND_METRICS)}
+            FROM daily_entries de
+            INNER JOIN patients p ON p.id = de.patient_id
+            WHERE p.patient_code = :code
+                AND de.entry_date >= CAST(:since AS DATE) - 27
+        ),
+        rolling AS (
+            SELECT
+                entry_date,
+                {", ".join(rolling_columns)}
+            FROM series
+            WINDOW
+                w7d AS (ORDER BY entry_date RANGE BETWEEN INTERVAL '6 days' PRECEDING AND CURRENT ROW),
+                w28d AS (ORDER BY entry_date RANGE BETWEEN INTERVAL '27 days' PRECEDING AND CURRENT ROW)
+        )
+        SELECT * FROM rolling
+        WHERE entry_date >= :since
+        ORDER BY entry_date ASC
+    """)
+
+
+DAILY_TRENDS_SQL = _daily_trends_sql()
+
+# Сырые строки для rolling_daily_trends, когда окно заходит в архив (archive.py)
+DAILY_SERIES_SQL = text(f"""
+    SELECT de.entry_date, {", ".join("de." + metric for metric in DAILY_TREND_METRICS)}
+    FROM daily_entries de
+    INNER JOIN patients p ON p.id = de.patient_id
+    WHERE p.patient_code = :code
+        AND de.entry_date >= :since
+    ORDER BY de.entry_date ASC
+""")
+
+# Optimized: patient registration date and all entries in ONE query
+EQ5D5L_HISTORY_SQL = text("""
+    SELECT
+        p.created_at::DATE as patient_created_date,
+        e.entry_date,
+        e.mobility, e.self_care, e.usual_activities,
+        e.pain_discomfort, e.anxiety_depression,
+        e.health_vas
+    FROM patients p
+    LEFT JOIN eq5d5l_entries e ON e.patient_id = p.id
+    WHERE p.patient_code = :code
+    ORDER BY e.entry_date ASC
+""")
+
+
+def _changes_sql():
+    # GET /changes: строки пациента после курсора по индексу (patient_id, change_seq) каждой таблицы.
+    # Каждая ветка отдаёт не больше :limit строк, общий порядок - по change_seq.
+    branches = [
+        f"""(SELECT '{kind}' AS kind, e.change_seq, to_jsonb(e) - 'patient_id' - 'change_seq' AS entry
+            FROM {table} e
+            WHERE e.patient_id = (SELECT id FROM patient) AND e.change_seq > :since
+            ORDER BY e.change_seq
+            LIMIT :limit)"""
+        for kind, table in ENTRY_TABLES.items()
+    ]
+    return text(f"""
+        WITH patient AS (SELECT id FROM patients WHERE patient_code = :code)
+        SELECT kind, change_seq, entry FROM (
+            {" UNION ALL ".join(branches)}
+        ) changes
+        ORDER BY change_seq
+        LIMIT :limit
+    """)
+
+
+CHANGES_SQL = _changes_sql()
+
+
+async def _checkout(session, **attributes):
+    started = time.perf_counter()
+    try:
+        with tracing.span("db.pool_checkout", **attributes):
+            await session.connection()
+    except PoolTimeoutError as e:
+        # Таймаут QueuePool до движка не доходит, handle_error его не видит
+        pool_control.observe_error(e)
+        raise
+    pool_control.observe_checkout(time.perf_counter() - started)
+
+
+async def _execute_with_retry(session, query, max_retries=3, initial_delay=0.5):
+    """Execute query with retry logic for transient errors"""
+    last_error = None
+    for attempt in range(max_retries):
+        try:
+            if not session.in_transaction():
+                # Ожидание соединения из пула - отдельный span (повторяется вместе с запросом)
+                await _checkout(session, attempt=attempt + 1)
+            result = await session.execute(query)
+            return result
+        except Exception as e:
+            error_str = str(e)
+            error_type = type(e).__name__
+            last_error = e
+
+            # Identify different error types
+            is_pool_error = (
+                "MaxClientsInSessionMode" in error_str or
+                "max clients reached" in error_str.lower() or
+                "pool" in error_str.lower() or
+                "connection" in error_str.lower() and "unavailable" in error_str.lower()
+            )
+
+            is_timeout = (
+                error_type == "TimeoutError" or
+                "timeout" in error_str.lower() or
+                "CancelledError" in error_type or
+                "asyncio.TimeoutError" in error_type
+            )
+
+            is_connection_error = (
+                "connection" in error_str.lower() and (
+                    "closed" in error_str.lower() or
+                    "lost" in error_str.lower() or
+                    "reset" in error_str.lower()
+                )
+            )
+
+            # Log the error
+            print(f"Database error on attempt {attempt + 1}/{max_retries}: {error_type}: {error_str[:200]}")
+
+            # Retry on pool errors and connection errors (transient)
+            if (is_pool_error or is_connection_error) and attempt < max_retries - 1:
+                # Exponential backoff: 0.5s, 1s, 2s
+                delay = initial_delay * (2 ** attempt)
+                print(f"Retrying after {delay}s...")
+                with tracing.span("db.retry_sleep", attempt=attempt + 1, delay_s=delay, reason=error_type):
+                    await asyncio.sleep(delay)
+                continue
+
+            # For timeouts, retry once more with longer delay
+            if is_timeout and attempt < max_retries - 1:
+                delay = initial_delay * (2 ** attempt) * 2  # Longer delay for timeouts
+                print(f"Timeout detected, retrying after {delay}s...")
+                with tracing.span("db.retry_sleep", attempt=attempt + 1, delay_s=delay, reason=error_type):
+                    await asyncio.sleep(delay)
+                continue
+
+            # Don't retry on other errors (syntax errors, constraint violations, etc.)
+            if not (is_pool_error or is_timeout or is_connection_error):
+                print(f"Non-retryable error: {error_type}: {error_str[:200]}")
+                raise
+
+            # If we're on the last attempt, raise the error
+            if attempt == max_retries - 1:
+                print(f"Max retries reached, failing with: {error_type}: {error_str[:200]}")
+                raise
+
+    # This shouldn't be reached, but just in case - raise the last error
+    if last_error:
+        raise last_error
+    # If we somehow got here without an error, something is wrong
+    raise Exception("_execute_with_retry completed without result or error")
+
+
+def _merge_archived(archived: list, live: list, key) -> list:
+    """Archived + live rows sorted by key; a live row replaces an archived one with the same key."""
+    merged = {key(row): row for row in archived}
+    merged.update((key(row), row) for row in live)
+    return [merged[k] for k in sorted(merged)]
+
+
+async def merge_archived_intake(archive, patient_code: Optional[str], live: list) -> list:
+    """Live matrix rows plus archived days of the patient (or cohort) that are not live.
+
+    Keyed by (patient_code, entry_date): an archived row keeps the patient_id of the shard it
+    was archived on, which differs after a rebalance into a shard that already had the patient."""
+    if archive is None or not archive.covers(None):
+        return live
+    columns = ("patient_code", "entry_date", "stool_count", "leakage", "urgency", "bloating") + intake_analysis.INTAKE_COLUMNS
+    with tracing.span("archive.read", table="daily_entries"):
+        archived = await asyncio.to_thread(archive.rows, patient_code, None, columns)
+    return _merge_archived(
+        [intake_analysis.matrix_row(record) for record in archived],
+        live,
+        key=lambda row: (row[0], row[1]),
+    )
+
+
+async def archived_daily_changes(archive, patient_code: str) -> list:
+    """Archived diary days of the patient as /changes rows with change_seq 0 (they have no number)."""
+    if archive is None or not archive.covers(None):
+        return []
+    with tracing.span("archive.read", table="daily_entries"):
+        archived = await asyncio.to_thread(archive.rows, patient_code)
+    # В архиве нет updated_at: последнее изменение строки было до архивации
+    return [
+        ("daily", 0, {**{key: value for key, value in record.items() if key not in ("patient_id", "patient_code")},
+                      "updated_at": record["created_at"]})
+        for record in archived
+    ]
+
+
+class PostgresRepository(Repository):
+    name = "postgres"
+
+    def __init__(self, session_factory, notify_changes: bool = False, archive=None, pool_controller=None,
+                 daily_layout: str = DAILY_LAYOUT):
+        if daily_layout not in DAILY_LAYOUTS:
+            raise ValueError(f"DAILY_LAYOUT must be one of {', '.join(DAILY_LAYOUTS)}, got {daily_layout!r}")
+        self.session_factory = session_factory
+        self.notify_changes = notify_changes
+        # archive.DailyArchive: старые daily_entries в Parquet, читаются вместе с живыми строками
+        self.archive = archive
+        # pool_control.AimdController движка этой базы (None - без адаптивного лимита)
+        self.pool_controller = pool_controller
+        self.upsert_daily_sql = UPSERT_DAILY_COMPACT_SQL if daily_layout == "compact" else UPSERT_DAILY_SQL
+
+    @asynccontextmanager
+    async def _session(self):
+        # Слот адаптивного лимита (pool_control) берётся до соединения из пула
+        async with pool_control.slot(self.pool_controller):
+            async with self.session_factory() as session:
+                yield session
+
+    async def _upsert(self, kind: str, patient_code: str, statement, entry: dict) -> str:
+        async with self._session() as session:
+            async with session.begin():
+                await _checkout(session)
+                res = await session.execute(UPSERT_PATIENT_SQL.bindparams(code=patient_code))
+                patient_id = res.first()[0]
+                res2 = await session.execute(statement.bindparams(patient_id=patient_id, **entry))
+                row2 = res2.first()
+                if self.notify_changes:
+                    await session.execute(NOTIFY_CHANGE_SQL.bindparams(
+                        kind=kind, code=patient_code, entry_id=str(row2[0]), entry_date=row2[1].isoformat()
+                    ))
+        return str(row2[0])
+
+    async def upsert_weekly(self, patient_code: str, entry: dict) -> str:
+        return await self._upsert("weekly", patient_code, UPSERT_WEEKLY_SQL, entry)
+
+    async def upsert_daily(self, patient_code: str, entry: dict) -> str:
+        return await self._upsert("daily", patient_code, self.upsert_daily_sql, entry)
+
+    async def upsert_monthly(self, patient_code: str, entry: dict) -> str:
+        return await self._upsert("monthly", patient_code, UPSERT_MONTHLY_SQL, entry)
+
+    async def upsert_eq5d5l(self, patient_code: str, entry: dict) -> str:
+        return await self._upsert("eq5d5l", patient_code, UPSERT_EQ5D5L_SQL, entry)
+
+    async def get_lars_series(self, patient_code: str, period: str) -> list:
+        async with self._session() as session:
+            result = await _execute_with_retry(session, LARS_SQL[period].bindparams(code=patient_code))
+            rows = result.fetchall()
+        # Reverse if ordered DESC to get chronological order
+        if period == "weekly":
+            rows = list(reversed(rows))
+        return [(row[2], row[1]) for row in rows]
+
+    async def get_questionnaire_state(self, patient_code: str, today: date) -> Optional[QuestionnaireState]:
+        async with self._session() as session:
+            result = await _execute_with_retry(
+                session, QUESTIONNAIRE_STATE_SQL.bindparams(code=patient_code, today=today)
+            )
+            row = result.first()
+        if not row:
+            return None
+        last_daily = row[5]
+        if last_daily is None and self.archive is not None and self.archive.covers(None):
+            last_daily = await asyncio.to_thread(self.archive.last_entry_date, patient_code)
+        return QuestionnaireState(
+            patient_id=row[0],
+            created_date=row[1],
+            last_dates={"weekly": row[2], "monthly": row[3], "eq5d5l": row[4], "daily": last_daily},
+            eq5d5l_dates=list(row[6] or []),
+            filled_today={
+                kind for kind, filled in zip(("weekly", "monthly", "eq5d5l", "daily"), row[7:11]) if filled
+            },
+        )
+
+    async def get_daily_trends(self, patient_code: str, since: date) -> list:
+        window_start = since - timedelta(days=max(DAILY_TREND_WINDOWS.values()) - 1)
+        if self.archive is None or not self.archive.covers(window_start):
+            async with self._session() as session:
+                result = await _execute_with_retry(
+                    session, DAILY_TRENDS_SQL.bindparams(code=patient_code, since=since)
+                )
+                return [dict(row) for row in result.mappings().fetchall()]
+
+        # Окно заходит в архив: склеиваем архив и живые строки и считаем окна в Python
+        async with self._session() as session:
+            result = await _execute_with_retry(
+                session, DAILY_SERIES_SQL.bindparams(code=patient_code, since=window_start)
+            )
+            live = [dict(row) for row in result.mappings().fetchall()]
+        with tracing.span("archive.read", table="daily_entries"):
+            archived = await asyncio.to_thread(
+                self.archive.rows, patient_code, window_start, ("entry_date",) + DAILY_TREND_METRICS
+            )
+        rows = _merge_archived(archived, live, key=lambda row: row["entry_date"])
+        return rolling_daily_trends(rows, since)
+
+    async def get_intake_rows(self, patient_code: Optional[str], include_archive: bool = True) -> list:
+        """Matrix rows (intake_analysis._SELECT_MATRIX) of one patient or the cohort, with archived days."""
+        async with self._session() as session:
+            await _checkout(session)
+            live = await intake_analysis.load_rows(session, patient_code)
+        if not include_archive:
+            return live
+        return await merge_archived_intake(self.archive, patient_code, live)
+
+    async def get_intake_symptom_matrix(self, patient_code: Optional[str]) -> "intake_analysis.IntakeSymptomMatrix":
+        return intake_analysis.IntakeSymptomMatrix.from_rows(await self.get_intake_rows(patient_code))
+
+    async def get_eq5d5l_history(self, patient_code: str) -> Optional[tuple]:
+        async with self._session() as session:
+            result = await _execute_with_retry(session, EQ5D5L_HISTORY_SQL.bindparams(code=patient_code))
+            rows = result.fetchall()
+        if not rows:
+            return None
+        return rows[0][0], [tuple(row[1:]) for row in rows if row[1] is not None]
+
+    async def get_changes(self, patient_code: str, since: int, limit: int) -> list:
+        async with self._session() as session:
+            result = await _execute_with_retry(
+                session, CHANGES_SQL.bindparams(code=patient_code, since=since, limit=limit)
+            )
+            changes = [tuple(row) for row in result.fetchall()]
+        if since:
+            return changes
+        # Полная загрузка: сначала архивные дни (без номера), живая строка той же даты придёт позже и заменит их
+        return await archived_daily_changes(self.archive, patient_code) + changes
+
+
+# ==========================================
+# In-memory
+# ==========================================
+
+def _between(low, high):
+    return ("BETWEEN", low, high)
+
+
+def _one_of(*allowed):
+    return ("IN",) + allowed
+
+
+def _numeric(precision: int, scale: int) -> str:
+    return f"NUMERIC({precision}, {scale})"
+
+
+SMALLINT_RANGE = (-32768, 32767)
+
+
+def _coerce(sql_type: str, value):
+    """Value as Postgres stores it in a column of sql_type (asyncpg binds int/float/Decimal
+    to numeric columns, bool and str are rejected); raises ConstraintViolation like Postgres."""
+    if sql_type == "TEXT":
+        return value
+    if isinstance(value, bool) or not isinstance(value, (int, float, Decimal)):
+        raise ConstraintViolation(f"invalid input for query argument: {value!r} ({sql_type} expected)")
+    try:
+        if sql_type == "SMALLINT":
+            # float8 -> smallint округляет к чётному (rint)
+            number = value if isinstance(value, int) else round(value)
+            if not SMALLINT_RANGE[0] <= number <= SMALLINT_RANGE[1]:
+                raise ConstraintViolation("smallint out of range")
+            return number
+        precision, scale = (int(part) for part in sql_type[len("NUMERIC("):-1].split(","))
+        number = Decimal(str(value)).quantize(Decimal(1).scaleb(-scale), rounding=ROUND_HALF_UP)
+    except (OverflowError, ValueError, ArithmeticError):
+        raise ConstraintViolation(f"invalid input for type {sql_type}: {value!r}")
+    if number.is_nan():
+        return float(number)
+    if abs(number) >= Decimal(10) ** (precision - scale):
+        raise ConstraintViolation("numeric field overflow")
+    return float(number)
+
+
+def _passes(check, value) -> bool:
+    operator, *operands = check
+    if operator == "BETWEEN":
+        return operands[0] <= value <= operands[1]
+    return value in operands
+
+
+# Колонки таблиц - точная копия schema.sql (tests/test_memory_constraints.py сверяет):
+# column -> (тип, nullable, CHECK)
+_DAILY_COLUMNS = {
+    "bristol_scale": ("SMALLINT", True, _between(1, 7)),
+    "stool_count": ("SMALLINT", False, None),
+    "pads_used": ("SMALLINT", False, None),
+    "urgency": ("TEXT", False, _one_of("Yes", "No")),
+    "night_stools": ("TEXT", False, _one_of("Yes", "No")),
+    "leakage": ("TEXT", False, _one_of("None", "Liquid", "Solid")),
+    "incomplete_evacuation": ("TEXT", False, _one_of("Yes", "No")),
+    "bloating": (_numeric(5, 2), False, None),
+    "impact_score": (_numeric(5, 2), False, None),
+    "activity_interfere": (_numeric(5, 2), False, None),
+}
+_DAILY_COLUMNS.update({column: ("SMALLINT", False, None) for column in intake_analysis.INTAKE_COLUMNS})
+
+TABLE_COLUMNS = {
+    "weekly_entries": {
+        "flatus_control": ("SMALLINT", False, _between(0, 2)),
+        "liquid_stool_leakage": ("SMALLINT", False, _between(0, 2)),
+        "bowel_frequency": ("SMALLINT", False, _between(0, 3)),
+        "repeat_bowel_opening": ("SMALLINT", False, _between(0, 2)),
+        "urgency_to_toilet": ("SMALLINT", False, _between(0, 2)),
+        "total_score": ("SMALLINT", True, None),
+    },
+    "daily_entries": _DAILY_COLUMNS,
+    "monthly_entries": {
+        "qol_score": ("SMALLINT", True, None),
+        "avoid_travel": (_numeric(3, 1), False, _between(1, 4)),
+        "avoid_social": (_numeric(3, 1), False, _between(1, 4)),
+        "embarrassed": (_numeric(3, 1), False, _between(1, 4)),
+        "worry_notice": (_numeric(3, 1), False, _between(1, 4)),
+        "depressed": (_numeric(3, 1), False, _between(1, 4)),
+        "control": (_numeric(4, 1), False, _between(0, 10)),
+        "satisfaction": (_numeric(4, 1), False, _between(0, 10)),
+    },
+    "eq5d5l_entries": {
+        "mobility": ("SMALLINT", False, _between(0, 4)),
+        "self_care": ("SMALLINT", False, _between(0, 4)),
+        "usual_activities": ("SMALLINT", False, _between(0, 4)),
+        "pain_discomfort": ("SMALLINT", False, _between(0, 4)),
+        "anxiety_depression": ("SMALLINT", False, _between(0, 4)),
+        "health_vas": ("SMALLINT", True, _between(0, 100)),
+    },
+}
+
+
+def _round_half_up(value) -> int:
+    """Same rounding as Postgres numeric::INTEGER."""
+    return int(Decimal(str(value)).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def _months_ago(day: date, months: int) -> date:
+    """day - INTERVAL 'N months' (clamped to the end of shorter months)."""
+    month_index = day.year * 12 + day.month - 1 - months
+    year, month = divmod(month_index, 12)
+    month += 1
+    next_month = date(year + (month == 12), month % 12 + 1, 1)
+    return date(year, month, min(day.day, (next_month - timedelta(days=1)).day))
+
+
+def rolling_daily_trends(rows: list, since: date) -> list:
+    """Python version of DAILY_TRENDS_SQL over [{"entry_date": ..., <metric>: ...}, ...]
+    sorted by entry_date; rows before `since` only feed the windows."""
+    dates = [row["entry_date"] for row in rows]
+    out = []
+    for pos in range(bisect_left(dates, since), len(rows)):
+        current = dates[pos]
+        point = {"entry_date": current}
+        for window, days in DAILY_TREND_WINDOWS.items():
+            window_rows = rows[bisect_left(dates, current - timedelta(days=days - 1)):pos + 1]
+            for metric in DAILY_TREND_METRICS:
+                values = [row[metric] for row in window_rows if row[metric] is not None]
+                point[f"{metric}_mean_{window}"] = (
+                    sum(Decimal(str(v)) for v in values) / len(values) if values else None
+                )
+                point[f"{metric}_count_{window}"] = len(values)
+        out.append(point)
+    return out
+
+
+class MemoryRepository(Repository):
+    name = "memory"
+
+    def __init__(self):
+        self.patients = {}  # patient_code -> {"id", "patient_code", "created_at"}
+        # table -> patient_id -> entry_date -> row
+        self.tables = {table: {} for table in TABLE_COLUMNS}
+        # Лента изменений: on_change(event) после каждой записи, seq как у change_events_seq
+        self.on_change = None
+        self.change_seq = 0
+        # Номера изменений строк как у entry_change_seq (GET /changes)
+        self.entry_change_seq = 0
+
+    def _validate(self, table: str, entry: dict) -> tuple:
+        values = {}
+        for column, (sql_type, nullable, check) in TABLE_COLUMNS[table].items():
+            value = entry.get(column)
+            if value is None:
+                if not nullable:
+                    raise ConstraintViolation(
+                        f'null value in column "{column}" of relation "{table}" violates not-null constraint'
+                    )
+            else:
+                value = _coerce(sql_type, value)
+                if check is not None and not _passes(check, value):
+                    raise ConstraintViolation(
+                        f'new row for relation "{table}" violates check constraint "{table}_{column}_check"'
+                    )
+            values[column] = value
+        raw_date = entry.get("entry_date")
+        try:
+            entry_date = date.fromisoformat(raw_date) if raw_date else date.today()
+        except (TypeError, ValueError):
+            raise ConstraintViolation(f'invalid input syntax for type date: "{raw_date}"')
+        return entry_date, values
+
+    def _upsert(self, patient_code: str, table: str, entry: dict) -> str:
+        # Вся проверка до изменений - как откат транзакции при ошибке
+        if not 4 <= len(patient_code) <= 64:
+            raise ConstraintViolation('new row for relation "patients" violates check constraint "patients_patient_code_check"')
+        entry_date, values = self._validate(table, entry)
+        patient = self.patients.get(patient_code)
+        if patient is None:
+            patient = {"id": uuid.uuid4(), "patient_code": patient_code, "created_at": datetime.now(timezone.utc)}
+            self.patients[patient_code] = patient
+        rows = self.tables[table].setdefault(patient["id"], {})
+        row = rows.get(entry_date)
+        if row is None:
+            row = {"id": uuid.uuid4(), "patient_id": patient["id"], "entry_date": entry_date,
+                   "created_at": datetime.now(timezone.utc)}
+            rows[entry_date] = row
+        row.update(values)
+        self.entry_change_seq += 1
+        row["updated_at"] = datetime.now(timezone.utc)
+        row["change_seq"] = self.entry_change_seq
+        if self.on_change is not None:
+            self.change_seq += 1
+            self.on_change({
+                "seq": self.change_seq,
+                "kind": next(kind for kind, name in ENTRY_TABLES.items() if name == table),
+                "patient_code": patient_code,
+                "entry_id": str(row["id"]),
+                "entry_date": entry_date.isoformat(),
+            })
+        return str(row["id"])
+
+    def _rows(self, table: str, patient_code: str) -> list:
+        patient = self.patients.get(patient_code)
+        if patient is None:
+            return []
+        rows = self.tables[table].get(patient["id"], {})
+        return [rows[entry_date] for entry_date in sorted(rows)]
+
+    async def upsert_weekly(self, patient_code: str, entry: dict) -> str:
+        return self._upsert(patient_code, "weekly_entries", entry)
+
+    async def upsert_daily(self, patient_code: str, entry: dict) -> str:
+        return self._upsert(patient_code, "daily_entries", entry)
+
+    async def upsert_monthly(self, patient_code: str, entry: dict) -> str:
+        return self._upsert(patient_code, "monthly_entries", entry)
+
+    async def upsert_eq5d5l(self, patient_code: str, entry: dict) -> str:
+        return self._upsert(patient_code, "eq5d5l_entries", entry)
+
+    async def get_lars_series(self, patient_code: str, period: str) -> list:
+        today = date.today()
+        groups = {}
+        for row in self._rows("weekly_entries", patient_code):
+            entry_date = row["entry_date"]
+            if row["total_score"] is None:
+                continue
+            if period == "weekly":
+                period_start = entry_date - timedelta(days=entry_date.weekday())
+            elif period == "monthly":
+                if entry_date < _months_ago(today, 6):
+                    continue
+                period_start = entry_date.replace(day=1)
+            else:
+                if entry_date < _months_ago(today, 60):
+                    continue
+                period_start = entry_date.replace(month=1, day=1)
+            groups.setdefault(period_start, []).append(row)
+        starts = sorted(groups)
+        if period == "weekly":
+            starts = starts[-5:]
+        return [
+            (
+                min(row["entry_date"] for row in groups[start]),
+                _round_half_up(sum(Decimal(str(row["total_score"])) for row in groups[start]) / len(groups[start])),
+            )
+            for start in starts
+        ]
+
+    async def get_questionnaire_state(self, patient_code: str, today: date) -> Optional[QuestionnaireState]:
+        patient = self.patients.get(patient_code)
+        if patient is None:
+            return None
+        last_dates = {}
+        filled_today = set()
+        for kind, table in ENTRY_TABLES.items():
+            rows = self.tables[table].get(patient["id"], {})
+            last_dates[kind] = max(rows) if rows else None
+            if today in rows:
+                filled_today.add(kind)
+        return QuestionnaireState(
+            patient_id=patient["id"],
+            created_date=patient["created_at"].date(),
+            last_dates=last_dates,
+            eq5d5l_dates=sorted(self.tables["eq5d5l_entries"].get(patient["id"], {})),
+            filled_today=filled_today,
+        )
+
+    async def get_daily_trends(self, patient_code: str, since: date) -> list:
+        rows = [row for row in self._rows("daily_entries", patient_code)
+                if row["entry_date"] >= since - timedelta(days=27)]
+        return rolling_daily_trends(rows, since)
+
+    def _matrix_rows(self, patient_code: str, rows: dict) -> list:
+        out = []
+        for entry_date in sorted(rows):
+            row = rows[entry_date]
+            out.append(
+                (patient_code, entry_date)
+                + tuple(row[column] for column in intake_analysis.INTAKE_COLUMNS)
+                + (
+                    row["stool_count"],
+                    {"Liquid": 1, "Solid": 2}.get(row["leakage"], 0),
+                    1 if row["urgency"] == "Yes" else 0,
+                    float(row["bloating"]),
+                )
+            )
+        return out
+
+    async def get_intake_symptom_matrix(self, patient_code: Optional[str]) -> "intake_analysis.IntakeSymptomMatrix":
+        daily = self.tables["daily_entries"]
+        if patient_code is None:
+            rows = []
+            for code, patient in sorted(self.patients.items()):
+                rows.extend(self._matrix_rows(code, daily.get(patient["id"], {})))
+        else:
+            patient = self.patients.get(patient_code)
+            rows = self._matrix_rows(patient_code, daily.get(patient["id"], {})) if patient else []
+        return intake_analysis.IntakeSymptomMatrix.from_rows(rows)
+
+    async def get_eq5d5l_history(self, patient_code: str) -> Optional[tuple]:
+        patient = self.patients.get(patient_code)
+        if patient is None:
+            return None
+        entries = [
+            (row["entry_date"], row["mobility"], row["self_care"], row["usual_activities"],
+             row["pain_discomfort"], row["anxiety_depression"], row["health_vas"])
+            for row in self._rows("eq5d5l_entries", patient_code)
+        ]
+        return patient["created_at"].date(), entries
+
+    async def get_changes(self, patient_code: str, since: int, limit: int) -> list:
+        changes = [
+            (kind, row["change_seq"], {key: value for key, value in row.items()
+                                       if key not in ("patient_id", "change_seq")})
+            for kind, table in ENTRY_TABLES.items()
+            for row in self._rows(table, patient_code)
+            if row["change_seq"] > since
+        ]
+        return sorted(changes, key=lambda change: change[1])[:limit]
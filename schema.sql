@@ -10,6 +10,10 @@ CREATE TABLE patients (
   created_at TIMESTAMPTZ NOT NULL DEFAULT now()
 );
 
+-- Номер последнего изменения строки опросника (GET /changes): общий для всех четырёх таблиц,
+-- ON CONFLICT DO UPDATE выдаёт строке новый номер и updated_at
+CREATE SEQUENCE entry_change_seq;
+
 -- Weekly (LARS) опросник - все поля уже отдельные
 CREATE TABLE weekly_entries (
   id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
@@ -24,10 +28,13 @@ CREATE TABLE weekly_entries (
   total_score SMALLINT,
   
   created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  change_seq BIGINT NOT NULL DEFAULT nextval('entry_change_seq'),
   UNIQUE (patient_id, entry_date)
 );
 
 -- Daily опросник - все поля отдельные
+-- (компактная раскладка с представлением daily_entries: migration_compact_daily_entries.sql, DAILY_LAYOUT=compact)
 CREATE TABLE daily_entries (
   id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
   patient_id UUID NOT NULL REFERENCES patients(id) ON DELETE CASCADE,
@@ -68,6 +75,8 @@ CREATE TABLE daily_entries (
   drink_energy SMALLINT NOT NULL DEFAULT 0,
   
   created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  change_seq BIGINT NOT NULL DEFAULT nextval('entry_change_seq'),
   UNIQUE (patient_id, entry_date)
 );
 
@@ -87,6 +96,8 @@ CREATE TABLE monthly_entries (
   satisfaction NUMERIC(4, 1) NOT NULL DEFAULT 0 CHECK (satisfaction BETWEEN 0 AND 10),
   
   created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  change_seq BIGINT NOT NULL DEFAULT nextval('entry_change_seq'),
   UNIQUE (patient_id, entry_date)
 );
 
@@ -105,12 +116,20 @@ CREATE TABLE eq5d5l_entries (
   health_vas SMALLINT CHECK (health_vas BETWEEN 0 AND 100),
   
   created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  change_seq BIGINT NOT NULL DEFAULT nextval('entry_change_seq'),
   UNIQUE (patient_id, entry_date)
 );
 
--- Индексы
-CREATE INDEX idx_patients_code ON patients (patient_code);
-CREATE INDEX idx_weekly_patient_date ON weekly_entries (patient_id, entry_date DESC);
-CREATE INDEX idx_daily_patient_date ON daily_entries (patient_id, entry_date DESC);
-CREATE INDEX idx_monthly_patient_date ON monthly_entries (patient_id, entry_date DESC);
-CREATE INDEX idx_eq5d5l_patient_date ON eq5d5l_entries (patient_id, entry_date DESC);
+-- Индексы: отдельные не нужны - UNIQUE (patient_code) и UNIQUE (patient_id, entry_date)
+-- уже создают B-tree, который обслуживает поиск по коду и выборки пациента по дате
+-- в обе стороны (см. migration_drop_redundant_indexes.sql, scripts/index_audit.py)
+
+-- Delta-синхронизация: строки пациента после курсора клиента (GET /changes)
+CREATE INDEX weekly_entries_changes_idx ON weekly_entries (patient_id, change_seq);
+CREATE INDEX daily_entries_changes_idx ON daily_entries (patient_id, change_seq);
+CREATE INDEX monthly_entries_changes_idx ON monthly_entries (patient_id, change_seq);
+CREATE INDEX eq5d5l_entries_changes_idx ON eq5d5l_entries (patient_id, change_seq);
+
+-- Номера событий ленты изменений (GET /events, pg_notify 'lars_changes')
+CREATE SEQUENCE change_events_seq;
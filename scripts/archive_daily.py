@@ -0,0 +1,138 @@
+"""Move daily_entries older than the horizon into the Parquet archive (archive.py).
+
+Runs month by month, oldest first. For each month, inside one transaction:
+1. lock the month's live rows (SELECT ... FOR UPDATE), so a concurrent edit
+   of an old day waits and then lands as a new live row
+2. merge them into DAILY_ARCHIVE_DIR/daily_entries/YYYY-MM.parquet
+3. move `archived_before` in the manifest past the month
+4. delete exactly the locked rows and commit
+A crash between 2 and 4 leaves rows both archived and live, which reads
+handle (live wins) and the next run merges again.
+
+With DATABASE_SHARD_URLS (sharding.py) every shard is archived in turn into
+the same archive; the manifest records each shard's progress under "shards",
+and `archived_before` only moves forward, so a shard that failed or lags
+behind still has its rows live.
+
+Usage:
+    DAILY_ARCHIVE_DIR=/data/archive python scripts/archive_daily.py --horizon-months 12
+    DATABASE_SHARD_URLS="a=postgresql://...,b=postgresql://..." python scripts/archive_daily.py
+    python scripts/archive_daily.py --dry-run   # only list what would be moved
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import archive  # noqa: E402
+import repository  # noqa: E402
+import sharding  # noqa: E402
+
+
+MONTHS_SQL = """
+    SELECT date_trunc('month', entry_date)::DATE AS month, COUNT(*) AS n
+    FROM daily_entries
+    WHERE entry_date < $1
+    GROUP BY 1
+    ORDER BY 1
+"""
+
+LOCK_MONTH_SQL = """
+    SELECT de.*, p.patient_code
+    FROM daily_entries de
+    INNER JOIN patients p ON p.id = de.patient_id
+    WHERE de.entry_date >= $1 AND de.entry_date < $2
+    ORDER BY p.patient_code, de.entry_date
+    FOR UPDATE OF de
+"""
+
+DELETE_SQL = "DELETE FROM daily_entries WHERE id = ANY($1::UUID[])"
+
+
+def _plain_dsn(url: str) -> str:
+    for prefix in ("postgresql+asyncpg://", "postgres+asyncpg://"):
+        if url.startswith(prefix):
+            return "postgresql://" + url[len(prefix):]
+    return url
+
+
+def _to_table(store: archive.DailyArchive, records: list):
+    columns = {}
+    for name in store.columns:
+        values = [record[name] for record in records]
+        if name in ("id", "patient_id"):
+            values = [str(value) for value in values]
+        columns[name] = values
+    return archive.pa.table(columns, schema=store.schema)
+
+
+async def archive_shard(store: archive.DailyArchive, name: str, url: str, cutoff: date, args):
+    import asyncpg
+
+    conn = await asyncpg.connect(dsn=_plain_dsn(url))
+    try:
+        months = await conn.fetch(MONTHS_SQL, cutoff)
+        print(f"[{name}] cutoff {cutoff}: {len(months)} month(s), {sum(m['n'] for m in months):,} rows to archive")
+        if args.dry_run:
+            for month in months:
+                print(f"  {month['month']:%Y-%m}: {month['n']:,} rows")
+            return
+
+        for month in months:
+            start = month["month"]
+            end = archive.add_months(start, 1)
+            started = time.monotonic()
+            async with conn.transaction():
+                records = await conn.fetch(LOCK_MONTH_SQL, start, end)
+                if not records:
+                    continue
+                total = await asyncio.to_thread(store.write_month, start, _to_table(store, records))
+                store.set_archived_before(end, shard=name)
+                deleted = await conn.execute(DELETE_SQL, [record["id"] for record in records])
+            print(
+                f"[{name}] {start:%Y-%m}: archived {len(records):,} rows ({total:,} in file), {deleted}, "
+                f"{time.monotonic() - started:.1f}s"
+            )
+        store.set_archived_before(cutoff, shard=name)
+
+        if months and not args.no_vacuum:
+            await conn.execute(f"VACUUM ANALYZE {await conn.fetchval(repository.DAILY_TABLE_SQL)}")
+    finally:
+        await conn.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--horizon-months", type=int, default=archive.ARCHIVE_HORIZON_MONTHS,
+                        help="keep this many full months (plus the current one) in Postgres")
+    parser.add_argument("--dir", default=archive.DAILY_ARCHIVE_DIR, help="archive root (DAILY_ARCHIVE_DIR)")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--no-vacuum", action="store_true", help="skip VACUUM ANALYZE of the daily table at the end")
+    args = parser.parse_args()
+
+    # Как в app.py: DATABASE_SHARD_URLS важнее DATABASE_URL
+    shards = sharding.parse_shard_urls(sharding.DATABASE_SHARD_URLS)
+    if not shards and os.getenv("DATABASE_URL"):
+        shards = {"default": os.getenv("DATABASE_URL")}
+    if not shards:
+        print("DATABASE_URL (or DATABASE_SHARD_URLS) is not set")
+        return 1
+    if not args.dir:
+        print("DAILY_ARCHIVE_DIR is not set (or pass --dir)")
+        return 1
+    if args.horizon_months < 1:
+        print("--horizon-months must be at least 1")
+        return 1
+
+    store = archive.DailyArchive(args.dir)
+    cutoff = archive.add_months(archive.month_start(date.today()), -args.horizon_months)
+    for name, shard_url in shards.items():
+        await archive_shard(store, name, shard_url, cutoff, args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
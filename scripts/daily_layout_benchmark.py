@@ -0,0 +1,266 @@
+"""Compare the wide and the compact daily_entries layout on a real database.
+
+Runs migration_compact_daily_entries.sql inside a transaction that is rolled
+back at the end, and measures both layouts on the same data:
+- storage: table size, rows per 8 kB page, average row size
+- upserts: the app's own UPSERT_DAILY_SQL / UPSERT_DAILY_COMPACT_SQL, one
+  statement per row like sendDaily, half of them new rows (INSERT), half
+  existing ones (ON CONFLICT DO UPDATE); upserts/s and WAL per upsert
+- reads: DAILY_TRENDS_SQL and the per-patient intake matrix through the
+  daily_entries view (the compact layout unpacks intake on every read)
+- the time the conversion itself takes
+After the conversion both layouts exist side by side (the old table is kept as
+daily_entries_wide), so the runs alternate between them; a CHECKPOINT first
+gives both the same full-page-write cost.
+
+The migration renames daily_entries under ACCESS EXCLUSIVE until the
+rollback, so run this against a staging copy of production, never
+production itself. The rolled-back rows stay behind as dead tuples: VACUUM
+daily_entries before running it again.
+
+Usage:
+    DATABASE_URL=postgresql://... python scripts/daily_layout_benchmark.py
+    python scripts/daily_layout_benchmark.py --rows 2000 --rounds 5 --json layout.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+from datetime import date
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import intake_analysis  # noqa: E402
+import repository  # noqa: E402
+
+
+MIGRATION_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migration_compact_daily_entries.sql"
+)
+PAGE_SIZE = 8192
+
+STORAGE_SQL = """
+    SELECT
+        pg_relation_size(CAST(:table AS REGCLASS)) AS table_bytes,
+        pg_indexes_size(CAST(:table AS REGCLASS)) AS index_bytes,
+        (SELECT COUNT(*) FROM {table}) AS n_rows,
+        (SELECT AVG(pg_column_size(t.*)) FROM {table} t) AS avg_row_bytes
+"""
+
+SAMPLE_SQL = """
+    SELECT de.*, p.patient_code
+    FROM daily_entries de
+    INNER JOIN patients p ON p.id = de.patient_id
+    ORDER BY random()
+    LIMIT :n
+"""
+
+CAN_CHECKPOINT_SQL = """
+    SELECT rolsuper OR EXISTS (
+        SELECT 1 FROM pg_roles r WHERE r.rolname = 'pg_checkpoint' AND pg_has_role(r.oid, 'MEMBER')
+    )
+    FROM pg_roles WHERE rolname = current_user
+"""
+
+DELETE_SQL = "DELETE FROM {table} WHERE patient_id = :patient_id AND entry_date = :entry_date"
+
+
+def _async_url(url: str) -> str:
+    for prefix in ("postgresql+asyncpg://", "postgres+asyncpg://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+
+def _size(n: float) -> str:
+    for unit in ("B", "kB", "MB", "GB"):
+        if abs(n) < 1024 or unit == "GB":
+            return f"{n:.1f} {unit}" if unit != "B" else f"{n:.0f} B"
+        n /= 1024
+
+
+def _on_wide_table(statement):
+    # После миграции старая таблица называется daily_entries_wide
+    return text(re.sub(r"\bdaily_entries\b", "daily_entries_wide", statement.text))
+
+
+async def storage(conn, table: str) -> dict:
+    row = (await conn.execute(text(STORAGE_SQL.format(table=table)), {"table": table})).mappings().first()
+    pages = max(row["table_bytes"] // PAGE_SIZE, 1)
+    return {
+        "table_bytes": row["table_bytes"],
+        "index_bytes": row["index_bytes"],
+        "rows": row["n_rows"],
+        "rows_per_page": round(row["n_rows"] / pages, 1),
+        "avg_row_bytes": round(float(row["avg_row_bytes"] or 0), 1),
+    }
+
+
+async def upsert_run(conn, statement, delete, fresh: list, existing: list) -> tuple:
+    """One pass of upserts: (seconds, WAL bytes); the new rows are deleted again afterwards."""
+    wal_before = (await conn.execute(text("SELECT pg_current_wal_insert_lsn()"))).scalar()
+    started = time.perf_counter()
+    for params in fresh + existing:
+        await conn.execute(statement, params)
+    elapsed = time.perf_counter() - started
+    wal_bytes = (await conn.execute(
+        text("SELECT pg_wal_lsn_diff(pg_current_wal_insert_lsn(), CAST(:lsn AS PG_LSN))"), {"lsn": wal_before}
+    )).scalar()
+    # Новые строки удаляем, чтобы следующий прогон снова их вставлял
+    for params in fresh:
+        await conn.execute(delete, {"patient_id": params["patient_id"], "entry_date": params["entry_date"]})
+    return elapsed, int(wal_bytes)
+
+
+async def read_run(conn, statement, params, patient_codes: list) -> list:
+    timings = []
+    for code in patient_codes:
+        started = time.perf_counter()
+        (await conn.execute(statement, params(code))).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+async def benchmark(conn, rows: int, rounds: int, read_patients: int) -> dict:
+    sample = [dict(row) for row in (await conn.execute(text(SAMPLE_SQL), {"n": rows * 2})).mappings().fetchall()]
+    if len(sample) < 2:
+        raise SystemExit("daily_entries has too few rows to benchmark")
+    patient_codes = sorted({row["patient_code"] for row in sample})[:read_patients]
+    params = [
+        {key: value for key, value in row.items() if key not in ("id", "created_at", "updated_at", "change_seq", "patient_code")}
+        for row in sample
+    ]
+    fresh, existing = params[:len(params) // 2], params[len(params) // 2:]
+
+    report = {"upserts_per_run": len(params)}
+    report["wide"] = await storage(conn, "daily_entries")
+    delete = text(DELETE_SQL.format(table="daily_entries"))
+    for row in fresh:
+        await conn.execute(delete, {"patient_id": row["patient_id"], "entry_date": row["entry_date"]})
+
+    with open(MIGRATION_PATH) as f:
+        migration = f.read()
+    # Несколько команд в одном execute - только через сам asyncpg
+    raw = await conn.get_raw_connection()
+    started = time.perf_counter()
+    await raw.driver_connection.execute(migration)
+    report["conversion_s"] = round(time.perf_counter() - started, 2)
+    report["compact"] = await storage(conn, "daily_entries_compact")
+    if (await conn.execute(text(CAN_CHECKPOINT_SQL))).scalar():
+        # Страницы новой таблицы только что записаны, а старой - нет: без CHECKPOINT
+        # full-page images достались бы только широкой раскладке
+        await conn.execute(text("CHECKPOINT"))
+    else:
+        print("no permission for CHECKPOINT - WAL per upsert favours the compact layout")
+
+    # Обе раскладки теперь рядом (daily_entries_wide и представление daily_entries):
+    # прогоны чередуются, чтобы фон (checkpoint, кэш) доставался обеим поровну
+    since = date.fromordinal(date.today().toordinal() - 364)
+    reads = {
+        "daily_trends": (repository.DAILY_TRENDS_SQL, lambda code: {"code": code, "since": since}),
+        "intake_matrix_patient": (intake_analysis.PATIENT_MATRIX_QUERY, lambda code: {"code": code}),
+    }
+    layouts = {
+        "wide": {
+            "upsert": _on_wide_table(repository.UPSERT_DAILY_SQL),
+            "delete": text(DELETE_SQL.format(table="daily_entries_wide")),
+            "reads": {name: _on_wide_table(statement) for name, (statement, _) in reads.items()},
+        },
+        "compact": {
+            "upsert": repository.UPSERT_DAILY_COMPACT_SQL,
+            "delete": text(DELETE_SQL.format(table="daily_entries_compact")),
+            "reads": {name: statement for name, (statement, _) in reads.items()},
+        },
+    }
+    runs = {layout: {"upserts": [], **{name: [] for name in reads}} for layout in layouts}
+    for run in range(rounds + 1):
+        for layout, statements in layouts.items():
+            upserts = await upsert_run(conn, statements["upsert"], statements["delete"], fresh, existing)
+            timings = {
+                name: await read_run(conn, statements["reads"][name], reads[name][1], patient_codes)
+                for name in reads
+            }
+            if run:  # первый прогон - прогрев
+                runs[layout]["upserts"].append(upserts)
+                for name in reads:
+                    runs[layout][name].extend(timings[name])
+
+    for layout, measured in runs.items():
+        report[layout]["upserts_per_s"] = round(len(params) / statistics.median(r[0] for r in measured["upserts"]))
+        report[layout]["wal_bytes_per_upsert"] = round(
+            statistics.median(r[1] for r in measured["upserts"]) / len(params)
+        )
+        for name in reads:
+            report[layout][f"{name}_ms"] = round(statistics.median(measured[name]), 3)
+    return report
+
+
+def print_report(report: dict):
+    wide, compact = report["wide"], report["compact"]
+    lines = [
+        ("table size", _size(wide["table_bytes"]), _size(compact["table_bytes"]),
+         compact["table_bytes"] / wide["table_bytes"]),
+        ("index size", _size(wide["index_bytes"]), _size(compact["index_bytes"]),
+         compact["index_bytes"] / wide["index_bytes"]),
+        ("rows per page", wide["rows_per_page"], compact["rows_per_page"],
+         compact["rows_per_page"] / wide["rows_per_page"]),
+        ("avg row", _size(wide["avg_row_bytes"]), _size(compact["avg_row_bytes"]),
+         compact["avg_row_bytes"] / wide["avg_row_bytes"]),
+        ("upserts/s", wide["upserts_per_s"], compact["upserts_per_s"],
+         compact["upserts_per_s"] / wide["upserts_per_s"]),
+        ("WAL per upsert", _size(wide["wal_bytes_per_upsert"]), _size(compact["wal_bytes_per_upsert"]),
+         compact["wal_bytes_per_upsert"] / wide["wal_bytes_per_upsert"]),
+        ("daily_trends", f"{wide['daily_trends_ms']:.2f} ms", f"{compact['daily_trends_ms']:.2f} ms",
+         compact["daily_trends_ms"] / wide["daily_trends_ms"]),
+        ("intake matrix", f"{wide['intake_matrix_patient_ms']:.2f} ms", f"{compact['intake_matrix_patient_ms']:.2f} ms",
+         compact["intake_matrix_patient_ms"] / wide["intake_matrix_patient_ms"]),
+    ]
+    print(f"{wide['rows']:,} diary rows, {report['upserts_per_run']:,} upserts per run")
+    print(f"{'':16} {'wide':>12} {'compact':>12}")
+    for label, before, after, ratio in lines:
+        print(f"{label:16} {before!s:>12} {after!s:>12} {100 * (ratio - 1):+7.1f}%")
+    print(f"conversion (migration_compact_daily_entries.sql): {report['conversion_s']:.1f}s")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000, help="new + existing rows upserted per run (each)")
+    parser.add_argument("--rounds", type=int, default=5, help="measured runs per layout (median is used)")
+    parser.add_argument("--read-patients", type=int, default=20, help="patients used for the read latency")
+    parser.add_argument("--json", metavar="FILE", help="write the results as JSON")
+    args = parser.parse_args()
+
+    url = os.getenv("DATABASE_URL")
+    if not url:
+        print("DATABASE_URL is not set")
+        return 1
+    engine = create_async_engine(_async_url(url))
+    try:
+        async with engine.connect() as conn:
+            transaction = await conn.begin()
+            try:
+                layout = (await conn.execute(text(repository.DAILY_TABLE_SQL))).scalar()
+                if layout != "daily_entries":
+                    print(f"daily_entries is already stored in {layout} - nothing to compare")
+                    return 1
+                # Миграция и все записи бенчмарка откатываются
+                report = await benchmark(conn, args.rows, args.rounds, args.read_patients)
+            finally:
+                await transaction.rollback()
+        print_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+    finally:
+        await engine.dispose()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
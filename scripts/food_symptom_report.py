@@ -0,0 +1,81 @@
+"""Print food/drink intake vs. symptom correlations for a patient or the whole cohort.
+
+Usage:
+    python scripts/food_symptom_report.py                 # whole cohort
+    python scripts/food_symptom_report.py --patient ABCD  # one patient
+    python scripts/food_symptom_report.py --json
+
+With DATABASE_SHARD_URLS the cohort is read from every shard.
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import intake_analysis  # noqa: E402
+import sharding  # noqa: E402
+
+
+def _async_url(url: str) -> str:
+    for prefix in ("postgresql+asyncpg://", "postgres+asyncpg://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+
+def _print_table(title: str, table: dict):
+    symptoms = intake_analysis.SYMPTOM_COLUMNS
+    print(title)
+    print(f"  {'':26}" + "".join(f"{s:>13}" for s in symptoms))
+    for intake, row in table.items():
+        cells = "".join(f"{'-' if row[s] is None else format(row[s], '+.3f'):>13}" for s in symptoms)
+        print(f"  {intake:26}{cells}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patient", help="patient_code; omit for the whole cohort")
+    parser.add_argument("--json", action="store_true", help="print raw JSON")
+    args = parser.parse_args()
+
+    patient_code = args.patient.strip().upper() if args.patient else None
+    urls = list(sharding.parse_shard_urls(sharding.DATABASE_SHARD_URLS).items())
+    if urls and patient_code:
+        owner = sharding.HashRing([name for name, _ in urls]).shard_for(patient_code)
+        urls = [(name, url) for name, url in urls if name == owner]
+    elif not urls and os.getenv("DATABASE_URL"):
+        urls = [("default", os.getenv("DATABASE_URL"))]
+    if not urls:
+        print("DATABASE_URL is not set")
+        return
+
+    async def load(url: str) -> list:
+        engine = create_async_engine(_async_url(url))
+        try:
+            async with engine.connect() as conn:
+                return await intake_analysis.load_rows(conn, patient_code)
+        finally:
+            await engine.dispose()
+
+    # Пациент целиком на одном шарде - строки шардов просто склеиваются
+    parts = await asyncio.gather(*(load(url) for _, url in urls))
+    matrix = intake_analysis.IntakeSymptomMatrix.from_rows([row for part in parts for row in part])
+
+    result = intake_analysis.compute_associations(matrix)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(
+        f"patients={result['n_patients']} days={result['n_days']} "
+        f"next_day_pairs={result['n_next_day_pairs']}"
+    )
+    _print_table("Same-day correlation (r)", result["same_day"])
+    _print_table("Next-day correlation (r)", result["next_day"])
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,312 @@
+"""Generate synthetic patient histories for capacity testing and load them with COPY.
+
+Every patient gets a registration date up to --years back and a latent
+symptom severity that improves over time (post-operative recovery). From it
+the generator derives:
+- daily diaries with missed days, drop-outs and a next-day coffee -> stool_count effect
+- weekly LARS answers every 7 days with total_score computed from the LARS weights
+- monthly questionnaires every 30 days (offset from the weekly day)
+- EQ-5D-5L entries inside the fill window of each milestone
+
+All values respect the CHECK constraints in schema.sql. Patients are split into
+chunks; worker processes generate a chunk with NumPy and COPY it over their own
+connection in one transaction, so memory stays bounded by chunk size x workers.
+
+Usage (scratch databases only):
+    python scripts/generate_data.py --patients 100000 --years 3 --workers 8
+    python scripts/generate_data.py --patients 10000 --dry-run   # generation speed only
+"""
+import os
+import sys
+import time
+import uuid
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import eq5d5l_scoring  # noqa: E402
+import intake_analysis  # noqa: E402
+import repository  # noqa: E402
+
+
+# Баллы LARS для каждого ответа (индекс ответа = значение в weekly_entries)
+LARS_WEIGHTS = {
+    "flatus_control": (0, 4, 7),
+    "liquid_stool_leakage": (0, 3, 3),
+    "bowel_frequency": (4, 2, 0, 5),  # >7/day, 4-7/day, 1-3/day, <1/day
+    "repeat_bowel_opening": (0, 9, 11),
+    "urgency_to_toilet": (0, 11, 16),
+}
+
+DAILY_COLUMNS = (
+    "patient_id", "entry_date", "bristol_scale", "stool_count", "pads_used", "urgency",
+    "night_stools", "leakage", "incomplete_evacuation", "bloating", "impact_score",
+    "activity_interfere",
+) + intake_analysis.INTAKE_COLUMNS
+WEEKLY_COLUMNS = ("patient_id", "entry_date") + tuple(LARS_WEIGHTS) + ("total_score",)
+MONTHLY_COLUMNS = (
+    "patient_id", "entry_date", "qol_score", "avoid_travel", "avoid_social", "embarrassed",
+    "worry_notice", "depressed", "control", "satisfaction",
+)
+EQ5D5L_COLUMNS = ("patient_id", "entry_date") + eq5d5l_scoring.DIMENSIONS + ("health_vas",)
+
+# Средняя дневная доза по типам intake (Пуассон), в порядке INTAKE_COLUMNS
+INTAKE_RATES = (1.5, 0.6, 0.8, 1.0, 0.4, 0.3, 0.8, 0.5, 0.6, 0.3, 5.0, 1.5, 1.2, 0.3, 0.4, 0.5, 0.6, 0.1)
+COFFEE = intake_analysis.INTAKE_COLUMNS.index("drink_coffee")
+
+
+def _plain_dsn(url: str) -> str:
+    # asyncpg does not understand postgresql+asyncpg, ensure plain scheme
+    for prefix in ("postgresql+asyncpg://", "postgres+asyncpg://"):
+        if url.startswith(prefix):
+            return "postgresql://" + url[len(prefix):]
+    return url
+
+
+def _dates(day_numbers: np.ndarray) -> list:
+    base = int(day_numbers.min()) if day_numbers.size else 0
+    lookup = [date.fromordinal(base + i) for i in range(int(day_numbers.max()) - base + 1)] if day_numbers.size else []
+    return [lookup[i] for i in (day_numbers - base).tolist()]
+
+
+def _levels(rng, severity: np.ndarray, max_level: int, spread: float = 0.8) -> np.ndarray:
+    """Answer level 0..max_level that grows with severity."""
+    raw = severity * (max_level + 0.5) + rng.normal(0.0, spread, severity.size)
+    return np.clip(np.rint(raw), 0, max_level).astype(np.int64)
+
+
+def _expand(counts: np.ndarray):
+    """Row -> (patient position, 0-based index within patient) for per-patient row counts."""
+    patient = np.repeat(np.arange(counts.size), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    return patient, np.arange(patient.size) - starts
+
+
+def generate_chunk(first: int, count: int, years: float, seed: int, prefix: str, today: date) -> dict:
+    """Rows for patients first..first+count-1 as {table: (columns, [tuples])}."""
+    rng = np.random.default_rng([seed, first])
+    today_number = today.toordinal()
+
+    history_days = rng.integers(20, max(int(years * 365), 21), count)
+    created_number = today_number - history_days
+    severity = rng.beta(2.0, 2.5, count)
+    recovery_days = rng.uniform(120, 720, count)
+    adherence = rng.beta(6.0, 1.5, count)
+    # ~30% пациентов перестают вести дневник
+    active_days = np.where(
+        rng.random(count) < 0.3,
+        rng.integers(14, history_days + 1),
+        history_days + 1,
+    )
+
+    patient_ids = [uuid.uuid4() for _ in range(count)]
+    created_at = [
+        datetime.combine(date.fromordinal(int(day)), dt_time(int(h), int(m)), tzinfo=timezone.utc)
+        for day, h, m in zip(created_number, rng.integers(7, 20, count), rng.integers(0, 60, count))
+    ]
+    patients = [
+        (patient_ids[i], f"{prefix}{first + i:08d}", created_at[i]) for i in range(count)
+    ]
+
+    def severity_at(patient: np.ndarray, day: np.ndarray) -> np.ndarray:
+        recovered = 0.35 + 0.65 * np.exp(-day / recovery_days[patient])
+        return np.clip(severity[patient] * recovered + rng.normal(0.0, 0.08, patient.size), 0.0, 1.0)
+
+    # --- daily ---
+    patient, day = _expand(active_days)
+    sev = severity_at(patient, day)
+    intake = rng.poisson(np.array(INTAKE_RATES)[None, :] * rng.uniform(0.3, 1.7, (count, 1))[patient])
+    coffee_yesterday = np.roll(intake[:, COFFEE], 1)
+    coffee_yesterday[day == 0] = 0
+    keep = rng.random(patient.size) < adherence[patient]
+    patient, day, sev, intake, coffee_yesterday = (
+        patient[keep], day[keep], sev[keep], intake[keep], coffee_yesterday[keep]
+    )
+    n = patient.size
+    stool_count = rng.poisson(1.0 + 5.0 * sev + 0.25 * coffee_yesterday)
+    bristol = np.clip(np.rint(4 + rng.normal(0, 1.0, n) + 2.0 * sev * rng.choice((-1, 1), n)), 1, 7).astype(np.int64)
+    bristol_values = [None if missing else value
+                      for missing, value in zip((rng.random(n) < 0.1).tolist(), bristol.tolist())]
+    leakage_choice = np.where(rng.random(n) < sev * 0.6, np.where(rng.random(n) < 0.7, 1, 2), 0)
+    yes_no = np.array(["No", "Yes"])
+    scores = np.clip(np.round(sev[:, None] * 8 + rng.normal(0, 1.2, (n, 3)), 1), 0, 10)
+    daily_columns = [
+        [patient_ids[i] for i in patient.tolist()],
+        _dates(created_number[patient] + day),
+        bristol_values,
+        stool_count.tolist(),
+        rng.poisson(sev * 2.0).tolist(),
+        yes_no[(rng.random(n) < sev).astype(np.int64)].tolist(),
+        yes_no[(rng.random(n) < sev * 0.5).astype(np.int64)].tolist(),
+        np.array(["None", "Liquid", "Solid"])[leakage_choice].tolist(),
+        yes_no[(rng.random(n) < sev * 0.7).astype(np.int64)].tolist(),
+        scores[:, 0].tolist(),
+        scores[:, 1].tolist(),
+        scores[:, 2].tolist(),
+    ] + [intake[:, k].tolist() for k in range(intake.shape[1])]
+
+    # --- weekly (LARS) ---
+    patient, week = _expand(active_days // 7 + 1)
+    day = week * 7
+    keep = (day < active_days[patient]) & (rng.random(patient.size) < np.minimum(adherence[patient] + 0.1, 1.0))
+    patient, day = patient[keep], day[keep]
+    sev = severity_at(patient, day)
+    answers = {item: _levels(rng, sev, len(weights) - 1) for item, weights in LARS_WEIGHTS.items()}
+    # bowel_frequency: 1-3/day (индекс 2) - норма, чем тяжелее, тем дальше от неё
+    answers["bowel_frequency"] = np.array((2, 1, 0, 3))[_levels(rng, sev, 3)]
+    total_score = sum(np.array(LARS_WEIGHTS[item])[level] for item, level in answers.items())
+    weekly_columns = [
+        [patient_ids[i] for i in patient.tolist()],
+        _dates(created_number[patient] + day),
+    ] + [answers[item].tolist() for item in LARS_WEIGHTS] + [total_score.tolist()]
+
+    # --- monthly ---
+    patient, month = _expand(np.maximum(active_days - 3, 0) // 30 + 1)
+    day = month * 30 + 3
+    keep = (day < active_days[patient]) & (rng.random(patient.size) < np.minimum(adherence[patient] + 0.1, 1.0))
+    patient, day = patient[keep], day[keep]
+    sev = severity_at(patient, day)
+    n = patient.size
+    monthly_columns = [
+        [patient_ids[i] for i in patient.tolist()],
+        _dates(created_number[patient] + day),
+        np.clip(np.rint(10 - sev * 8 + rng.normal(0, 1, n)), 0, 10).astype(np.int64).tolist(),
+    ] + [(_levels(rng, sev, 3) + 1).astype(np.float64).tolist() for _ in range(5)] + [
+        np.clip(np.rint(10 - sev * 8 + rng.normal(0, 1.5, n)), 0, 10).tolist(),
+        np.clip(np.rint(9 - sev * 7 + rng.normal(0, 1.5, n)), 0, 10).tolist(),
+    ]
+
+    # --- EQ-5D-5L ---
+    milestones = np.array(eq5d5l_scoring.MILESTONES)
+    patient = np.repeat(np.arange(count), milestones.size)
+    day = np.tile(milestones, count) + rng.integers(
+        -eq5d5l_scoring.WINDOW_BEFORE_DAYS, eq5d5l_scoring.WINDOW_AFTER_DAYS + 1, patient.size
+    )
+    keep = (day < active_days[patient]) & (rng.random(patient.size) < 0.9)
+    patient, day = patient[keep], day[keep]
+    sev = severity_at(patient, day)
+    eq5d5l_columns = [
+        [patient_ids[i] for i in patient.tolist()],
+        _dates(created_number[patient] + day),
+    ] + [_levels(rng, sev, 4, spread=0.7).tolist() for _ in eq5d5l_scoring.DIMENSIONS] + [
+        np.clip(np.rint(92 - sev * 45 + rng.normal(0, 8, patient.size)), 0, 100).astype(np.int64).tolist(),
+    ]
+
+    return {
+        "patients": (("id", "patient_code", "created_at"), patients),
+        "daily_entries": (DAILY_COLUMNS, list(zip(*daily_columns))),
+        "weekly_entries": (WEEKLY_COLUMNS, list(zip(*weekly_columns))),
+        "monthly_entries": (MONTHLY_COLUMNS, list(zip(*monthly_columns))),
+        "eq5d5l_entries": (EQ5D5L_COLUMNS, list(zip(*eq5d5l_columns))),
+    }
+
+
+# Состояние процесса-воркера: свой event loop и своё соединение
+_worker = {}
+
+
+def _init_worker(dsn):
+    _worker["loop"] = asyncio.new_event_loop()
+    _worker["dsn"] = dsn
+    _worker["conn"] = None
+
+
+async def _copy_chunk(tables: dict):
+    import asyncpg
+
+    if _worker["conn"] is None:
+        _worker["conn"] = await asyncpg.connect(dsn=_worker["dsn"])
+    conn = _worker["conn"]
+    async with conn.transaction():
+        for table, (columns, records) in tables.items():
+            if records:
+                await conn.copy_records_to_table(table, records=records, columns=columns)
+
+
+def _run_chunk(job) -> dict:
+    first, count, years, seed, prefix, today, dry_run = job
+    tables = generate_chunk(first, count, years, seed, prefix, today)
+    if not dry_run:
+        _worker["loop"].run_until_complete(_copy_chunk(tables))
+    return {table: len(records) for table, (_, records) in tables.items()}
+
+
+async def _check_prefix_unused(dsn: str, prefix: str):
+    import asyncpg
+
+    conn = await asyncpg.connect(dsn=dsn)
+    try:
+        exists = await conn.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM patients WHERE patient_code LIKE $1 || '%')", prefix
+        )
+        if exists:
+            raise SystemExit(f"Patients with prefix {prefix!r} already exist - use another --prefix")
+    finally:
+        await conn.close()
+
+
+async def _analyze(dsn: str):
+    import asyncpg
+
+    conn = await asyncpg.connect(dsn=dsn)
+    try:
+        # При DAILY_LAYOUT=compact daily_entries - представление, анализируется daily_entries_compact
+        daily_table = await conn.fetchval(repository.DAILY_TABLE_SQL)
+        await conn.execute(f"ANALYZE patients, {daily_table}, weekly_entries, monthly_entries, eq5d5l_entries")
+    finally:
+        await conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--years", type=float, default=3.0, help="maximum history length per patient")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--chunk", type=int, default=200, help="patients per COPY transaction")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--prefix", default="SYN", help="patient_code prefix (codes are prefix + 8 digits)")
+    parser.add_argument("--dry-run", action="store_true", help="generate rows without loading them")
+    parser.add_argument("--no-analyze", action="store_true", help="skip ANALYZE after loading")
+    args = parser.parse_args()
+
+    if not 4 <= len(args.prefix) + 8 <= 64:
+        raise SystemExit("--prefix is too long for patient_code")
+    dsn = None
+    if not args.dry_run:
+        url = os.getenv("DATABASE_URL")
+        if not url:
+            print("DATABASE_URL is not set")
+            return
+        dsn = _plain_dsn(url)
+        asyncio.run(_check_prefix_unused(dsn, args.prefix))
+
+    today = date.today()
+    jobs = [
+        (first, min(args.chunk, args.patients - first), args.years, args.seed, args.prefix, today, args.dry_run)
+        for first in range(0, args.patients, args.chunk)
+    ]
+    totals = {}
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(dsn,)) as pool:
+        for done, counts in enumerate(pool.map(_run_chunk, jobs), start=1):
+            for table, rows in counts.items():
+                totals[table] = totals.get(table, 0) + rows
+            elapsed = time.monotonic() - started
+            rows = sum(totals.values())
+            print(
+                f"chunk {done}/{len(jobs)}: {rows:,} rows in {elapsed:.1f}s "
+                f"({rows / elapsed * 60 / 1e6:.2f}M rows/min)",
+                flush=True,
+            )
+
+    if not args.dry_run and not args.no_analyze:
+        asyncio.run(_analyze(dsn))
+    print({table: f"{rows:,}" for table, rows in totals.items()})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+"""Index audit for a live database: redundant, overlapping and unused indexes, write amplification.
+
+Reads only the catalog and statistics views (pg_index, pg_stat_user_indexes,
+pg_stat_user_tables), so it is safe to run against production:
+- duplicate / redundant: a plain B-tree whose key columns are a prefix of
+  another index on the same table with the same predicate. A B-tree is
+  scanned both ways, so (patient_id, entry_date DESC) next to
+  UNIQUE (patient_id, entry_date) is redundant for `patient_id = ... ORDER BY
+  entry_date DESC`; only an ORDER BY mixing directions across the columns
+  would lose its index (reported as "differs in sort order"). Indexes backing
+  a PRIMARY KEY / UNIQUE constraint are never proposed for dropping
+- overlapping: indexes sharing the leading column but not covered - listed only
+- unused: idx_scan = 0 since the statistics were reset - listed only, check
+  every replica before dropping
+- write amplification per table: index tuples written per row insert or
+  non-HOT update, and how much smaller it gets without the redundant indexes
+
+--write-migration FILE writes the DROP INDEX statements for the redundant
+indexes. --benchmark measures upsert throughput and WAL per upsert with the
+current and the proposed index sets on a copy of each affected table created
+inside a transaction that is rolled back; the real tables are only read
+(no locks beyond ACCESS SHARE), but the copy needs disk space and I/O, so
+prefer a staging copy of production.
+
+Usage:
+    python scripts/index_audit.py
+    python scripts/index_audit.py --write-migration migration_drop_redundant_indexes.sql
+    python scripts/index_audit.py --benchmark --bench-rows 2000
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+
+INDEXES_SQL = """
+    SELECT
+        t.relname AS table_name,
+        i.relname AS index_name,
+        am.amname AS method,
+        x.indisunique AS is_unique,
+        x.indisprimary AS is_primary,
+        c.conname AS constraint_name,
+        x.indnkeyatts AS n_key_columns,
+        x.indkey::INT2[] AS column_numbers,
+        x.indoption::INT2[] AS column_options,
+        x.indexprs IS NOT NULL AS has_expressions,
+        pg_get_expr(x.indpred, x.indrelid) AS predicate,
+        pg_get_indexdef(x.indexrelid) AS definition,
+        pg_relation_size(x.indexrelid) AS size_bytes,
+        COALESCE(s.idx_scan, 0) AS idx_scan,
+        ARRAY(
+            SELECT a.attname FROM unnest(x.indkey::INT2[]) WITH ORDINALITY k(attnum, n)
+            LEFT JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = k.attnum
+            ORDER BY k.n
+        ) AS column_names
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_class t ON t.oid = x.indrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    JOIN pg_am am ON am.oid = i.relam
+    LEFT JOIN pg_constraint c ON c.conindid = x.indexrelid AND c.contype IN ('p', 'u', 'x')
+    LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = x.indexrelid
+    WHERE n.nspname = $1 AND t.relkind = 'r'
+    ORDER BY t.relname, i.relname
+"""
+
+TABLES_SQL = """
+    SELECT
+        relname AS table_name,
+        n_tup_ins, n_tup_upd, n_tup_hot_upd, n_tup_del, n_live_tup,
+        pg_relation_size(relid) AS heap_bytes,
+        pg_indexes_size(relid) AS index_bytes
+    FROM pg_stat_user_tables
+    WHERE schemaname = $1
+    ORDER BY relname
+"""
+
+STATS_RESET_SQL = "SELECT stats_reset FROM pg_stat_database WHERE datname = current_database()"
+
+BENCH_PREFIX = "_index_audit_"
+
+
+def _plain_dsn(url: str) -> str:
+    for prefix in ("postgresql+asyncpg://", "postgres+asyncpg://"):
+        if url.startswith(prefix):
+            return "postgresql://" + url[len(prefix):]
+    return url
+
+
+def _size(n: int) -> str:
+    for unit in ("B", "kB", "MB", "GB"):
+        if abs(n) < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def _keys(index: dict) -> list:
+    """[(column, option)] for the key columns; option bits = DESC / NULLS FIRST."""
+    n = index["n_key_columns"]
+    return list(zip(index["column_names"][:n], index["column_options"][:n]))
+
+
+def _is_prefix(short: list, long: list) -> bool:
+    """Key columns of `short` lead `long` (sort directions are not compared)."""
+    return len(short) <= len(long) and [column for column, _ in short] == [column for column, _ in long[:len(short)]]
+
+
+def _same_order(short: list, long: list) -> bool:
+    if short == long[:len(short)]:
+        return True
+    # Обратный обход B-tree: DESC/NULLS FIRST инвертированы у всех колонок сразу
+    return [(column, option ^ 3) for column, option in short] == long[:len(short)]
+
+
+def _plain_btree(index: dict) -> bool:
+    return index["method"] == "btree" and not index["has_expressions"] and 0 not in index["column_numbers"]
+
+
+def find_redundant(indexes: list) -> list:
+    """[(index, covering index, reason)] for indexes that can be dropped."""
+    redundant = []
+    dropped = set()
+    for index in indexes:
+        if not _plain_btree(index) or index["constraint_name"] or index["is_unique"]:
+            continue
+        for other in indexes:
+            if (
+                other is index
+                or other["index_name"] in dropped
+                or other["table_name"] != index["table_name"]
+                or not _plain_btree(other)
+                or other["predicate"] != index["predicate"]
+                or not _is_prefix(_keys(index), _keys(other))
+            ):
+                continue
+            same = len(_keys(index)) == len(_keys(other))
+            # Из двух одинаковых обычных индексов оставляем один (тот, что используется чаще)
+            if same and not (other["constraint_name"] or other["is_unique"]) and (
+                (other["idx_scan"], index["index_name"]) < (index["idx_scan"], other["index_name"])
+            ):
+                continue
+            reason = f"{'duplicate' if same else 'prefix'} of {other['index_name']}"
+            if other["constraint_name"]:
+                reason += " (constraint index)"
+            if not _same_order(_keys(index), _keys(other)):
+                reason += ", differs in sort order"
+            redundant.append((index, other, reason))
+            dropped.add(index["index_name"])
+            break
+    return redundant
+
+
+def find_overlapping(indexes: list, redundant: list) -> list:
+    """[(index, other)] pairs with the same leading column where neither covers the other."""
+    covered = {index["index_name"] for index, _, _ in redundant}
+    pairs = []
+    for i, index in enumerate(indexes):
+        for other in indexes[i + 1:]:
+            if (
+                index["table_name"] == other["table_name"]
+                and index["index_name"] not in covered
+                and other["index_name"] not in covered
+                and _plain_btree(index) and _plain_btree(other)
+                and _keys(index)[0][0] == _keys(other)[0][0]
+                and not _is_prefix(_keys(index), _keys(other))
+                and not _is_prefix(_keys(other), _keys(index))
+            ):
+                pairs.append((index, other))
+    return pairs
+
+
+def find_unused(indexes: list) -> list:
+    # Индексы ограничений нужны для проверки уникальности, даже если планировщик их не выбирает
+    return [index for index in indexes if index["idx_scan"] == 0 and not (index["is_unique"] or index["is_primary"])]
+
+
+def write_amplification(tables: list, indexes: list, redundant: list) -> list:
+    dropped = {index["index_name"] for index, _, _ in redundant}
+    result = []
+    for table in tables:
+        own = [index for index in indexes if index["table_name"] == table["table_name"]]
+        kept = [index for index in own if index["index_name"] not in dropped]
+        # INSERT и не-HOT UPDATE пишут кортеж в каждый индекс; HOT UPDATE - ни в один
+        writes = table["n_tup_ins"] + table["n_tup_upd"] - table["n_tup_hot_upd"]
+        result.append({
+            "table": table["table_name"],
+            "indexes": len(own),
+            "indexes_after": len(kept),
+            "inserts": table["n_tup_ins"],
+            "updates": table["n_tup_upd"],
+            "hot_update_pct": round(100 * table["n_tup_hot_upd"] / table["n_tup_upd"], 1) if table["n_tup_upd"] else None,
+            "index_tuples_written": writes * len(own),
+            "index_tuples_per_row_write": len(own),
+            "index_tuples_per_row_write_after": len(kept),
+            "heap_bytes": table["heap_bytes"],
+            "index_bytes": table["index_bytes"],
+            "index_bytes_after": sum(index["size_bytes"] for index in kept),
+        })
+    return result
+
+
+def migration_sql(redundant: list, schema: str) -> str:
+    lines = [
+        "-- Удаление избыточных индексов (сгенерировано scripts/index_audit.py)",
+        "-- Каждый из них повторяет ведущие колонки другого индекса той же таблицы;",
+        "-- B-tree читается в обе стороны, поэтому планы запросов не меняются, а каждый",
+        "-- send* перестаёт обновлять лишнее дерево.",
+        "-- DROP INDEX коротко берёт ACCESS EXCLUSIVE на таблицу; вне транзакции можно",
+        "-- заменить на DROP INDEX CONCURRENTLY.",
+        "",
+    ]
+    for index, other, reason in redundant:
+        lines.append(f"-- {index['index_name']}: {reason}, {_size(index['size_bytes'])}")
+        name = index["index_name"] if schema == "public" else f"{schema}.{index['index_name']}"
+        lines.append(f"DROP INDEX IF EXISTS {name};")
+    return "\n".join(lines) + "\n"
+
+
+# ---------- benchmark ----------
+
+async def _table_columns(conn, schema: str, table: str) -> list:
+    rows = await conn.fetch(
+        """
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = (quote_ident($1) || '.' || quote_ident($2))::regclass AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
+        """,
+        schema, table,
+    )
+    return [row["attname"] for row in rows]
+
+
+def _conflict_columns(own: list) -> list:
+    unique = [index for index in own if index["is_unique"] and not index["is_primary"] and _plain_btree(index)]
+    if not unique:
+        return []
+    return [column for column, _ in _keys(unique[0])]
+
+
+
+
+def _bench_index_sql(index: dict, schema: str, bench_table: str) -> str:
+    definition = index["definition"]
+    for target in (f" ON {schema}.{index['table_name']} ", f" ON {index['table_name']} "):
+        definition = definition.replace(target, f" ON {bench_table} ", 1)
+    return definition.replace(f" INDEX {index['index_name']} ", f" INDEX {BENCH_PREFIX}{index['index_name']} ", 1)
+
+
+async def _run_workload(conn, statement: str, batches: list) -> tuple:
+    wal_before = await conn.fetchval("SELECT pg_current_wal_insert_lsn()")
+    started = time.perf_counter()
+    for batch in batches:
+        await conn.executemany(statement, batch)
+    elapsed = time.perf_counter() - started
+    wal_bytes = await conn.fetchval("SELECT pg_wal_lsn_diff(pg_current_wal_insert_lsn(), $1)", wal_before)
+    return elapsed, int(wal_bytes)
+
+
+async def benchmark_table(conn, schema: str, table: str, own: list, drop: set, rows: int, prefill: int,
+                          rounds: int) -> dict:
+    """Upserts/s and WAL per upsert on a copy of `table` with the current and the proposed index sets.
+
+    Like the send* handlers: one upsert per row, half of them new rows
+    (INSERT), half existing ones (ON CONFLICT DO UPDATE).
+    """
+    conflict = _conflict_columns(own)
+    if not conflict:
+        return {"table": table, "skipped": "no UNIQUE constraint to upsert on"}
+    columns = await _table_columns(conn, schema, table)
+    insert_columns = [column for column in columns if column not in ("id", "created_at")]
+    update_columns = [column for column in insert_columns if column not in conflict] or conflict
+    bench = f"{BENCH_PREFIX}{table}"
+    source = f"{schema}.{table}"
+
+    sample = await conn.fetch(
+        f"SELECT {', '.join(insert_columns)} FROM {source} ORDER BY random() LIMIT $1", rows * 2
+    )
+    if len(sample) < 2:
+        return {"table": table, "skipped": "not enough rows"}
+    fresh = [tuple(row) for row in sample[:len(sample) // 2]]
+    existing = [tuple(row) for row in sample[len(sample) // 2:]]
+    key_positions = [insert_columns.index(column) for column in conflict]
+    fresh_keys = [tuple(row[n] for n in key_positions) for row in fresh]
+
+    upsert = (
+        f"INSERT INTO {bench} ({', '.join(insert_columns)}) "
+        f"VALUES ({', '.join(f'${n}' for n in range(1, len(insert_columns) + 1))}) "
+        f"ON CONFLICT ({', '.join(conflict)}) DO UPDATE SET "
+        + ", ".join(f"{column} = EXCLUDED.{column}" for column in update_columns)
+    )
+    delete_fresh = (
+        f"DELETE FROM {bench} WHERE "
+        + " AND ".join(f"{column} = ${n}" for n, column in enumerate(conflict, 1))
+    )
+
+    results = {"current": [], "proposed": []}
+    transaction = conn.transaction()
+    await transaction.start()
+    try:
+        # Копия таблицы живёт только внутри этой транзакции; исходная только читается
+        await conn.execute(f"CREATE TABLE {bench} (LIKE {source} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        await conn.execute(f"INSERT INTO {bench} SELECT * FROM {source} LIMIT {int(prefill)}")
+        for index in own:
+            await conn.execute(_bench_index_sql(index, schema, bench))
+        await conn.executemany(delete_fresh, fresh_keys)
+        await conn.executemany(upsert, existing)
+        await conn.execute(f"ANALYZE {bench}")
+
+        for label in ("current", "proposed"):
+            if label == "proposed":
+                for name in sorted(drop):
+                    await conn.execute(f"DROP INDEX {BENCH_PREFIX}{name}")
+            for _ in range(rounds + 1):
+                elapsed, wal_bytes = await _run_workload(conn, upsert, [fresh, existing])
+                results[label].append((elapsed, wal_bytes))
+                # Новые строки удаляем, чтобы следующий прогон снова их вставлял
+                await conn.executemany(delete_fresh, fresh_keys)
+    finally:
+        await transaction.rollback()
+
+    upserts = len(fresh) + len(existing)
+    summary = {"table": table, "upserts_per_run": upserts, "dropped": sorted(drop)}
+    for label, runs in results.items():
+        runs = runs[1:]  # первый прогон - прогрев
+        summary[label] = {
+            "upserts_per_s": round(upserts / statistics.median(run[0] for run in runs)),
+            "wal_bytes_per_upsert": round(statistics.median(run[1] for run in runs) / upserts),
+        }
+    summary["throughput_change_pct"] = round(
+        100 * (summary["proposed"]["upserts_per_s"] / summary["current"]["upserts_per_s"] - 1), 1
+    )
+    return summary
+
+
+# ---------- report ----------
+
+def print_report(indexes: list, redundant: list, overlapping: list, unused: list, amplification: list,
+                 stats_reset):
+    print(f"{len(indexes)} indexes; usage statistics since {stats_reset or 'cluster start'}\n")
+    print("Indexes:")
+    for index in indexes:
+        kind = "PK" if index["is_primary"] else "UNIQUE" if index["is_unique"] else ""
+        print(
+            f"  {index['table_name'] + '.' + index['index_name']:58} {kind:6} "
+            f"{_size(index['size_bytes']):>10}  scans={index['idx_scan']}"
+        )
+
+    print("\nRedundant (safe to drop):")
+    for index, other, reason in redundant:
+        print(f"  {index['index_name']}: {reason}, {_size(index['size_bytes'])}")
+    if not redundant:
+        print("  none")
+
+    print("\nOverlapping (same leading column, review manually):")
+    for index, other in overlapping:
+        print(f"  {index['index_name']} ~ {other['index_name']}")
+    if not overlapping:
+        print("  none")
+
+    print("\nUnused (idx_scan = 0, not backing a constraint; check all replicas before dropping):")
+    for index in unused:
+        print(f"  {index['table_name']}.{index['index_name']} ({_size(index['size_bytes'])})")
+    if not unused:
+        print("  none")
+
+    print("\nWrite amplification (index tuples written per inserted or non-HOT updated row):")
+    for row in amplification:
+        hot = "-" if row["hot_update_pct"] is None else f"{row['hot_update_pct']}%"
+        print(
+            f"  {row['table']:18} indexes {row['indexes']} -> {row['indexes_after']}  "
+            f"inserts={row['inserts']} updates={row['updates']} hot={hot}  "
+            f"index size {_size(row['index_bytes'])} -> {_size(row['index_bytes_after'])} "
+            f"(heap {_size(row['heap_bytes'])})"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--schema", default="public")
+    parser.add_argument("--write-migration", metavar="FILE", help="write DROP INDEX statements for redundant indexes")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="measure upsert throughput before/after on rolled-back table copies")
+    parser.add_argument("--bench-rows", type=int, default=1000, help="new + existing rows upserted per run (each)")
+    parser.add_argument("--bench-prefill", type=int, default=200000, help="rows copied into each table copy")
+    parser.add_argument("--bench-rounds", type=int, default=5, help="measured runs per index set (median is used)")
+    parser.add_argument("--json", metavar="FILE", help="write the full report as JSON")
+    args = parser.parse_args()
+
+    url = os.getenv("DATABASE_URL")
+    if not url:
+        print("DATABASE_URL is not set")
+        return 1
+
+    import asyncpg
+
+    conn = await asyncpg.connect(dsn=_plain_dsn(url))
+    try:
+        indexes = [dict(row) for row in await conn.fetch(INDEXES_SQL, args.schema)]
+        tables = [dict(row) for row in await conn.fetch(TABLES_SQL, args.schema)]
+        stats_reset = await conn.fetchval(STATS_RESET_SQL)
+
+        redundant = find_redundant(indexes)
+        overlapping = find_overlapping(indexes, redundant)
+        unused = find_unused(indexes)
+        amplification = write_amplification(tables, indexes, redundant)
+        print_report(indexes, redundant, overlapping, unused, amplification, stats_reset)
+
+        if args.write_migration:
+            if redundant:
+                with open(args.write_migration, "w") as f:
+                    f.write(migration_sql(redundant, args.schema))
+                print(f"\nmigration written to {args.write_migration}")
+            else:
+                print("\nnothing to drop, migration not written")
+
+        benchmarks = []
+        if args.benchmark:
+            drops = {}
+            for index, _, _ in redundant:
+                drops.setdefault(index["table_name"], set()).add(index["index_name"])
+            print("\nUpsert benchmark (table copies, rolled back):")
+            for table, drop in sorted(drops.items()):
+                own = [index for index in indexes if index["table_name"] == table]
+                result = await benchmark_table(
+                    conn, args.schema, table, own, drop, args.bench_rows, args.bench_prefill, args.bench_rounds
+                )
+                benchmarks.append(result)
+                if "skipped" in result:
+                    print(f"  {table}: skipped, {result['skipped']}")
+                    continue
+                current, proposed = result["current"], result["proposed"]
+                print(
+                    f"  {table:18} {current['upserts_per_s']:>7} -> {proposed['upserts_per_s']:>7} upserts/s "
+                    f"({result['throughput_change_pct']:+.1f}%), WAL/upsert "
+                    f"{current['wal_bytes_per_upsert']} -> {proposed['wal_bytes_per_upsert']} B"
+                )
+            if not drops:
+                print("  nothing to compare")
+
+        if args.json:
+            report = {
+                "stats_reset": stats_reset.isoformat() if stats_reset else None,
+                "indexes": indexes,
+                "redundant": [
+                    {"index": index["index_name"], "table": index["table_name"], "covered_by": other["index_name"],
+                     "reason": reason, "size_bytes": index["size_bytes"]}
+                    for index, other, reason in redundant
+                ],
+                "overlapping": [[index["index_name"], other["index_name"]] for index, other in overlapping],
+                "unused": [index["index_name"] for index in unused],
+                "write_amplification": amplification,
+                "benchmark": benchmarks,
+            }
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True, default=str)
+    finally:
+        await conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,379 @@
+"""Query-plan regression check for every SQL statement the app issues.
+
+Seeds a LOCAL Postgres (never point this at production) with synthetic
+patients and diaries, runs EXPLAIN (ANALYZE, BUFFERS) for each statement in
+repository.py / intake_analysis.py and compares the result with
+scripts/plan_budgets.json. Exits with code 1 when a statement falls back to
+a sequential scan on an app table or exceeds its execution-time / buffer
+budget, or when a statement is missing from the registry below.
+
+Usage:
+    psql "$DATABASE_URL" -f schema.sql
+    python scripts/plan_check.py --seed --patients 50000 --days 730
+    python scripts/plan_check.py                      # re-check existing data
+    python scripts/plan_check.py --write-budgets      # accept current plans as the baseline
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+from datetime import date
+
+from sqlalchemy import text
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.ext.asyncio import create_async_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import intake_analysis  # noqa: E402
+import repository  # noqa: E402
+
+
+BUDGETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan_budgets.json")
+APP_TABLES = {"patients", "daily_entries_compact"} | set(repository.ENTRY_TABLES.values())
+# Статементы только одной раскладки дневника (repository.DAILY_LAYOUTS); на другой не выполняются
+LAYOUT_STATEMENTS = {"upsert_daily": "wide", "upsert_daily_compact": "compact"}
+SEED_PREFIX = "PLAN"
+
+# Запас при --write-budgets: время нестабильно, буферы почти детерминированы
+TIME_HEADROOM = 3.0
+BUFFER_HEADROOM = 2.0
+
+
+def _async_url(url: str) -> str:
+    for prefix in ("postgresql+asyncpg://", "postgres+asyncpg://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+
+def _sample_daily_entry():
+    entry = {
+        "entry_date": date.today().isoformat(), "bristol_scale": 4, "stool_count": 2, "pads_used": 1,
+        "urgency": "No", "night_stools": "No", "leakage": "None", "incomplete_evacuation": "No",
+        "bloating": 1.0, "impact_score": 2.0, "activity_interfere": 0.0,
+    }
+    entry.update({column: 0 for column in intake_analysis.INTAKE_COLUMNS})
+    return entry
+
+
+# name -> (statement, params(patient_code, patient_id), full_table)
+# full_table: statement reads the whole table by design - seq scan allowed, no budget
+def statements():
+    today = date.today()
+    return {
+        "upsert_patient": (repository.UPSERT_PATIENT_SQL, lambda code, pid: {"code": code}, False),
+        "upsert_weekly": (repository.UPSERT_WEEKLY_SQL, lambda code, pid: {
+            "patient_id": pid, "entry_date": today.isoformat(), "flatus_control": 1, "liquid_stool_leakage": 0,
+            "bowel_frequency": 2, "repeat_bowel_opening": 1, "urgency_to_toilet": 2, "total_score": 27,
+        }, False),
+        "upsert_daily": (repository.UPSERT_DAILY_SQL, lambda code, pid: dict(
+            _sample_daily_entry(), patient_id=pid), False),
+        "upsert_daily_compact": (repository.UPSERT_DAILY_COMPACT_SQL, lambda code, pid: dict(
+            _sample_daily_entry(), patient_id=pid), False),
+        "upsert_monthly": (repository.UPSERT_MONTHLY_SQL, lambda code, pid: {
+            "patient_id": pid, "entry_date": today.isoformat(), "qol_score": 6, "avoid_travel": 2.0,
+            "avoid_social": 1.0, "embarrassed": 1.0, "worry_notice": 2.0, "depressed": 1.0,
+            "control": 6.0, "satisfaction": 7.0,
+        }, False),
+        "upsert_eq5d5l": (repository.UPSERT_EQ5D5L_SQL, lambda code, pid: {
+            "patient_id": pid, "entry_date": today.isoformat(), "mobility": 1, "self_care": 0,
+            "usual_activities": 1, "pain_discomfort": 2, "anxiety_depression": 0, "health_vas": 70,
+        }, False),
+        "notify_change": (repository.NOTIFY_CHANGE_SQL, lambda code, pid: {
+            "kind": "daily", "code": code, "entry_id": "00000000-0000-0000-0000-000000000000",
+            "entry_date": today.isoformat()}, False),
+        "lars_weekly": (repository.LARS_WEEKLY_SQL, lambda code, pid: {"code": code}, False),
+        "lars_monthly": (repository.LARS_MONTHLY_SQL, lambda code, pid: {"code": code}, False),
+        "lars_yearly": (repository.LARS_YEARLY_SQL, lambda code, pid: {"code": code}, False),
+        "questionnaire_state": (repository.QUESTIONNAIRE_STATE_SQL, lambda code, pid: {
+            "code": code, "today": today}, False),
+        "daily_trends": (repository.DAILY_TRENDS_SQL, lambda code, pid: {
+            "code": code, "since": date.fromordinal(today.toordinal() - 364)}, False),
+        "daily_series": (repository.DAILY_SERIES_SQL, lambda code, pid: {
+            "code": code, "since": date.fromordinal(today.toordinal() - 391)}, False),
+        "eq5d5l_history": (repository.EQ5D5L_HISTORY_SQL, lambda code, pid: {"code": code}, False),
+        # Первая страница полной синхронизации (since=0, лимит app.CHANGES_PAGE_LIMIT по умолчанию + 1)
+        "changes": (repository.CHANGES_SQL, lambda code, pid: {"code": code, "since": 0, "limit": 501}, False),
+        "intake_matrix_patient": (intake_analysis.PATIENT_MATRIX_QUERY, lambda code, pid: {"code": code}, False),
+        # Когортный анализ читает всю таблицу - seq scan ожидаем
+        "intake_matrix_cohort": (intake_analysis.COHORT_MATRIX_QUERY, lambda code, pid: {}, True),
+    }
+
+
+def unregistered_statements(registry) -> list:
+    """SQL constants in the app modules that are not covered by the registry."""
+    registered = {id(statement) for statement, _, _ in registry.values()}
+    missing = []
+    for module in (repository, intake_analysis):
+        for name, value in vars(module).items():
+            if isinstance(value, TextClause) and id(value) not in registered:
+                missing.append(f"{module.__name__}.{name}")
+    return missing
+
+
+SEED_STATEMENTS = [
+    """
+    INSERT INTO patients (patient_code, created_at)
+    SELECT :prefix || lpad(g::text, 7, '0'), now() - make_interval(days => CAST(:days AS INTEGER))
+    FROM generate_series(CAST(:first AS INTEGER), CAST(:last AS INTEGER)) g
+    ON CONFLICT (patient_code) DO NOTHING
+    """,
+    """
+    INSERT INTO daily_entries (
+        patient_id, entry_date, bristol_scale, stool_count, pads_used, urgency, night_stools,
+        leakage, incomplete_evacuation, bloating, impact_score, activity_interfere,
+        food_vegetables_all, food_legumes, food_whole_grains, drink_water, drink_coffee, drink_alcohol
+    )
+    SELECT
+        p.id, CURRENT_DATE - d,
+        CASE WHEN random() < 0.9 THEN 1 + floor(random() * 7)::int END,
+        floor(random() * 8)::int, floor(random() * 4)::int,
+        CASE WHEN random() < 0.3 THEN 'Yes' ELSE 'No' END,
+        CASE WHEN random() < 0.2 THEN 'Yes' ELSE 'No' END,
+        (ARRAY['None', 'None', 'None', 'Liquid', 'Solid'])[1 + floor(random() * 5)::int],
+        CASE WHEN random() < 0.25 THEN 'Yes' ELSE 'No' END,
+        round((random() * 10)::numeric, 2), round((random() * 10)::numeric, 2), round((random() * 10)::numeric, 2),
+        floor(random() * 4)::int, floor(random() * 3)::int, floor(random() * 3)::int,
+        floor(random() * 9)::int, floor(random() * 5)::int, floor(random() * 3)::int
+    FROM patients p
+    CROSS JOIN generate_series(0, CAST(:days AS INTEGER) - 1) d
+    WHERE p.patient_code BETWEEN :first_code AND :last_code
+        AND random() < 0.8
+        -- NOT EXISTS вместо ON CONFLICT: при DAILY_LAYOUT=compact daily_entries - представление
+        AND NOT EXISTS (
+            SELECT 1 FROM daily_entries de WHERE de.patient_id = p.id AND de.entry_date = CURRENT_DATE - d
+        )
+    """,
+    """
+    INSERT INTO weekly_entries (
+        patient_id, entry_date, flatus_control, liquid_stool_leakage, bowel_frequency,
+        repeat_bowel_opening, urgency_to_toilet, total_score
+    )
+    SELECT
+        p.id, CURRENT_DATE - d,
+        floor(random() * 3)::int, floor(random() * 3)::int, floor(random() * 4)::int,
+        floor(random() * 3)::int, floor(random() * 3)::int, floor(random() * 43)::int
+    FROM patients p
+    CROSS JOIN generate_series(0, CAST(:days AS INTEGER) - 1, 7) d
+    WHERE p.patient_code BETWEEN :first_code AND :last_code
+    ON CONFLICT (patient_id, entry_date) DO NOTHING
+    """,
+    """
+    INSERT INTO monthly_entries (
+        patient_id, entry_date, qol_score, avoid_travel, avoid_social, embarrassed,
+        worry_notice, depressed, control, satisfaction
+    )
+    SELECT
+        p.id, CURRENT_DATE - d, floor(random() * 11)::int,
+        1 + floor(random() * 4)::int, 1 + floor(random() * 4)::int, 1 + floor(random() * 4)::int,
+        1 + floor(random() * 4)::int, 1 + floor(random() * 4)::int,
+        floor(random() * 11)::int, floor(random() * 11)::int
+    FROM patients p
+    CROSS JOIN generate_series(3, CAST(:days AS INTEGER) - 1, 30) d
+    WHERE p.patient_code BETWEEN :first_code AND :last_code
+    ON CONFLICT (patient_id, entry_date) DO NOTHING
+    """,
+    """
+    INSERT INTO eq5d5l_entries (
+        patient_id, entry_date, mobility, self_care, usual_activities,
+        pain_discomfort, anxiety_depression, health_vas
+    )
+    SELECT
+        p.id, p.created_at::DATE + m,
+        floor(random() * 5)::int, floor(random() * 5)::int, floor(random() * 5)::int,
+        floor(random() * 5)::int, floor(random() * 5)::int, floor(random() * 101)::int
+    FROM patients p
+    CROSS JOIN unnest(ARRAY[14, 30, 90, 180, 365]) m
+    WHERE p.patient_code BETWEEN :first_code AND :last_code
+        AND p.created_at::DATE + m <= CURRENT_DATE
+    ON CONFLICT (patient_id, entry_date) DO NOTHING
+    """,
+]
+
+
+async def seed(engine, patients: int, days: int, batch: int):
+    started = time.monotonic()
+    for first in range(1, patients + 1, batch):
+        last = min(first + batch - 1, patients)
+        async with engine.begin() as conn:
+            for statement in SEED_STATEMENTS:
+                await conn.execute(text(statement), {
+                    "prefix": SEED_PREFIX, "first": first, "last": last, "days": days,
+                    "first_code": f"{SEED_PREFIX}{first:07d}", "last_code": f"{SEED_PREFIX}{last:07d}",
+                })
+        print(f"seeded patients {first}..{last} ({time.monotonic() - started:.0f}s)")
+    async with engine.connect() as conn:
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("VACUUM ANALYZE"))
+
+
+def _walk(node, node_types: set, seq_scans: set):
+    node_types.add(node["Node Type"])
+    if node["Node Type"] == "Seq Scan" and node.get("Relation Name") in APP_TABLES:
+        seq_scans.add(node["Relation Name"])
+    for child in node.get("Plans", []):
+        _walk(child, node_types, seq_scans)
+
+
+async def explain(engine, statement, params: dict) -> dict:
+    query = text("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement.text).bindparams(**params)
+    async with engine.connect() as conn:
+        # EXPLAIN ANALYZE реально выполняет запрос - записи откатываем
+        transaction = await conn.begin()
+        try:
+            result = await conn.execute(query)
+            plan = result.scalar()
+        finally:
+            await transaction.rollback()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    plan = plan[0]
+    node_types, seq_scans = set(), set()
+    _walk(plan["Plan"], node_types, seq_scans)
+    return {
+        "execution_ms": plan["Execution Time"],
+        "planning_ms": plan["Planning Time"],
+        "shared_hit": plan["Plan"].get("Shared Hit Blocks", 0),
+        "shared_read": plan["Plan"].get("Shared Read Blocks", 0),
+        "node_types": sorted(node_types),
+        "seq_scans": sorted(seq_scans),
+    }
+
+
+async def daily_layout(engine) -> str:
+    async with engine.connect() as conn:
+        compact = (await conn.execute(text("SELECT to_regclass('daily_entries_compact') IS NOT NULL"))).scalar()
+    return "compact" if compact else "wide"
+
+
+async def pick_patient(engine, patient_code):
+    async with engine.connect() as conn:
+        if patient_code:
+            row = (await conn.execute(
+                text("SELECT id, patient_code FROM patients WHERE patient_code = :code").bindparams(code=patient_code)
+            )).first()
+        else:
+            # Пациент из середины диапазона с дневником
+            row = (await conn.execute(text("""
+                SELECT p.id, p.patient_code FROM patients p
+                WHERE EXISTS (SELECT 1 FROM daily_entries de WHERE de.patient_id = p.id)
+                ORDER BY p.patient_code
+                OFFSET (SELECT COUNT(*) / 2 FROM patients) LIMIT 1
+            """))).first()
+            if row is None:
+                row = (await conn.execute(text("SELECT id, patient_code FROM patients LIMIT 1"))).first()
+    if row is None:
+        raise SystemExit("No patients found - run with --seed first")
+    return row[1], row[0]
+
+
+def check(measured: dict, budget: dict, full_table: bool) -> list:
+    failures = []
+    if full_table:
+        return failures
+    if measured["seq_scans"]:
+        failures.append(f"sequential scan on {', '.join(measured['seq_scans'])}")
+    if budget:
+        if measured["execution_ms"] > budget["max_execution_ms"]:
+            failures.append(f"execution {measured['execution_ms']:.2f}ms > budget {budget['max_execution_ms']:.2f}ms")
+        buffers = measured["shared_hit"] + measured["shared_read"]
+        if buffers > budget["max_shared_buffers"]:
+            failures.append(f"buffers {buffers} > budget {budget['max_shared_buffers']}")
+    return failures
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seed", action="store_true", help="insert synthetic data before checking")
+    parser.add_argument("--patients", type=int, default=50000)
+    parser.add_argument("--days", type=int, default=730, help="days of diary history per patient")
+    parser.add_argument("--batch", type=int, default=2000, help="patients per seed transaction")
+    parser.add_argument("--patient", help="patient_code to use for per-patient statements")
+    parser.add_argument("--runs", type=int, default=5, help="EXPLAIN ANALYZE runs per statement after a warm-up run (median is used)")
+    parser.add_argument("--budgets", default=BUDGETS_PATH)
+    parser.add_argument("--write-budgets", action="store_true", help="store current results as the new budgets")
+    parser.add_argument("--report", help="write the full measurement report as JSON to this path")
+    args = parser.parse_args()
+
+    url = os.getenv("DATABASE_URL")
+    if not url:
+        print("DATABASE_URL is not set")
+        return 1
+    engine = create_async_engine(_async_url(url))
+    try:
+        if args.seed:
+            await seed(engine, args.patients, args.days, args.batch)
+
+        registry = statements()
+        missing = unregistered_statements(registry)
+        patient_code, patient_id = await pick_patient(engine, args.patient)
+        layout = await daily_layout(engine)
+        registry = {
+            name: entry for name, entry in registry.items() if LAYOUT_STATEMENTS.get(name, layout) == layout
+        }
+        print(f"checking {len(registry)} statements for patient {patient_code} (daily layout: {layout})")
+
+        budgets = {}
+        if os.path.exists(args.budgets):
+            with open(args.budgets) as f:
+                budgets = json.load(f)
+
+        report, failed = {}, False
+        for name, (statement, params, full_table) in registry.items():
+            try:
+                # Первый прогон прогревает кэш каталога и буферы - не учитывается
+                runs = [await explain(engine, statement, params(patient_code, patient_id))
+                        for _ in range(args.runs + 1)][1:]
+            except Exception as e:
+                print(f"FAIL {name:24} {type(e).__name__}: {str(e).splitlines()[0][:200]}")
+                report[name] = {"failures": [f"{type(e).__name__}: {e}"], "full_table": full_table}
+                failed = True
+                continue
+            measured = dict(runs[-1], execution_ms=statistics.median(run["execution_ms"] for run in runs))
+            failures = check(measured, None if args.write_budgets else budgets.get(name), full_table)
+            report[name] = dict(measured, failures=failures, full_table=full_table)
+            status = "FAIL" if failures else "ok"
+            print(
+                f"{status:4} {name:24} {measured['execution_ms']:9.2f}ms "
+                f"hit={measured['shared_hit']:<7} read={measured['shared_read']:<7} "
+                f"nodes={','.join(measured['node_types'])}"
+            )
+            for failure in failures:
+                print(f"     - {failure}")
+            failed = failed or bool(failures)
+
+        for name in missing:
+            print(f"FAIL {name} is not registered in scripts/plan_check.py")
+            failed = True
+
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        if args.write_budgets:
+            new_budgets = {
+                name: {
+                    "max_execution_ms": round(max(result["execution_ms"] * TIME_HEADROOM, 1.0), 2),
+                    "max_shared_buffers": int((result["shared_hit"] + result["shared_read"]) * BUFFER_HEADROOM) + 10,
+                }
+                for name, result in report.items()
+                if not result["full_table"] and not result["failures"]
+            }
+            # Бюджеты статементов другой раскладки дневника сохраняются
+            new_budgets.update({
+                name: budget for name, budget in budgets.items()
+                if name in LAYOUT_STATEMENTS and name not in registry
+            })
+            with open(args.budgets, "w") as f:
+                json.dump(new_budgets, f, indent=2, sort_keys=True)
+                f.write("\n")
+            print(f"budgets written to {args.budgets}")
+        return 1 if failed else 0
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
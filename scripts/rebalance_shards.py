@@ -0,0 +1,201 @@
+"""Move patients to the shard that owns them under DATABASE_SHARD_URLS (sharding.py).
+
+After a shard is added (or removed) the hash ring assigns ~1/N of the
+patients to a different shard. Deploy the new DATABASE_SHARD_URLS first - the
+app then reads and writes those patients on their new shard - and run this
+script right away: until a patient is moved, reads on the new shard miss the
+history that is still on the old one.
+
+Per patient:
+1. on the source shard, lock the patients row (SELECT ... FOR UPDATE), so a
+   replica still running the old configuration waits instead of writing
+2. copy the patient and all entry rows to the owner shard in one transaction;
+   rows the app already wrote there win (ON CONFLICT DO NOTHING), and the
+   earlier created_at is kept (it drives the EQ-5D-5L schedule); the patient's
+   rows on the owner get new change_seq numbers above any number the source has
+   issued, so /changes cursors taken on the old shard stay valid and the client
+   downloads the patient once more
+3. after that commit, delete the patient (entries cascade) on the source
+A crash between 2 and 3 leaves a copy on both shards; the next run copies
+nothing new and deletes the leftover. All shards share one archive
+(archive.py, DAILY_ARCHIVE_DIR) whose reads and merges are keyed by
+patient_code, so a moved patient's archived days stay visible on the new
+shard; with DAILY_ARCHIVE_DIR set, the script also rewrites their patient_id
+in the Parquet files to the patient's id on the new shard. With DAILY_LAYOUT=compact the rows of
+daily_entries_compact are copied as they are; all shards must use the same
+daily layout.
+
+--init-sequences gives every shard its own residue of change_events_seq
+(INCREMENT BY sharding.CHANGE_EVENTS_STRIDE), so /events ids stay unique across
+shards; with CHANGE_FEED_TOKEN set the app refuses to start on several shards
+until this has been done.
+
+Usage:
+    DATABASE_SHARD_URLS="a=postgresql://...,b=postgresql://..." python scripts/rebalance_shards.py --dry-run
+    python scripts/rebalance_shards.py
+    python scripts/rebalance_shards.py --init-sequences
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import archive  # noqa: E402
+import repository  # noqa: E402
+import sharding  # noqa: E402
+
+
+SEQUENCE_STRIDE = sharding.CHANGE_EVENTS_STRIDE
+
+LOCK_PATIENT_SQL = "SELECT id, patient_code, created_at FROM patients WHERE patient_code = $1 FOR UPDATE"
+
+COPY_PATIENT_SQL = """
+    INSERT INTO patients (id, patient_code, created_at)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (patient_code) DO UPDATE SET created_at = LEAST(patients.created_at, EXCLUDED.created_at)
+    RETURNING id
+"""
+
+DELETE_PATIENT_SQL = "DELETE FROM patients WHERE id = $1"
+
+# Та же блокировка, что в repository.UPSERT_PATIENT_SQL: перенумерация не пересекается с записью приложения
+LOCK_PATIENT_WRITES_SQL = "SELECT pg_advisory_xact_lock(hashtextextended($1, 0))"
+
+# Номера entry_change_seq на целевом шарде - не меньше выданных на исходном
+ALIGN_CHANGE_SEQ_SQL = "SELECT setval('entry_change_seq', GREATEST($1, last_value)) FROM entry_change_seq"
+LAST_CHANGE_SEQ_SQL = "SELECT last_value FROM entry_change_seq"
+
+
+def _plain_dsn(url: str) -> str:
+    for prefix in ("postgresql+asyncpg://", "postgres+asyncpg://"):
+        if url.startswith(prefix):
+            return "postgresql://" + url[len(prefix):]
+    return url
+
+
+async def move_patient(source, target, patient_code: str, tables: list) -> tuple:
+    """Copy one patient from source to target and delete it on source.
+
+    Returns (rows copied per table, patient id on target or None if the patient is gone)."""
+    copied = {}
+    async with source.transaction():
+        patient = await source.fetchrow(LOCK_PATIENT_SQL, patient_code)
+        if patient is None:
+            return copied, None
+        rows = {
+            table: await source.fetch(f"SELECT * FROM {table} WHERE patient_id = $1", patient["id"])
+            for table in tables
+        }
+        async with target.transaction():
+            await target.execute(LOCK_PATIENT_WRITES_SQL, patient["patient_code"])
+            await target.execute(ALIGN_CHANGE_SEQ_SQL, await source.fetchval(LAST_CHANGE_SEQ_SQL))
+            target_id = await target.fetchval(
+                COPY_PATIENT_SQL, patient["id"], patient["patient_code"], patient["created_at"]
+            )
+            for table, records in rows.items():
+                if not records:
+                    continue
+                columns = list(records[0].keys())
+                position = columns.index("patient_id")
+                await target.executemany(
+                    f"INSERT INTO {table} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join(f'${n}' for n in range(1, len(columns) + 1))}) "
+                    "ON CONFLICT DO NOTHING",
+                    [tuple(record)[:position] + (target_id,) + tuple(record)[position + 1:] for record in records],
+                )
+                copied[table] = len(records)
+            for table in tables:
+                await target.execute(
+                    f"UPDATE {table} SET change_seq = nextval('entry_change_seq') WHERE patient_id = $1", target_id
+                )
+        await source.execute(DELETE_PATIENT_SQL, patient["id"])
+    return copied, target_id
+
+
+async def init_sequences(connections: dict):
+    if len(connections) > SEQUENCE_STRIDE:
+        raise SystemExit(f"--init-sequences supports at most {SEQUENCE_STRIDE} shards")
+    last_values = [
+        await conn.fetchval("SELECT last_value FROM change_events_seq") for conn in connections.values()
+    ]
+    # Новые номера у всех шардов больше любого уже выданного, поэтому курсоры клиентов остаются валидными
+    base = (max(last_values) // SEQUENCE_STRIDE + 1) * SEQUENCE_STRIDE
+    for position, (name, conn) in enumerate(connections.items()):
+        await conn.execute(
+            f"ALTER SEQUENCE change_events_seq INCREMENT BY {SEQUENCE_STRIDE} RESTART WITH {base + position + 1}"
+        )
+        print(f"{name}: change_events_seq restarts at {base + position + 1}, step {SEQUENCE_STRIDE}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="only count patients on the wrong shard")
+    parser.add_argument("--limit", type=int, help="move at most this many patients")
+    parser.add_argument("--init-sequences", action="store_true",
+                        help="interleave change_events_seq across shards instead of moving patients")
+    args = parser.parse_args()
+
+    shards = sharding.parse_shard_urls(sharding.DATABASE_SHARD_URLS)
+    if not shards:
+        print("DATABASE_SHARD_URLS is not set")
+        return 1
+    ring = sharding.HashRing(shards)
+
+    import asyncpg
+
+    connections = {}
+    try:
+        for name, url in shards.items():
+            connections[name] = await asyncpg.connect(dsn=_plain_dsn(url))
+        if args.init_sequences:
+            await init_sequences(connections)
+            return 0
+        # Представление daily_entries (compact) не принимает ON CONFLICT - копируем саму таблицу
+        daily_tables = {await conn.fetchval(repository.DAILY_TABLE_SQL) for conn in connections.values()}
+        if len(daily_tables) > 1:
+            print(f"Shards use different daily layouts ({', '.join(sorted(daily_tables))}) - migrate them first")
+            return 1
+        daily_table = daily_tables.pop()
+        tables = [daily_table if table == "daily_entries" else table for table in repository.ENTRY_TABLES.values()]
+
+        misplaced = []
+        for name, conn in connections.items():
+            codes = [row["patient_code"] for row in await conn.fetch("SELECT patient_code FROM patients")]
+            wrong = [(code, name, ring.shard_for(code)) for code in codes if ring.shard_for(code) != name]
+            misplaced.extend(wrong)
+            print(f"{name}: {len(codes):,} patients, {len(wrong):,} belong to another shard")
+        for (source, target), count in sorted(Counter((s, t) for _, s, t in misplaced).items()):
+            print(f"  {source} -> {target}: {count:,}")
+        if args.dry_run or not misplaced:
+            return 0
+
+        if args.limit is not None:
+            misplaced = misplaced[:args.limit]
+        started = time.monotonic()
+        totals = Counter()
+        new_ids = {}
+        for moved, (code, source, target) in enumerate(misplaced, start=1):
+            copied, target_id = await move_patient(connections[source], connections[target], code, tables)
+            totals.update(copied)
+            if target_id is not None:
+                new_ids[code] = str(target_id)
+            if moved % 100 == 0 or moved == len(misplaced):
+                print(f"moved {moved:,}/{len(misplaced):,} patients ({time.monotonic() - started:.0f}s)")
+        print("rows copied: " + ", ".join(f"{table}={count:,}" for table, count in sorted(totals.items())))
+
+        daily_archive = archive.create_archive()
+        if daily_archive is not None and new_ids:
+            # Один проход по файлам архива на весь прогон, а не на каждого пациента
+            rehomed = await asyncio.to_thread(daily_archive.rehome, new_ids)
+            print(f"archive: patient_id updated in {rehomed:,} archived rows")
+    finally:
+        for conn in connections.values():
+            await conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
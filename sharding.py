@@ -0,0 +1,159 @@
+"""Patients spread over several Postgres databases (shards) by consistent hashing.
+
+DATABASE_SHARD_URLS lists the shards as "name=url" pairs separated by commas
+or whitespace (bare URLs are named shard0, shard1, ...). A patient_code is
+hashed onto a ring with SHARD_VNODES points per shard name; the first point
+clockwise owns the patient. The ring depends only on the names, so a shard's
+URL can change freely, and adding a shard moves only ~1/N of the patients
+(scripts/rebalance_shards.py moves their rows).
+
+Every query in the app is scoped to one patient, so ShardedRepository routes
+each call to the owning shard's PostgresRepository (own engine, pool and
+pool controller). Cohort reads scatter to all shards in parallel and gather
+the rows; they fail if any shard fails rather than return a partial cohort.
+
+/events ids come from each shard's change_events_seq; with more than one shard
+the app refuses to start unless scripts/rebalance_shards.py --init-sequences
+gave every shard INCREMENT BY CHANGE_EVENTS_STRIDE and its own residue.
+"""
+import os
+import asyncio
+import hashlib
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import date
+from typing import Optional
+
+from sqlalchemy import text
+
+import intake_analysis
+import metrics
+from repository import QuestionnaireState, Repository, merge_archived_intake
+
+
+DATABASE_SHARD_URLS = os.getenv("DATABASE_SHARD_URLS", "")
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "256"))
+
+# Шаг change_events_seq на каждом шарде (rebalance_shards.py --init-sequences), остатки разные
+CHANGE_EVENTS_STRIDE = 64
+
+CHANGE_EVENTS_SEQ_SQL = text("""
+    SELECT (SELECT increment_by FROM pg_sequences WHERE sequencename = 'change_events_seq') AS increment_by,
+           last_value
+    FROM change_events_seq
+""")
+
+routed_total = metrics.Counter("shard_requests_total", "Repository calls routed to a shard", ("shard", "kind"))
+
+
+def parse_shard_urls(value: str) -> "OrderedDict[str, str]":
+    """'a=postgresql://...,b=postgresql://...' (or bare URLs) -> {name: url} in the given order."""
+    shards = OrderedDict()
+    for position, item in enumerate(value.replace(",", " ").split()):
+        name, separator, url = item.partition("=")
+        if not separator or "://" in name:
+            name, url = f"shard{position}", item
+        if name in shards:
+            raise ValueError(f"Duplicate shard name in DATABASE_SHARD_URLS: {name}")
+        shards[name] = url
+    return shards
+
+
+async def check_change_event_sequences(engines: dict):
+    """Raise ValueError unless every shard's change_events_seq steps by CHANGE_EVENTS_STRIDE
+    with a residue no other shard uses, i.e. /events ids cannot collide across shards."""
+    residues = {}
+    for name, engine in engines.items():
+        async with engine.connect() as conn:
+            increment_by, last_value = (await conn.execute(CHANGE_EVENTS_SEQ_SQL)).one()
+        if increment_by != CHANGE_EVENTS_STRIDE:
+            raise ValueError(
+                f"change_events_seq on shard {name} has INCREMENT BY {increment_by}, expected "
+                f"{CHANGE_EVENTS_STRIDE}: run python scripts/rebalance_shards.py --init-sequences"
+            )
+        residue = last_value % CHANGE_EVENTS_STRIDE
+        if residue in residues:
+            raise ValueError(
+                f"change_events_seq on shards {residues[residue]} and {name} issue the same /events ids: "
+                "run python scripts/rebalance_shards.py --init-sequences"
+            )
+        residues[residue] = name
+
+
+def _hash(key: str) -> int:
+    # Не hash(): он меняется между процессами (PYTHONHASHSEED)
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, names, vnodes: int = SHARD_VNODES):
+        self.names = list(names)
+        if not self.names:
+            raise ValueError("HashRing needs at least one shard")
+        points = sorted((_hash(f"{name}#{i}"), name) for name in self.names for i in range(vnodes))
+        self._keys = [point for point, _ in points]
+        self._owners = [name for _, name in points]
+
+    def shard_for(self, patient_code: str) -> str:
+        index = bisect_right(self._keys, _hash(patient_code))
+        return self._owners[index % len(self._owners)]
+
+
+class ShardedRepository(Repository):
+    name = "sharded"
+
+    def __init__(self, shards: dict, ring: HashRing, archive=None):
+        # shards: name -> PostgresRepository
+        self.shards = shards
+        self.ring = ring
+        # Архив общий для всех шардов (строки в нём по patient_code)
+        self.archive = archive
+
+    def shard(self, patient_code: str, kind: str) -> Repository:
+        name = self.ring.shard_for(patient_code)
+        routed_total.inc(shard=name, kind=kind)
+        return self.shards[name]
+
+    async def upsert_weekly(self, patient_code: str, entry: dict) -> str:
+        return await self.shard(patient_code, "write").upsert_weekly(patient_code, entry)
+
+    async def upsert_daily(self, patient_code: str, entry: dict) -> str:
+        return await self.shard(patient_code, "write").upsert_daily(patient_code, entry)
+
+    async def upsert_monthly(self, patient_code: str, entry: dict) -> str:
+        return await self.shard(patient_code, "write").upsert_monthly(patient_code, entry)
+
+    async def upsert_eq5d5l(self, patient_code: str, entry: dict) -> str:
+        return await self.shard(patient_code, "write").upsert_eq5d5l(patient_code, entry)
+
+    async def get_lars_series(self, patient_code: str, period: str) -> list:
+        return await self.shard(patient_code, "read").get_lars_series(patient_code, period)
+
+    async def get_questionnaire_state(self, patient_code: str, today: date) -> Optional[QuestionnaireState]:
+        return await self.shard(patient_code, "read").get_questionnaire_state(patient_code, today)
+
+    async def get_daily_trends(self, patient_code: str, since: date) -> list:
+        return await self.shard(patient_code, "read").get_daily_trends(patient_code, since)
+
+    async def get_intake_rows(self, patient_code: Optional[str], include_archive: bool = True) -> list:
+        if patient_code is not None:
+            return await self.shard(patient_code, "read").get_intake_rows(patient_code, include_archive)
+        for name in self.shards:
+            routed_total.inc(shard=name, kind="scatter")
+        parts = await asyncio.gather(*(
+            shard.get_intake_rows(None, include_archive=False) for shard in self.shards.values()
+        ))
+        # Пациент целиком лежит на одном шарде, поэтому склейка сохраняет порядок (patient, entry_date)
+        live = [row for part in parts for row in part]
+        if not include_archive:
+            return live
+        return await merge_archived_intake(self.archive, None, live)
+
+    async def get_intake_symptom_matrix(self, patient_code: Optional[str]) -> "intake_analysis.IntakeSymptomMatrix":
+        return intake_analysis.IntakeSymptomMatrix.from_rows(await self.get_intake_rows(patient_code))
+
+    async def get_eq5d5l_history(self, patient_code: str) -> Optional[tuple]:
+        return await self.shard(patient_code, "read").get_eq5d5l_history(patient_code)
+
+    async def get_changes(self, patient_code: str, since: int, limit: int) -> list:
+        return await self.shard(patient_code, "read").get_changes(patient_code, since, limit)
@@ -0,0 +1,103 @@
+"""Single-flight coalescing of identical concurrent reads.
+
+After a push reminder many devices of the same patient resume at once and
+send the same getLarsData / getNextQuestionnaire / ... requests. Instead of
+taking one pool connection each, concurrent calls with the same
+(endpoint, patient_code, params) share one in-flight query: the first caller
+starts it as a separate task, later callers wait for the same task, and all
+of them get the same result (or the same exception). Results are shared
+objects - handlers must not modify them.
+
+Cancellation: a caller that goes away (client disconnected) only stops
+waiting; the query keeps running for the others (asyncio.shield). When the
+last waiter is gone the query is cancelled, so an abandoned burst frees its
+connection.
+
+Writes call forget(patient_code) after commit: requests that arrive later
+start a new query and see the write, instead of joining a read that began
+before it.
+
+SINGLE_FLIGHT=0 disables coalescing.
+"""
+import os
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+import metrics
+import tracing
+
+
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "1") != "0"
+
+executions_total = metrics.Counter(
+    "singleflight_executions_total", "Read queries actually executed", ("endpoint",)
+)
+coalesced_total = metrics.Counter(
+    "singleflight_coalesced_total", "Requests served by joining an identical in-flight query", ("endpoint",)
+)
+abandoned_total = metrics.Counter(
+    "singleflight_abandoned_total", "In-flight queries cancelled because every waiter went away", ("endpoint",)
+)
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, enabled: bool = SINGLE_FLIGHT):
+        self.enabled = enabled
+        # patient_code -> {(endpoint, params): _Flight}
+        self._flights: dict = {}
+        metrics.Gauge("singleflight_in_flight", "Coalesced read queries currently running",
+                      callback=lambda: {(): sum(len(flights) for flights in self._flights.values())})
+
+    async def do(self, endpoint: str, patient_code: Optional[str], params: tuple,
+                 fn: Callable[[], Awaitable]):
+        """Run fn(), or wait for an identical call already in flight, and return its result."""
+        if not self.enabled:
+            return await fn()
+        key = (endpoint, params)
+        flights = self._flights.setdefault(patient_code, {})
+        flight = flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(fn()))
+            flight.task.add_done_callback(lambda task: self._finished(patient_code, key, flight))
+            flights[key] = flight
+            executions_total.inc(endpoint=endpoint)
+            joined = False
+        else:
+            coalesced_total.inc(endpoint=endpoint)
+            joined = True
+
+        flight.waiters += 1
+        try:
+            if joined:
+                with tracing.span("singleflight.join", endpoint=endpoint):
+                    return await asyncio.shield(flight.task)
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Все, кто ждал, ушли - запрос больше никому не нужен
+                abandoned_total.inc(endpoint=endpoint)
+                self._remove(patient_code, key, flight)
+                flight.task.cancel()
+
+    def forget(self, patient_code: Optional[str]):
+        """Let later calls for this patient start a new query (current waiters are not affected)."""
+        self._flights.pop(patient_code, None)
+
+    def _finished(self, patient_code, key, flight: _Flight):
+        self._remove(patient_code, key, flight)
+        if not flight.task.cancelled():
+            flight.task.exception()  # исключение получат ожидающие; здесь только помечаем как прочитанное
+
+    def _remove(self, patient_code, key, flight: _Flight):
+        flights = self._flights.get(patient_code)
+        if flights is not None and flights.get(key) is flight:
+            del flights[key]
+            if not flights:
+                del self._flights[patient_code]
@@ -0,0 +1,111 @@
+"""archive.DailyArchive: Parquet month files keyed by (patient_code, entry_date), the watermark, startup checks."""
+import os
+import sys
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import archive  # noqa: E402
+import intake_analysis  # noqa: E402
+
+
+def daily_row(patient_code: str, patient_id: str, entry_date: date, stool_count: int = 1) -> dict:
+    row = {
+        "id": f"{patient_code}-{entry_date}", "patient_id": patient_id, "patient_code": patient_code,
+        "entry_date": entry_date, "bristol_scale": 4, "stool_count": stool_count, "pads_used": 0,
+        "urgency": "No", "night_stools": "No", "leakage": "None", "incomplete_evacuation": "No",
+        "bloating": Decimal("1.25"), "impact_score": Decimal("2.00"), "activity_interfere": Decimal("0.00"),
+        "created_at": datetime(2024, 1, 1, tzinfo=timezone.utc),
+    }
+    row.update({column: 0 for column in intake_analysis.INTAKE_COLUMNS})
+    return row
+
+
+def write(store: archive.DailyArchive, rows: list) -> int:
+    return store.write_month(archive.month_start(rows[0]["entry_date"]), pa.Table.from_pylist(rows, schema=store.schema))
+
+
+def test_rewrite_after_shard_move_replaces_by_patient_code(tmp_path):
+    store = archive.DailyArchive(str(tmp_path))
+    write(store, [daily_row("AAAA", "old-id", date(2024, 1, day), 1) for day in (1, 2)])
+    # Тот же пациент, заархивированный уже на новом шарде: другой patient_id
+    total = write(store, [daily_row("AAAA", "new-id", date(2024, 1, 2), 7)])
+
+    assert total == 2
+    rows = store.rows("AAAA")
+    assert [(row["entry_date"].day, row["stool_count"]) for row in rows] == [(1, 1), (2, 7)]
+
+
+def test_rehome_sets_patient_id_of_moved_patients(tmp_path):
+    store = archive.DailyArchive(str(tmp_path))
+    write(store, [daily_row("AAAA", "old-a", date(2024, 1, 1)), daily_row("BBBB", "id-b", date(2024, 1, 1))])
+    write(store, [daily_row("AAAA", "old-a", date(2024, 2, 1))])
+
+    assert store.rehome({"AAAA": "new-a"}) == 2
+    assert {(row["patient_code"], row["patient_id"]) for row in store.rows()} == {("AAAA", "new-a"), ("BBBB", "id-b")}
+    # Ничего не меняется - файлы не переписываются
+    written_at = store.month_path(date(2024, 1, 1)).stat().st_mtime_ns
+    assert store.rehome({"AAAA": "new-a", "CCCC": "id-c"}) == 0
+    assert store.month_path(date(2024, 1, 1)).stat().st_mtime_ns == written_at
+
+
+def test_write_read_round_trip(tmp_path):
+    store = archive.DailyArchive(str(tmp_path))
+    january = [daily_row("AAAA", "id-a", date(2024, 1, day), day) for day in (30, 31)]
+    january[0]["bristol_scale"] = None
+    january[0]["food_legumes"] = 300  # SMALLINT, не 0..255
+    write(store, january)
+    write(store, [daily_row("AAAA", "id-a", date(2024, 2, 1), 5), daily_row("BBBB", "id-b", date(2024, 2, 1), 6)])
+
+    assert store.rows("AAAA") == january + [daily_row("AAAA", "id-a", date(2024, 2, 1), 5)]
+    assert len(store.rows()) == 4
+    assert [row["stool_count"] for row in store.rows("AAAA", since=date(2024, 1, 31))] == [31, 5]
+    assert store.rows("BBBB", columns=("entry_date", "bloating")) == [
+        {"entry_date": date(2024, 2, 1), "bloating": Decimal("1.25")}
+    ]
+    assert store.rows("CCCC") == []
+    assert store.last_entry_date("AAAA") == date(2024, 2, 1)
+    assert store.last_entry_date("CCCC") is None
+    assert store.manifest()["months"]["2024-01"]["rows"] == 2
+
+
+def test_watermark_only_moves_forward(tmp_path):
+    store = archive.DailyArchive(str(tmp_path))
+    assert store.archived_before is None
+    assert not store.covers(None)
+
+    store.set_archived_before(date(2024, 3, 1), shard="a")
+    store.set_archived_before(date(2024, 2, 1), shard="b")
+    assert store.archived_before == date(2024, 3, 1)
+    assert store.manifest()["shards"] == {"a": "2024-03-01", "b": "2024-02-01"}
+    assert store.covers(None)
+    assert store.covers(date(2024, 2, 29))
+    assert not store.covers(date(2024, 3, 1))
+
+    # Другой процесс (scripts/archive_daily.py) сдвигает границу - читатель видит её без перезапуска
+    archive.DailyArchive(str(tmp_path)).set_archived_before(date(2024, 4, 1))
+    assert store.archived_before == date(2024, 4, 1)
+
+
+def test_create_archive_fails_at_startup_without_pyarrow(tmp_path, monkeypatch):
+    archive.DailyArchive(str(tmp_path)).set_archived_before(date(2024, 3, 1))
+    monkeypatch.setattr(archive, "DAILY_ARCHIVE_DIR", str(tmp_path))
+    assert archive.create_archive().archived_before == date(2024, 3, 1)
+
+    monkeypatch.setattr(archive, "pa", None)
+    with pytest.raises(RuntimeError, match="before 2024-03-01"):
+        archive.create_archive()
+    monkeypatch.setattr(archive, "DAILY_ARCHIVE_DIR", "")
+    assert archive.create_archive() is None
+
+
+def test_create_archive_fails_at_startup_on_broken_manifest(tmp_path, monkeypatch):
+    store = archive.DailyArchive(str(tmp_path))
+    (store.path / "_manifest.json").write_text("{")
+    monkeypatch.setattr(archive, "DAILY_ARCHIVE_DIR", str(tmp_path))
+    with pytest.raises(ValueError):
+        archive.create_archive()
@@ -0,0 +1,54 @@
+"""eq5d5l_scoring: index values pinned to the published EQ-5D-5L value sets."""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import eq5d5l_scoring  # noqa: E402
+
+# Значения индекса из опубликованных value set'ов (England: Devlin et al. 2018, US: Pickard et al. 2019);
+# 33333 и 12345 - сумма декрементов из их таблиц коэффициентов, посчитанная вручную
+REFERENCE = [
+    ("11111", "england", 1.0),
+    ("55555", "england", -0.285),
+    ("33333", "england", 0.593),
+    ("12345", "england", 0.322),
+    ("21111", "england", 0.942),
+    ("11111", "us", 1.0),
+    ("55555", "us", -0.573),
+    ("33333", "us", 0.449),
+    ("12345", "us", 0.171),
+    ("11112", "us", 0.943),
+]
+
+
+def levels(state: str) -> tuple:
+    """Health state "12345" -> levels (0, 1, 2, 3, 4) as stored in eq5d5l_entries."""
+    return tuple(int(digit) - 1 for digit in state)
+
+
+@pytest.mark.parametrize("state, value_set, expected", REFERENCE)
+def test_score_matches_published_value(state, value_set, expected):
+    assert eq5d5l_scoring.score(*levels(state), value_set=value_set) == pytest.approx(expected, abs=1e-9)
+
+
+def test_score_many_matches_score():
+    states = [levels(state) for state, value_set, _ in REFERENCE if value_set == "england"]
+    expected = [value for _, value_set, value in REFERENCE if value_set == "england"]
+    np.testing.assert_allclose(eq5d5l_scoring.score_many(states, "england"), expected)
+
+
+def test_health_state_round_trip():
+    assert eq5d5l_scoring.health_state(levels("12345")) == "12345"
+
+
+def test_levels_outside_0_to_4_are_rejected():
+    with pytest.raises(ValueError):
+        eq5d5l_scoring.score(0, 0, 0, 0, 5, value_set="england")
+
+
+def test_unknown_value_set_is_rejected():
+    with pytest.raises(ValueError):
+        eq5d5l_scoring.score(0, 0, 0, 0, 0, value_set="mars")
@@ -0,0 +1,139 @@
+"""events.ChangeBroadcaster and the LISTEN reconnect, without Postgres."""
+import os
+import sys
+import json
+import types
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import events  # noqa: E402
+
+
+def event(seq: int) -> dict:
+    return {"seq": seq, "kind": "daily", "patient_code": "AAAA"}
+
+
+def drain(subscription: events.Subscription) -> list:
+    items = []
+    while not subscription.queue.empty():
+        items.append(subscription.queue.get_nowait())
+    return items
+
+
+def test_resume_from_cursor_returns_events_after_it():
+    broadcaster = events.ChangeBroadcaster(buffer_size=10)
+
+    async def run():
+        # Порядок COMMIT'ов: seq 3 закоммичен раньше 2
+        for seq in (1, 3, 2, 4):
+            broadcaster.publish(event(seq))
+        _, backlog = broadcaster.subscribe(cursor=3)
+        assert [item["seq"] for item in backlog] == [2, 4]
+        # Курсор последнего события - догонять нечего
+        _, backlog = broadcaster.subscribe(cursor=4)
+        assert backlog == []
+        # Без курсора - только новые события
+        subscription, backlog = broadcaster.subscribe(cursor=None)
+        assert backlog == []
+        broadcaster.publish(event(5))
+        assert [item["seq"] for item in drain(subscription)] == [5]
+
+    asyncio.run(run())
+
+
+def test_cursor_older_than_buffer_gets_reset():
+    broadcaster = events.ChangeBroadcaster(buffer_size=3)
+
+    async def run():
+        for seq in range(1, 6):
+            broadcaster.publish(event(seq))
+        _, backlog = broadcaster.subscribe(cursor=1)
+        assert backlog == [{"type": "reset"}]
+        # Курсор новее всего, что видела эта реплика (события другой реплики) - не reset
+        _, backlog = broadcaster.subscribe(cursor=99)
+        assert backlog == []
+
+    asyncio.run(run())
+
+
+def test_slow_subscriber_is_disconnected_on_overflow():
+    broadcaster = events.ChangeBroadcaster(buffer_size=100, subscriber_queue=2)
+
+    async def run():
+        slow, _ = broadcaster.subscribe(cursor=None)
+        fast, _ = broadcaster.subscribe(cursor=None)
+        for seq in range(1, 4):
+            broadcaster.publish(event(seq))
+            drain(fast)
+        assert slow.overflowed
+        assert not fast.overflowed
+        assert broadcaster._subscribers == {fast}
+        # Переполненному больше ничего не доставляется
+        broadcaster.publish(event(4))
+        assert [item["seq"] for item in drain(slow)] == [1, 2]
+
+        # Поток отдаёт то, что уже в очереди, и закрывается; клиент продолжит с Last-Event-ID: 6
+        stream = events.sse_stream(None, broadcaster, cursor=4)
+        assert await stream.__anext__() == "retry: 3000\n\n"
+        subscription = next(iter(broadcaster._subscribers - {fast}))
+        for seq in range(5, 8):
+            broadcaster.publish(event(seq))
+        chunks = [chunk async for chunk in stream]
+        assert [chunk.split("\n")[0] for chunk in chunks] == ["id: 5", "id: 6"]
+        assert subscription.overflowed
+        assert subscription not in broadcaster._subscribers
+
+    asyncio.run(run())
+
+
+class FakeConnection:
+    def __init__(self, closed: bool):
+        self.closed = closed
+        self.listeners = []
+
+    async def add_listener(self, channel, callback):
+        self.listeners.append((channel, callback))
+
+    def is_closed(self):
+        return self.closed
+
+    async def close(self):
+        self.closed = True
+
+
+def test_listener_reconnect_publishes_reset(monkeypatch):
+    # Первое соединение сразу обрывается, второе живое
+    connections = [FakeConnection(closed=True), FakeConnection(closed=False)]
+    connected = []
+
+    async def connect(dsn, **kwargs):
+        connection = connections[len(connected)]
+        connected.append(connection)
+        return connection
+
+    monkeypatch.setitem(sys.modules, "asyncpg", types.SimpleNamespace(connect=connect))
+    broadcaster = events.ChangeBroadcaster(buffer_size=10)
+    listener = events.PostgresChangeListener(broadcaster, "postgresql://unused")
+
+    async def run():
+        subscription, _ = broadcaster.subscribe(cursor=None)
+        broadcaster.publish(event(1))
+        listener.start()
+        first = await asyncio.wait_for(subscription.queue.get(), 1)
+        assert first["seq"] == 1
+        reset = await asyncio.wait_for(subscription.queue.get(), 1)
+        assert reset == {"type": "reset"}
+        assert len(connected) == 2
+        # Буфер очищен: старый курсор больше не продолжить
+        _, backlog = broadcaster.subscribe(cursor=1)
+        assert backlog == [{"type": "reset"}]
+
+        # Уведомление на новом соединении доходит до подписчиков
+        channel, callback = connections[1].listeners[0]
+        assert channel == events.NOTIFY_CHANNEL
+        callback(connections[1], 1, channel, json.dumps(event(2)))
+        assert drain(subscription) == [event(2)]
+        await listener.stop()
+        assert connections[1].closed
+
+    asyncio.run(run())
@@ -0,0 +1,71 @@
+"""intake_analysis matrix and the archive merge in repository.merge_archived_intake."""
+import os
+import sys
+import asyncio
+from datetime import date, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import intake_analysis  # noqa: E402
+import repository  # noqa: E402
+
+
+class FakeArchive:
+    """archive.DailyArchive stand-in: everything is covered, rows() returns the given records."""
+
+    def __init__(self, records: list):
+        self.records = records
+
+    def covers(self, since):
+        return True
+
+    def rows(self, patient_code=None, since=None, columns=None):
+        return [
+            {column: record[column] for column in columns}
+            for record in self.records
+            if patient_code is None or record["patient_code"] == patient_code
+        ]
+
+
+def daily_record(patient_code: str, patient_id: str, entry_date: date, stool_count: int) -> dict:
+    record = {
+        "patient_id": patient_id, "patient_code": patient_code, "entry_date": entry_date,
+        "stool_count": stool_count, "leakage": "None", "urgency": "No", "bloating": Decimal("1.00"),
+    }
+    record.update({column: 1 for column in intake_analysis.INTAKE_COLUMNS})
+    return record
+
+
+def test_archived_rows_from_another_shard_merge_by_patient_code():
+    start = date(2024, 1, 1)
+    # Архив писался на старом шарде: другой patient_id у того же пациента
+    archived = [daily_record("AAAA", "old-shard-id", start + timedelta(days=offset), 1) for offset in range(3)]
+    live = [
+        intake_analysis.matrix_row(daily_record("AAAA", "new-shard-id", start + timedelta(days=offset), 5))
+        for offset in (2, 3)
+    ]
+
+    rows = asyncio.run(repository.merge_archived_intake(FakeArchive(archived), "AAAA", live))
+
+    assert [(row[0], row[1]) for row in rows] == [("AAAA", start + timedelta(days=offset)) for offset in range(4)]
+    # Живая строка заменяет архивную за тот же день
+    stool = len(intake_analysis.INTAKE_COLUMNS) + 2
+    assert [row[stool] for row in rows] == [1, 1, 5, 5]
+
+    matrix = intake_analysis.IntakeSymptomMatrix.from_rows(rows)
+    result = intake_analysis.compute_associations(matrix)
+    assert result["n_patients"] == 1
+    assert result["n_days"] == 4
+    assert result["n_next_day_pairs"] == 3
+
+
+def test_matrix_groups_patients_by_code():
+    day = date(2024, 3, 1)
+    rows = [
+        intake_analysis.matrix_row(daily_record(code, f"id-{code}", day + timedelta(days=offset), offset))
+        for code in ("AAAA", "BBBB")
+        for offset in range(2)
+    ]
+    matrix = intake_analysis.IntakeSymptomMatrix.from_rows(rows)
+    assert matrix.patient_index.tolist() == [0, 0, 1, 1]
+    assert intake_analysis.compute_associations(matrix)["n_next_day_pairs"] == 2
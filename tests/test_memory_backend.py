@@ -0,0 +1,209 @@
+"""The API on MemoryRepository (STORAGE_BACKEND=memory) through the main send*/get* flows.
+
+Each test uses its own patient_code, so they share one app instance.
+Run from the repository root: python -m pytest -q
+"""
+import os
+import sys
+from datetime import date, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ["RATE_LIMIT_ENABLED"] = "0"
+os.environ["COHORT_ANALYSIS_TOKEN"] = "test-cohort-token"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+import repository  # noqa: E402
+
+
+WEEKLY = {"flatus_control": 2, "liquid_stool_leakage": 1, "bowel_frequency": 2, "repeat_bowel_opening": 0, "urgency_to_toilet": 1}
+EQ5D5L = {"mobility": 1, "self_care": 0, "usual_activities": 2, "pain_discomfort": 0, "anxiety_depression": 3, "health_vas": 55}
+
+
+@pytest.fixture(scope="module")
+def client():
+    assert isinstance(app.repo, repository.MemoryRepository)
+    with TestClient(app.app) as test_client:
+        yield test_client
+
+
+def headers(code: str) -> dict:
+    return {"X-Patient-Code": code}
+
+
+def test_missing_and_invalid_patient_code(client):
+    assert client.get("/getLarsData?period=weekly").status_code == 400
+    assert client.get("/getLarsData?period=weekly", headers=headers("ab")).status_code == 400
+    assert client.post("/sendDaily", json={}, headers=headers("ab")).status_code == 400
+
+
+def test_first_questionnaire_is_weekly(client):
+    body = client.get("/getNextQuestionnaire", headers=headers("mem-new")).json()
+    assert body["status"] == "ok"
+    assert body["questionnaire_type"] == "weekly"
+    assert body["is_today_filled"] is False
+
+
+def test_weekly_upsert_and_lars_series(client):
+    h = headers("mem-weekly")
+    day = (date.today() - timedelta(days=3)).isoformat()
+    first = client.post("/sendWeekly", json={**WEEKLY, "entry_date": day, "raw_data": {"total_score": 29}}, headers=h).json()
+    again = client.post("/sendWeekly", json={**WEEKLY, "entry_date": day, "raw_data": {"total_score": 35}}, headers=h).json()
+    assert first["status"] == again["status"] == "ok"
+    # Тот же день - та же строка (ON CONFLICT DO UPDATE)
+    assert first["id"] == again["id"]
+
+    data = client.get("/getLarsData?period=weekly", headers=h).json()["data"]
+    assert [point["score"] for point in data] == [35]
+    assert client.get("/getLarsData?period=daily", headers=h).status_code == 400
+
+
+def test_weekly_check_constraint_is_enforced(client):
+    response = client.post("/sendWeekly", json={**WEEKLY, "flatus_control": 9}, headers=headers("mem-weekly-bad"))
+    assert response.status_code == 500
+    assert response.json()["error_type"] == "ConstraintViolation"
+
+
+def test_daily_validation(client):
+    h = headers("mem-daily-bad")
+    out_of_range = client.post("/sendDaily", json={"bristol_scale": 9}, headers=h)
+    assert out_of_range.status_code == 500
+    assert out_of_range.json()["error_type"] == "ConstraintViolation"
+    # Широкая раскладка (schema.sql): SMALLINT без верхней границы 255
+    assert client.post("/sendDaily", json={"food_consumption": {"legumes": 256}}, headers=h).status_code == 200
+    out_of_smallint = client.post("/sendDaily", json={"food_consumption": {"legumes": 40000}}, headers=h)
+    assert out_of_smallint.status_code == 500
+    assert out_of_smallint.json()["error_type"] == "ConstraintViolation"
+
+
+def test_compact_layout_limits_intake_amounts(client, monkeypatch):
+    monkeypatch.setattr(app, "INTAKE_AMOUNT_LIMIT", 255)
+    h = headers("mem-daily-compact")
+    too_much = client.post("/sendDaily", json={"food_consumption": {"legumes": 256}}, headers=h)
+    assert too_much.status_code == 400
+    assert "food_legumes" in too_much.json()["detail"]
+    assert client.post("/sendDaily", json={"food_consumption": {"legumes": 255}}, headers=h).status_code == 200
+
+
+def test_daily_trends_and_associations(client):
+    h = headers("mem-daily")
+    for offset in range(10):
+        day = (date.today() - timedelta(days=offset)).isoformat()
+        response = client.post("/sendDaily", json={
+            "entry_date": day,
+            "bristol_scale": 4,
+            "food_consumption": {"legumes": offset % 3},
+            "drink_consumption": {"coffee": offset % 2},
+            "raw_data": {"stool_count": 1 + offset % 3, "bloating": 1.25, "urgency": "Yes" if offset % 2 else "No"},
+        }, headers=h)
+        assert response.json()["status"] == "ok"
+
+    trends = client.get("/getDailyTrends?days=7", headers=h).json()["data"]
+    assert [point["date"] for point in trends] == sorted(point["date"] for point in trends)
+    assert trends[-1]["metrics"]["stool_count"]["count_7d"] == 7
+
+    associations = client.get("/getFoodSymptomAssociations", headers=h).json()["data"]
+    assert associations["n_patients"] == 1
+    assert associations["n_days"] == 10
+    assert associations["same_day"]["food_legumes"]["stool_count"] == pytest.approx(1.0)
+
+
+def test_cohort_associations_need_token(client):
+    assert client.get("/getFoodSymptomAssociations?cohort=true").status_code == 401
+    assert client.get("/getFoodSymptomAssociations?cohort=true&token=wrong").status_code == 401
+    response = client.get(
+        "/getFoodSymptomAssociations?cohort=true", headers={"Authorization": "Bearer test-cohort-token"}
+    )
+    assert response.status_code == 200
+    assert response.json()["data"]["n_patients"] >= 1
+
+
+def test_monthly_and_eq5d5l(client):
+    h = headers("mem-monthly")
+    assert client.post("/sendMonthly", json={"qol_score": 5, "raw_data": {"avoid_travel": 2.5}}, headers=h).json()["status"] == "ok"
+    assert client.post("/sendEq5d5l", json={**EQ5D5L, "health_vas": 155}, headers=h).status_code in (400, 422, 500)
+    assert client.post("/sendEq5d5l", json=EQ5D5L, headers=h).json()["status"] == "ok"
+
+    body = client.get("/getEq5d5lData", headers=h).json()
+    assert body["status"] == "ok"
+    assert body["value_set"] == app.eq5d5l_scoring.DEFAULT_VALUE_SET
+    assert [point["milestone_days"] for point in body["data"]] == list(app.EQ5D5L_MILESTONES)
+
+
+def test_changes_paging_and_updates(client):
+    h = headers("mem-changes")
+    for offset in range(5):
+        day = (date.today() - timedelta(days=offset)).isoformat()
+        client.post("/sendDaily", json={"entry_date": day, "raw_data": {"stool_count": offset}}, headers=h)
+    client.post("/sendWeekly", json=WEEKLY, headers=h)
+
+    cursor, received = 0, []
+    while True:
+        page = client.get(f"/changes?since={cursor}&limit=2", headers=h).json()
+        seqs = [change["seq"] for change in page["changes"]]
+        assert seqs == sorted(seqs) and all(seq > cursor for seq in seqs)
+        received += page["changes"]
+        cursor = page["cursor"]
+        if not page["has_more"]:
+            break
+    assert sorted(change["kind"] for change in received) == ["daily"] * 5 + ["weekly"]
+    assert all("patient_id" not in change["entry"] for change in received)
+
+    # Без новых записей курсор не двигается
+    idle = client.get(f"/changes?since={cursor}", headers=h).json()
+    assert idle["changes"] == [] and idle["cursor"] == cursor and idle["has_more"] is False
+
+    # Изменённая строка приходит снова с новым номером
+    client.post("/sendDaily", json={"entry_date": date.today().isoformat(), "raw_data": {"stool_count": 9}}, headers=h)
+    update = client.get(f"/changes?since={cursor}", headers=h).json()
+    assert [(change["kind"], change["entry"]["stool_count"]) for change in update["changes"]] == [("daily", 9)]
+    assert update["cursor"] > cursor
+
+    assert client.get("/changes?since=-1", headers=h).status_code == 400
+    assert client.get("/changes?limit=0", headers=h).status_code == 400
+
+
+def test_patient_cache_skips_results_read_before_invalidate():
+    cache = app._PatientCache(max_patients=2)
+    generation = cache.generation()
+    cache.invalidate("AAAA")  # запись закоммичена, пока шло чтение
+    cache.put("AAAA", "trends", "stale", generation)
+    assert cache.get("AAAA", "trends") is None
+
+    cache.put("AAAA", "trends", "fresh", cache.generation())
+    assert cache.get("AAAA", "trends") == "fresh"
+    # Другой пациент не мешает
+    generation = cache.generation()
+    cache.invalidate("BBBB")
+    cache.put("AAAA", "trends", "still fresh", generation)
+    assert cache.get("AAAA", "trends") == "still fresh"
+
+
+def test_patient_cache_remembers_invalidation_after_eviction():
+    cache = app._PatientCache(max_patients=1)
+    generation = cache.generation()
+    cache.invalidate("AAAA")
+    cache.invalidate("BBBB")  # вытесняет отметку AAAA
+    cache.put("AAAA", "trends", "stale", generation)
+    assert cache.get("AAAA", "trends") is None
+
+
+def test_daily_trends_shorter_window_is_tail_of_cached_series(client):
+    h = headers("mem-trends-cache")
+    for offset in range(20):
+        day = (date.today() - timedelta(days=offset)).isoformat()
+        client.post("/sendDaily", json={"entry_date": day, "raw_data": {"stool_count": offset % 4}}, headers=h)
+
+    long = client.get("/getDailyTrends?days=30", headers=h).json()["data"]
+    short = client.get("/getDailyTrends?days=5", headers=h).json()["data"]
+    assert [point["index"] for point in short] == [1, 2, 3, 4, 5]
+    assert [point["metrics"] for point in short] == [point["metrics"] for point in long[-5:]]
+    # Один элемент кэша на пациента, независимо от days
+    assert list(app.daily_trends_cache._data["MEM-TRENDS-CACHE"]) == ["trends"]
+
+    client.post("/sendDaily", json={"entry_date": date.today().isoformat(), "raw_data": {"stool_count": 9}}, headers=h)
+    fresh = client.get("/getDailyTrends?days=5", headers=h).json()["data"]
+    assert fresh[-1]["metrics"]["stool_count"]["count_7d"] == 7
+    assert fresh[-1]["metrics"]["stool_count"] != short[-1]["metrics"]["stool_count"]
@@ -0,0 +1,96 @@
+"""MemoryRepository column types and CHECKs are an exact copy of schema.sql."""
+import os
+import re
+import sys
+from decimal import Decimal
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import repository  # noqa: E402
+
+# Служебные колонки заполняет сама таблица, MemoryRepository их не проверяет
+SYSTEM_COLUMNS = {"id", "patient_id", "entry_date", "created_at", "updated_at", "change_seq"}
+
+COLUMN_RE = re.compile(r"^(\w+) (SMALLINT|TEXT|NUMERIC\(\d+, \d+\))(.*?),?$")
+BETWEEN_RE = re.compile(r"CHECK \((\w+) BETWEEN (-?\d+) AND (-?\d+)\)")
+IN_RE = re.compile(r"CHECK \((\w+) IN \(([^)]*)\)\)")
+
+
+def schema_columns() -> dict:
+    with open(os.path.join(ROOT, "schema.sql")) as f:
+        sql = "\n".join(line.split("--")[0].strip() for line in f)
+    tables = {}
+    for table, body in re.findall(r"CREATE TABLE (\w+) \((.*?)\n\);", sql, re.S):
+        if table == "patients":
+            continue
+        columns = {}
+        for line in body.splitlines():
+            match = COLUMN_RE.match(line)
+            if not match or match.group(1) in SYSTEM_COLUMNS:
+                continue
+            column, sql_type, rest = match.groups()
+            check = None
+            if BETWEEN_RE.search(rest):
+                name, low, high = BETWEEN_RE.search(rest).groups()
+                check = ("BETWEEN", int(low), int(high))
+            elif IN_RE.search(rest):
+                name, values = IN_RE.search(rest).groups()
+                check = ("IN",) + tuple(value.strip().strip("'") for value in values.split(","))
+            else:
+                assert "CHECK" not in rest, line
+                name = column
+            assert name == column, line
+            columns[column] = (sql_type, "NOT NULL" not in rest, check)
+        tables[table] = columns
+    return tables
+
+
+def test_table_columns_match_schema_sql():
+    assert repository.TABLE_COLUMNS == schema_columns()
+
+
+@pytest.mark.parametrize("sql_type, value, stored", [
+    ("SMALLINT", 32767, 32767),
+    ("SMALLINT", -32768, -32768),
+    # float8 -> smallint: к чётному, как rint() в Postgres
+    ("SMALLINT", 2.5, 2),
+    ("SMALLINT", -2.5, -2),
+    ("NUMERIC(5, 2)", 999.99, 999.99),
+    ("NUMERIC(5, 2)", 0.125, 0.13),
+    ("NUMERIC(5, 2)", -0.125, -0.13),
+    ("NUMERIC(3, 1)", 4.04, 4.0),
+    ("NUMERIC(5, 2)", Decimal("1.5"), 1.5),
+    ("TEXT", "Yes", "Yes"),
+])
+def test_coerce_accepts_like_postgres(sql_type, value, stored):
+    assert repository._coerce(sql_type, value) == stored
+
+
+@pytest.mark.parametrize("sql_type, value", [
+    ("SMALLINT", 32768),
+    ("SMALLINT", -32769),
+    ("SMALLINT", 32767.9),
+    ("SMALLINT", 1e300),
+    ("SMALLINT", True),
+    ("SMALLINT", "3"),
+    ("NUMERIC(5, 2)", 999.995),
+    ("NUMERIC(5, 2)", 1000),
+    ("NUMERIC(5, 2)", float("inf")),
+    ("NUMERIC(5, 2)", "2.5"),
+    ("NUMERIC(3, 1)", True),
+])
+def test_coerce_rejects_like_postgres(sql_type, value):
+    with pytest.raises(repository.ConstraintViolation):
+        repository._coerce(sql_type, value)
+
+
+def test_check_applies_to_the_stored_value():
+    repo = repository.MemoryRepository()
+    monthly = {column: 1 for column in repository.TABLE_COLUMNS["monthly_entries"]}
+    # 4.04 хранится как 4.0 и проходит CHECK (avoid_travel BETWEEN 1 AND 4), 4.05 -> 4.1 - нет
+    _, values = repo._validate("monthly_entries", {**monthly, "avoid_travel": 4.04})
+    assert values["avoid_travel"] == 4.0
+    with pytest.raises(repository.ConstraintViolation, match="monthly_entries_avoid_travel_check"):
+        repo._validate("monthly_entries", {**monthly, "avoid_travel": 4.05})
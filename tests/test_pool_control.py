@@ -0,0 +1,65 @@
+"""pool_control: the adaptive gate counts each timeout once."""
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pool_control  # noqa: E402
+
+
+class QueryTimeout(TimeoutError):
+    """Stands in for a driver / statement timeout raised while the slot is held."""
+
+
+def make_controller(limit: int = 8, timeout: float = 1.0) -> pool_control.AimdController:
+    gate = pool_control.ConcurrencyGate(limit, timeout=timeout, name="test")
+    return pool_control.AimdController(gate, low=1, high=32, interval=3600)
+
+
+def test_timeout_inside_slot_lowers_limit_once():
+    controller = make_controller(limit=8)
+
+    async def run():
+        with pytest.raises(QueryTimeout):
+            async with pool_control.slot(controller):
+                error = QueryTimeout("canceling statement due to statement timeout")
+                # Так ошибку передаёт хук handle_error движка
+                pool_control.observe_error(error)
+                raise error
+        assert controller._errors == {"timeout": 1}
+        assert controller.gate.in_flight == 0
+        await controller.tick()
+
+    asyncio.run(run())
+    assert controller.gate.limit == 6
+    assert controller.last_decision == ("decrease", "timeout")
+
+
+def test_gate_wait_timeout_is_observed_once():
+    controller = make_controller(limit=1, timeout=0.05)
+
+    async def run():
+        async with pool_control.slot(controller):
+            with pytest.raises(asyncio.TimeoutError):
+                async with pool_control.slot(controller):
+                    pass
+        assert controller._errors == {"timeout": 1}
+        assert controller.gate.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_error_without_kind_is_ignored():
+    controller = make_controller()
+
+    async def run():
+        with pytest.raises(ValueError):
+            async with pool_control.slot(controller):
+                raise ValueError("violates check constraint")
+        await controller.tick()
+
+    asyncio.run(run())
+    assert controller._errors == {}
+    assert controller.gate.limit == 8
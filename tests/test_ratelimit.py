@@ -0,0 +1,145 @@
+"""ratelimit: budgets, the in-memory token bucket, client IP behind proxies and check()."""
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ratelimit  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    return clock
+
+
+def acquire(limiter, key, budget):
+    return asyncio.run(limiter.acquire(key, budget))
+
+
+@pytest.mark.parametrize("value, per_minute, burst", [
+    ("60:30", 60.0, 30),
+    ("0.5:1", 0.5, 1),
+    # без burst - минутный запас, но не меньше одного токена
+    ("120", 120.0, 120),
+    ("0.5", 0.5, 1),
+])
+def test_budget_parse(value, per_minute, burst):
+    budget = ratelimit.Budget.parse(value)
+    assert (budget.per_minute, budget.burst) == (per_minute, burst)
+    assert budget.rate == per_minute / 60.0
+
+
+@pytest.mark.parametrize("value", ["0:10", "-5:10", "60:0", "abc", "60:x", ""])
+def test_budget_parse_rejects_invalid(value):
+    with pytest.raises(ValueError):
+        ratelimit.Budget.parse(value)
+
+
+def test_bucket_allows_burst_then_refills(clock):
+    limiter = ratelimit.MemoryRateLimiter()
+    budget = ratelimit.Budget(per_minute=60, burst=3)
+    assert [acquire(limiter, "k", budget) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert acquire(limiter, "k", budget) == pytest.approx(1.0)
+
+    clock.now += 0.5
+    assert acquire(limiter, "k", budget) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert acquire(limiter, "k", budget) == 0.0
+
+    # Долгий простой не даёт больше burst
+    clock.now += 3600
+    assert [acquire(limiter, "k", budget) for _ in range(4)][-1] > 0
+
+
+def test_least_recently_used_bucket_is_evicted(clock):
+    limiter = ratelimit.MemoryRateLimiter(max_keys=2)
+    budget = ratelimit.Budget(per_minute=1, burst=1)
+    acquire(limiter, "a", budget)
+    acquire(limiter, "b", budget)
+    assert acquire(limiter, "a", budget) > 0  # "a" снова самый свежий
+    acquire(limiter, "c", budget)
+
+    assert list(limiter._buckets) == ["a", "c"]
+    # Вытесненный ключ начинает с полного bucket
+    assert acquire(limiter, "b", budget) == 0.0
+    assert list(limiter._buckets) == ["c", "b"]
+
+
+class Headers(dict):
+    """Starlette Headers stand-in: lower-case keys, .get()."""
+
+
+@pytest.mark.parametrize("hops, forwarded, expected", [
+    (0, "1.1.1.1", "10.0.0.9"),
+    (1, "1.1.1.1", "1.1.1.1"),
+    # Клиент подделал левую часть; берём адрес, дописанный нашим прокси
+    (1, "6.6.6.6, 1.1.1.1", "1.1.1.1"),
+    (2, "6.6.6.6, 1.1.1.1, 172.16.0.2", "1.1.1.1"),
+    # Заголовок короче числа прокси - запрос пришёл в обход, адрес сокета
+    (2, "1.1.1.1", "10.0.0.9"),
+    (1, "", "10.0.0.9"),
+])
+def test_client_ip_behind_proxies(monkeypatch, hops, forwarded, expected):
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_PROXY_HOPS", hops)
+    headers = Headers({"x-forwarded-for": forwarded} if forwarded else {})
+    assert ratelimit.client_ip(headers, "10.0.0.9") == expected
+
+
+def test_client_ip_without_peer(monkeypatch):
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_PROXY_HOPS", 0)
+    assert ratelimit.client_ip(Headers(), None) == "unknown"
+
+
+@pytest.fixture
+def budgets(monkeypatch):
+    budgets = {
+        ("patient", "write"): ratelimit.Budget(per_minute=1, burst=1),
+        ("patient", "read"): ratelimit.Budget(per_minute=1, burst=1),
+        ("ip", "write"): ratelimit.Budget(per_minute=1, burst=2),
+        ("ip", "read"): ratelimit.Budget(per_minute=1, burst=2),
+    }
+    monkeypatch.setattr(ratelimit, "BUDGETS", budgets)
+    return budgets
+
+
+def test_check_spends_ip_then_patient(clock, budgets):
+    limiter = ratelimit.MemoryRateLimiter()
+    assert asyncio.run(ratelimit.check(limiter, "write", "AAAA", "1.1.1.1")) is None
+    assert limiter._buckets["ip:write:1.1.1.1"][0] == 1.0
+    assert limiter._buckets["patient:write:AAAA"][0] == 0.0
+    # Чтение - отдельные bucket
+    assert asyncio.run(ratelimit.check(limiter, "read", "AAAA", "1.1.1.1")) is None
+
+
+def test_patient_rejection_refunds_the_ip_token(clock, budgets):
+    limiter = ratelimit.MemoryRateLimiter()
+    asyncio.run(ratelimit.check(limiter, "write", "AAAA", "1.1.1.1"))
+
+    scope, wait = asyncio.run(ratelimit.check(limiter, "write", "AAAA", "1.1.1.1"))
+    assert scope == "patient" and wait == pytest.approx(60.0)
+    assert limiter._buckets["ip:write:1.1.1.1"][0] == 1.0
+    # Отказы одного пациента не съедают бюджет IP: другой пациент за тем же адресом проходит
+    asyncio.run(ratelimit.check(limiter, "write", "AAAA", "1.1.1.1"))
+    assert asyncio.run(ratelimit.check(limiter, "write", "BBBB", "1.1.1.1")) is None
+
+
+def test_ip_rejection_does_not_touch_patient_bucket(clock, budgets):
+    limiter = ratelimit.MemoryRateLimiter()
+    asyncio.run(ratelimit.check(limiter, "write", None, "1.1.1.1"))
+    asyncio.run(ratelimit.check(limiter, "write", None, "1.1.1.1"))
+
+    scope, _ = asyncio.run(ratelimit.check(limiter, "write", "AAAA", "1.1.1.1"))
+    assert scope == "ip"
+    assert "patient:write:AAAA" not in limiter._buckets
@@ -0,0 +1,151 @@
+"""singleflight.SingleFlight: coalescing, cancellation of abandoned queries, forget()."""
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import singleflight  # noqa: E402
+
+
+class Query:
+    """Read query stand-in: counts executions and blocks until release()."""
+
+    def __init__(self):
+        self.started = 0
+        self.cancelled = 0
+        self.gate = asyncio.Event()
+
+    async def __call__(self):
+        self.started += 1
+        number = self.started
+        try:
+            await self.gate.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return {"execution": number}
+
+    def release(self):
+        self.gate.set()
+
+
+async def settle():
+    """Let the callers and the query tasks they started run up to their first await."""
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_concurrent_calls_share_one_execution():
+    flights = singleflight.SingleFlight(enabled=True)
+
+    async def run():
+        query = Query()
+        callers = [asyncio.ensure_future(flights.do("getLarsData", "AAAA", ("weekly",), query)) for _ in range(5)]
+        await settle()
+        query.release()
+        results = await asyncio.gather(*callers)
+        assert query.started == 1
+        # Один и тот же объект у всех
+        assert all(result is results[0] for result in results)
+        assert flights._flights == {}
+
+    asyncio.run(run())
+
+
+def test_different_params_are_not_coalesced():
+    flights = singleflight.SingleFlight(enabled=True)
+
+    async def run():
+        query = Query()
+        query.release()
+        await asyncio.gather(
+            flights.do("getLarsData", "AAAA", ("weekly",), query),
+            flights.do("getLarsData", "AAAA", ("monthly",), query),
+            flights.do("getLarsData", "BBBB", ("weekly",), query),
+        )
+        assert query.started == 3
+
+    asyncio.run(run())
+
+
+def test_exception_reaches_every_waiter():
+    flights = singleflight.SingleFlight(enabled=True)
+
+    async def failing():
+        await asyncio.sleep(0)
+        raise RuntimeError("connection lost")
+
+    async def run():
+        results = await asyncio.gather(
+            *(flights.do("getLarsData", "AAAA", (), failing) for _ in range(3)), return_exceptions=True
+        )
+        assert [type(result) for result in results] == [RuntimeError] * 3
+
+    asyncio.run(run())
+
+
+def test_query_is_cancelled_when_every_waiter_goes_away():
+    flights = singleflight.SingleFlight(enabled=True)
+
+    async def run():
+        query = Query()
+        callers = [asyncio.ensure_future(flights.do("getDailyTrends", "AAAA", (30,), query)) for _ in range(3)]
+        await settle()
+        task = flights._flights["AAAA"][("getDailyTrends", (30,))].task
+
+        callers[0].cancel()
+        callers[1].cancel()
+        await settle()
+        # Третий ещё ждёт - запрос продолжается
+        assert not task.done()
+
+        callers[2].cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await callers[2]
+        await settle()
+        assert task.cancelled()
+        assert query.cancelled == 1
+        assert flights._flights == {}
+
+    asyncio.run(run())
+
+
+def test_forget_starts_a_fresh_query():
+    flights = singleflight.SingleFlight(enabled=True)
+
+    async def run():
+        old_read, new_read = Query(), Query()
+        before = asyncio.ensure_future(flights.do("getLarsData", "AAAA", ("weekly",), old_read))
+        await settle()
+        # Запись закоммичена: следующие запросы не присоединяются к старому чтению
+        flights.forget("AAAA")
+        after = asyncio.ensure_future(flights.do("getLarsData", "AAAA", ("weekly",), new_read))
+        await settle()
+        assert (old_read.started, new_read.started) == (1, 1)
+
+        old_read.release()
+        assert await before == {"execution": 1}
+        # Завершение старого запроса не снимает новый: к нему ещё можно присоединиться
+        joined = asyncio.ensure_future(flights.do("getLarsData", "AAAA", ("weekly",), new_read))
+        await settle()
+        assert new_read.started == 1
+
+        new_read.release()
+        assert await after is await joined
+        assert flights._flights == {}
+
+    asyncio.run(run())
+
+
+def test_disabled_runs_every_call():
+    flights = singleflight.SingleFlight(enabled=False)
+
+    async def run():
+        query = Query()
+        query.release()
+        await asyncio.gather(*(flights.do("getLarsData", "AAAA", (), query) for _ in range(3)))
+        assert query.started == 3
+
+    asyncio.run(run())
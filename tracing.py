@@ -0,0 +1,314 @@
+"""Request-scoped tracing: handler, SQL statement, pool checkout and retry-sleep spans.
+
+A trace is started per HTTP request by the middleware in app.py and kept in a
+context variable, so repository code and SQLAlchemy cursor events add spans to
+it without passing anything around. When no trace is active span() is a no-op.
+
+Configuration (env):
+- TRACE_EXPORT: file path (one JSON trace per line) or http(s):// URL of an
+  OTLP/HTTP JSON collector, e.g. http://localhost:4318/v1/traces
+- TRACE_SAMPLE_RATE: share of requests to export, 0..1 (default 0)
+- TRACE_SLOW_MS: also export every request slower than this (default 0 = off)
+- TRACE_DEBUG_TOKEN: when set, a request with "X-Debug-Timing: <token>" gets a
+  Server-Timing response header with the span breakdown
+"""
+import os
+import json
+import time
+import uuid
+import queue
+import random
+import threading
+import contextvars
+import urllib.request
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.sql.elements import TextClause
+
+
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))
+TRACE_DEBUG_TOKEN = os.getenv("TRACE_DEBUG_TOKEN", "")
+DEBUG_HEADER = "x-debug-timing"
+SERVICE_NAME = "lars_backend"
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    parent_id: Optional[str]
+    start_ns: int
+    attributes: dict = field(default_factory=dict)
+    duration_ms: Optional[float] = None
+    error: Optional[str] = None
+    _t0: float = field(default_factory=time.perf_counter, repr=False)
+
+    def end(self, error: Optional[BaseException] = None):
+        if self.duration_ms is None:
+            self.duration_ms = (time.perf_counter() - self._t0) * 1000
+        if error is not None:
+            self.error = f"{type(error).__name__}: {str(error)[:200]}"
+
+
+class Trace:
+    def __init__(self, name: str, sampled: bool):
+        self.trace_id = uuid.uuid4().hex
+        self.sampled = sampled
+        self.spans = []
+        self.root = self.start_span(name, parent=None)
+
+    def start_span(self, name: str, parent: Optional[Span], attributes: Optional[dict] = None) -> Span:
+        span = Span(
+            name=name,
+            span_id=uuid.uuid4().hex[:16],
+            parent_id=parent.span_id if parent else None,
+            start_ns=time.time_ns(),
+            attributes=attributes or {},
+        )
+        self.spans.append(span)
+        return span
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("trace_span", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def recording_enabled() -> bool:
+    return bool(TRACE_EXPORT) and (TRACE_SAMPLE_RATE > 0 or TRACE_SLOW_MS > 0)
+
+
+def debug_requested(header_value: Optional[str]) -> bool:
+    return bool(TRACE_DEBUG_TOKEN) and header_value == TRACE_DEBUG_TOKEN
+
+
+def start_trace(name: str) -> Trace:
+    trace = Trace(name, sampled=random.random() < TRACE_SAMPLE_RATE)
+    _current_trace.set(trace)
+    _current_span.set(trace.root)
+    return trace
+
+
+def finish_trace(trace: Trace, error: Optional[BaseException] = None):
+    trace.root.end(error)
+    _current_trace.set(None)
+    _current_span.set(None)
+    slow = TRACE_SLOW_MS > 0 and trace.root.duration_ms >= TRACE_SLOW_MS
+    if TRACE_EXPORT and (trace.sampled or slow):
+        _exporter().submit(trace)
+
+
+def start_span(name: str, **attributes) -> Optional[Span]:
+    """Start a leaf span under the current one; end it with span.end()."""
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    return trace.start_span(name, _current_span.get(), attributes)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Span around a block; nested spans become its children."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = trace.start_span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.end(e)
+        raise
+    finally:
+        current.end()
+        _current_span.reset(token)
+
+
+def server_timing(trace: Trace) -> str:
+    """Server-Timing header value: total plus one metric per span in start order."""
+    parts = [f"total;dur={trace.root.duration_ms:.1f}"]
+    for position, item in enumerate(trace.spans[1:], start=1):
+        duration = item.duration_ms if item.duration_ms is not None else 0.0
+        desc = item.attributes.get("db.statement_name") or item.error or ""
+        metric = f"{position}-{item.name};dur={duration:.1f}"
+        if desc:
+            metric += ';desc="' + str(desc).replace('"', "'")[:100] + '"'
+        parts.append(metric)
+    return ", ".join(parts)
+
+
+# ==========================================
+# SQLAlchemy instrumentation
+# ==========================================
+
+def statement_names(*modules) -> dict:
+    """SQL text -> constant name for every TextClause defined in the given modules."""
+    names = {}
+    for module in modules:
+        for name, value in vars(module).items():
+            if isinstance(value, TextClause):
+                names.setdefault(value.text, f"{module.__name__}.{name}")
+    return names
+
+
+def instrument_engine(engine, names: Optional[dict] = None):
+    """Add a db.sql span for every statement executed through the engine."""
+    names = names or {}
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current_trace.get() is None or context is None:
+            return
+        compiled = getattr(context, "compiled", None)
+        clause_text = getattr(getattr(compiled, "statement", None), "text", None)
+        context._trace_span = start_span(
+            "db.sql",
+            **{
+                "db.statement_name": names.get(clause_text, "adhoc"),
+                "db.statement": statement[:500],
+            },
+        )
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        current = getattr(context, "_trace_span", None)
+        if current is not None:
+            current.end()
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(exception_context):
+        current = getattr(exception_context.execution_context, "_trace_span", None)
+        if current is not None:
+            current.end(exception_context.original_exception)
+
+
+# ==========================================
+# Export
+# ==========================================
+
+def _trace_record(trace: Trace) -> dict:
+    return {
+        "trace_id": trace.trace_id,
+        "name": trace.root.name,
+        "duration_ms": round(trace.root.duration_ms, 3),
+        "spans": [
+            {
+                "span_id": item.span_id,
+                "parent_id": item.parent_id,
+                "name": item.name,
+                "start_ns": item.start_ns,
+                "duration_ms": round(item.duration_ms or 0.0, 3),
+                "attributes": item.attributes,
+                "error": item.error,
+            }
+            for item in trace.spans
+        ],
+    }
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_payload(traces: list) -> dict:
+    spans = []
+    for trace in traces:
+        for item in trace.spans:
+            otlp_span = {
+                "traceId": trace.trace_id,
+                "spanId": item.span_id,
+                "name": item.name,
+                "kind": 2 if item.parent_id is None else 1,  # SERVER / INTERNAL
+                "startTimeUnixNano": str(item.start_ns),
+                "endTimeUnixNano": str(item.start_ns + int((item.duration_ms or 0.0) * 1e6)),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in item.attributes.items()],
+                "status": {"code": 2, "message": item.error} if item.error else {"code": 1},
+            }
+            if item.parent_id:
+                otlp_span["parentSpanId"] = item.parent_id
+            spans.append(otlp_span)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": spans}],
+        }]
+    }
+
+
+class TraceExporter:
+    """Writes finished traces from a background thread so requests never wait on I/O.
+
+    The queue is bounded; when the target cannot keep up traces are dropped
+    and counted instead of growing memory.
+    """
+
+    def __init__(self, target: str, max_queue: int = 1000, batch_size: int = 100):
+        self.target = target
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue: "queue.Queue[Trace]" = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def submit(self, trace: Trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"Trace export failed ({len(batch)} traces): {type(e).__name__}: {e}")
+
+    def _write(self, batch: list):
+        if self.target.startswith(("http://", "https://")):
+            request = urllib.request.Request(
+                self.target,
+                data=json.dumps(_otlp_payload(batch)).encode(),
+                headers={"Content-Type": "application/json"},
+                method="POST",
+            )
+            with urllib.request.urlopen(request, timeout=5) as response:
+                response.read()
+            return
+        with open(self.target, "a", encoding="utf-8") as f:
+            for trace in batch:
+                f.write(json.dumps(_trace_record(trace), default=str) + "\n")
+
+
+_exporter_instance: Optional[TraceExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def _exporter() -> TraceExporter:
+    global _exporter_instance
+    if _exporter_instance is None:
+        with _exporter_lock:
+            if _exporter_instance is None:
+                _exporter_instance = TraceExporter(TRACE_EXPORT)
+    return _exporter_instance